@@ -19,6 +19,10 @@ class _Annotation():
     TYPE = None
     UPLOADABLE_DESCRIPTION = None
 
+    # Annotations can be made by the million (see AnnotationTable), so
+    # they carry no per-instance __dict__
+    __slots__ = ('_collection', '_source', '_data')
+
     def __init__(self, collection, annotation_data, source=None):
         """
         Base class for annotations.
@@ -129,6 +133,8 @@ class AnnotationMask(_Annotation):
     re-downloading of data.
     """
 
+    __slots__ = ()
+
     TYPE = 'mask'
     UPLOADABLE_DESCRIPTION = """
         Mask annotation data includes the actual mask (as a base64 encoded
@@ -351,6 +357,8 @@ class AnnotationBB(_Annotation):
     re-downloading of data.
     """
 
+    __slots__ = ()
+
     TYPE = 'zc-boundingbox'
     UPLOADABLE_DESCRIPTION = """
         Bounding box annotation data includes the bounding box bounds,
@@ -398,6 +406,8 @@ class AnnotationPolygon(_Annotation):
     re-downloading of data.
     """
 
+    __slots__ = ()
+
     TYPE = 'zc-polygon'
     UPLOADABLE_DESCRIPTION = """
         Polygon annotation data includes the coordinates of the
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""local annotation store functionality."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from .annotation_table import AnnotationTable
+
+
+class AnnotationStore():
+    """
+    A local SQLite copy of the annotations of one collection source, so
+    they can be queried repeatedly without downloading them each time.
+
+    sync() brings the store up to date with batches of every annotation
+    (see collection.iter_annotations()), writing only the annotations that
+    were added or changed since the last sync, and removing deleted ones. Each
+    annotation is stored as its JSON along with a content hash and indexed
+    columns (image_index, class_id, author, type) for fast local queries.
+
+    Get one, synced, with collection.sync_annotation_store().
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS annotations ('
+        'id TEXT PRIMARY KEY, image_index INTEGER, class_id INTEGER, author TEXT, type TEXT, '
+        'hash TEXT NOT NULL, data TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS annotations_image_index ON annotations (image_index)',
+        'CREATE INDEX IF NOT EXISTS annotations_class_id ON annotations (class_id)',
+        'CREATE INDEX IF NOT EXISTS annotations_author ON annotations (author)',
+        'CREATE INDEX IF NOT EXISTS annotations_type ON annotations (type)',
+    ]
+
+    def __repr__(self):
+        return '<AnnotationStore "{}" ({} annotations)>'.format(self.path, len(self))
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM annotations').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def _row(anno) -> tuple:
+        data = json.dumps(anno, sort_keys=True)
+        class_id = anno.get('class_id')
+        return (
+            str(anno['id']),
+            anno.get('image_index'),
+            None if class_id is None else int(class_id),
+            anno.get('author'),
+            anno.get('type'),
+            hashlib.sha1(data.encode('utf-8')).hexdigest(),
+            data,
+        )
+
+    def sync(self, batches) -> dict:
+        """
+        Makes the store hold exactly the annotations in 'batches' (an
+        iterable of lists of annotation dicts), in one transaction. Returns
+        { inserted, updated, deleted }.
+        """
+        result = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        with self._lock, self._db:
+            db = self._db
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)')
+            db.execute('DELETE FROM seen')
+
+            for batch in batches:
+                rows = [self._row(a) for a in batch]
+                ids = [r[0] for r in rows]
+                existing = {}
+                # Stay under SQLite's limit on query parameters
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    existing.update(db.execute(
+                        'SELECT id, hash FROM annotations WHERE id IN ({})'.format(','.join('?' * len(chunk))),
+                        chunk))
+
+                changed = [r for r in rows if existing.get(r[0]) != r[5]]
+                result['updated'] += sum(r[0] in existing for r in changed)
+                result['inserted'] += sum(r[0] not in existing for r in changed)
+                db.executemany('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+                db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(i,) for i in ids])
+
+            result['deleted'] = db.execute('DELETE FROM annotations WHERE id NOT IN (SELECT id FROM seen)').rowcount
+            db.execute('DELETE FROM seen')
+
+        return result
+
+    def query(self, image_index=None, class_id=None, author=None, anno_type=None) -> list:
+        """
+        Returns the stored annotation dicts matching every filter given,
+        ordered by image. Each filter may be one value or a list of values.
+        """
+        clauses, params = [], []
+        for column, value in [('image_index', image_index), ('class_id', class_id),
+                              ('author', author), ('type', anno_type)]:
+            if value is None:
+                continue
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            clauses.append('{} IN ({})'.format(column, ','.join('?' * len(values))))
+            params += [v if column in ('author', 'type') else int(v) for v in values]
+
+        sql = 'SELECT data FROM annotations'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY image_index, id'
+
+        with self._lock:
+            return [json.loads(data) for data, in self._db.execute(sql, params)]
+
+    def table(self, **filters) -> AnnotationTable:
+        """The annotations matching 'filters' (see query()) as an AnnotationTable."""
+        return AnnotationTable.from_annotations(self.query(**filters))
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""columnar annotation functionality."""
+
+import numpy as np
+import pandas as pd
+
+BB_TYPE = 'zc-boundingbox'
+POLYGON_TYPE = 'zc-polygon'
+MASK_TYPES = ['mask', 'mask_1UC1']
+
+
+def _gather(buffer, offsets, indices):
+    """
+    Gathers the segments 'indices' of a buffer split by 'offsets' (segment
+    i is buffer[offsets[i]:offsets[i + 1]]) into a new buffer and offsets.
+    """
+    starts = offsets[:-1][indices]
+    lengths = offsets[1:][indices] - starts
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return buffer[positions], new_offsets
+
+
+def _bounds(annotation, anno_type) -> tuple:
+    """The (x, y, w, h) box of a raw annotation's data, NaN where it has none."""
+    if anno_type == BB_TYPE:
+        return annotation.get('x'), annotation.get('y'), annotation.get('w'), annotation.get('h')
+    if anno_type in MASK_TYPES and annotation.get('roi'):
+        roi = annotation['roi']
+        return roi.get('xmin'), roi.get('ymin'), roi.get('width'), roi.get('height')
+    points = annotation.get('points')
+    if anno_type == POLYGON_TYPE and points:
+        xs, ys = np.asarray(points, dtype=np.float64).reshape(-1, 2).T
+        return xs.min(), ys.min(), xs.max() - xs.min(), ys.max() - ys.min()
+    return np.nan, np.nan, np.nan, np.nan
+
+
+class AnnotationTable():
+    """
+    A collection's annotations held as columns rather than as one dict (or
+    object) per annotation, for working with millions of them.
+
+    Each field (id, image_index, class_id, author, type, score, the bounding
+    box x/y/w/h and mask width/height) is one array, with author and type
+    as pandas categoricals. Polygon points share one float32 [N, 2] buffer
+    and mask data one uint8 buffer, each annotation's share found through an
+    offsets array.
+
+    Tables can be filtered and grouped by image without creating any
+    annotation objects. AnnotationBB, AnnotationPolygon and AnnotationMask
+    objects are only made when asked for, with annotation() or iteration.
+
+    Get one with collection.get_annotations_table(), or build one from
+    annotation dicts as returned by collection.get_annotations() with
+    AnnotationTable.from_annotations().
+    """
+
+    FIELDS = ['id', 'image_index', 'class_id', 'author', 'type', 'score',
+              'x', 'y', 'w', 'h', 'mask_width', 'mask_height']
+
+    def __repr__(self):
+        return '<AnnotationTable ({} annotations)>'.format(len(self))
+
+    def __init__(self, columns, points, point_offsets, mask_data, mask_offsets,
+                 collection=None, source=None):
+        """
+        Takes the field arrays (see FIELDS) and shared buffers directly.
+        Use from_annotations() to build a table from annotation dicts.
+        """
+        missing = [f for f in self.FIELDS if f not in columns]
+        if missing:
+            raise ValueError('Missing annotation table columns: {}'.format(missing))
+        self._columns = columns
+        self._points = points
+        self._point_offsets = point_offsets
+        self._mask_data = mask_data
+        self._mask_offsets = mask_offsets
+        self._collection = collection
+        self._source = source
+
+    @classmethod
+    def from_annotations(cls, annotations, collection=None, source=None) -> 'AnnotationTable':
+        """
+        Builds a table from an iterable of annotation dicts, as returned by
+        collection.get_annotations(), in one pass.
+        """
+        fields = {f: [] for f in cls.FIELDS}
+        points, point_lengths = [], []
+        masks, mask_lengths = [], []
+
+        for a in annotations:
+            anno_type = a.get('type')
+            data = a.get('annotation') or {}
+            fields['id'].append(a.get('id'))
+            fields['image_index'].append(a.get('image_index', -1))
+            class_id = a.get('class_id')
+            fields['class_id'].append(-1 if class_id is None else int(class_id))
+            fields['author'].append(a.get('author'))
+            fields['type'].append(anno_type)
+            score = data.get('score')
+            fields['score'].append(np.nan if score is None else score)
+            for f, v in zip(['x', 'y', 'w', 'h'], _bounds(data, anno_type)):
+                fields[f].append(np.nan if v is None else v)
+            fields['mask_width'].append(data.get('width', -1) if anno_type in MASK_TYPES else -1)
+            fields['mask_height'].append(data.get('height', -1) if anno_type in MASK_TYPES else -1)
+
+            p = data.get('points') if anno_type == POLYGON_TYPE else None
+            p = np.asarray(p or [], dtype=np.float32).reshape(-1, 2)
+            points.append(p)
+            point_lengths.append(len(p))
+
+            m = data.get('mask') if anno_type in MASK_TYPES else None
+            m = (m or '').encode('ascii')
+            masks.append(m)
+            mask_lengths.append(len(m))
+
+        columns = {
+            'id': np.array(fields['id'], dtype=object),
+            'image_index': np.array(fields['image_index'], dtype=np.int64),
+            'class_id': np.array(fields['class_id'], dtype=np.int64),
+            'author': pd.Categorical(fields['author']),
+            'type': pd.Categorical(fields['type']),
+            'mask_width': np.array(fields['mask_width'], dtype=np.int32),
+            'mask_height': np.array(fields['mask_height'], dtype=np.int32),
+        }
+        for f in ['score', 'x', 'y', 'w', 'h']:
+            columns[f] = np.array(fields[f], dtype=np.float64)
+
+        return cls(
+            columns,
+            np.concatenate(points) if points else np.zeros((0, 2), dtype=np.float32),
+            np.concatenate([[0], np.cumsum(point_lengths, dtype=np.int64)]).astype(np.int64),
+            np.frombuffer(b''.join(masks), dtype=np.uint8),
+            np.concatenate([[0], np.cumsum(mask_lengths, dtype=np.int64)]).astype(np.int64),
+            collection=collection, source=source)
+
+    @classmethod
+    def concat(cls, tables) -> 'AnnotationTable':
+        """Joins several tables (eg built from batches of annotations) into one."""
+        tables = list(tables)
+        if not tables:
+            return cls.from_annotations([])
+
+        def join_offsets(offsets):
+            shifts = np.cumsum([0] + [o[-1] for o in offsets[:-1]])
+            return np.concatenate([offsets[0][:1]] + [o[1:] + s for o, s in zip(offsets, shifts)])
+
+        columns = {}
+        for f in cls.FIELDS:
+            parts = [t._columns[f] for t in tables]
+            if isinstance(parts[0], pd.Categorical):
+                columns[f] = pd.Categorical(np.concatenate([np.asarray(p, dtype=object) for p in parts]))
+            else:
+                columns[f] = np.concatenate(parts)
+
+        return cls(
+            columns,
+            np.concatenate([t._points for t in tables]),
+            join_offsets([t._point_offsets for t in tables]),
+            np.concatenate([t._mask_data for t in tables]),
+            join_offsets([t._mask_offsets for t in tables]),
+            collection=tables[0]._collection, source=tables[0]._source)
+
+    def __len__(self):
+        return len(self._columns['id'])
+
+    def __getitem__(self, field):
+        """One field's column, eg table['image_index']."""
+        return self._columns[field]
+
+    @property
+    def bboxes():
+        pass
+
+    @bboxes.getter
+    def bboxes(self) -> np.ndarray:
+        """An [N, 4] array of (x, y, w, h), NaN for annotations without a box."""
+        return np.stack([self._columns[f] for f in ['x', 'y', 'w', 'h']], axis=1)
+
+    def take(self, indices) -> 'AnnotationTable':
+        """A new table of the annotations at 'indices' (ints, or a boolean mask)."""
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = indices.astype(np.int64)
+
+        columns = {f: c[indices] for f, c in self._columns.items()}
+        points, point_offsets = _gather(self._points, self._point_offsets, indices)
+        mask_data, mask_offsets = _gather(self._mask_data, self._mask_offsets, indices)
+        return AnnotationTable(columns, points, point_offsets, mask_data, mask_offsets,
+                               collection=self._collection, source=self._source)
+
+    def filter(self, image_index=None, class_id=None, author=None, anno_type=None, min_score=None):
+        """
+        A new table of the annotations matching every filter given. Each
+        filter may be one value or a list of values to accept.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        for field, value in [('image_index', image_index), ('class_id', class_id),
+                             ('author', author), ('type', anno_type)]:
+            if value is not None:
+                values = value if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+                keep &= np.asarray(pd.Series(self._columns[field]).isin(list(values)))
+        if min_score is not None:
+            keep &= self._columns['score'] >= min_score
+        return self.take(keep)
+
+    def group_by_image(self):
+        """Yields (image_index, table) for each image with annotations, in image order."""
+        image_indices = self._columns['image_index']
+        order = np.argsort(image_indices, kind='stable')
+        images, starts = np.unique(image_indices[order], return_index=True)
+        for image_index, group in zip(images, np.split(order, starts[1:])):
+            yield int(image_index), self.take(group)
+
+    def points(self, i) -> np.ndarray:
+        """The [n, 2] polygon points of annotation 'i' (a view of the shared buffer)."""
+        return self._points[self._point_offsets[i]:self._point_offsets[i + 1]]
+
+    def mask_data(self, i) -> str:
+        """The encoded mask data of annotation 'i', as sent by Zegami."""
+        return self._mask_data[self._mask_offsets[i]:self._mask_offsets[i + 1]].tobytes().decode('ascii')
+
+    def to_dict(self, i) -> dict:
+        """Annotation 'i' as a dict, in the shape returned by collection.get_annotations()."""
+        c = self._columns
+        anno_type = c['type'][i]
+        score = c['score'][i]
+        data = {'score': None if np.isnan(score) else float(score)}
+        if anno_type == BB_TYPE:
+            data.update({'x': c['x'][i], 'y': c['y'][i], 'w': c['w'][i], 'h': c['h'][i]})
+        elif anno_type == POLYGON_TYPE:
+            data['points'] = self.points(i).tolist()
+        elif anno_type in MASK_TYPES:
+            data.update({
+                'mask': self.mask_data(i),
+                'width': int(c['mask_width'][i]),
+                'height': int(c['mask_height'][i]),
+            })
+            if not np.isnan(c['x'][i]):
+                data['roi'] = {'xmin': c['x'][i], 'ymin': c['y'][i], 'width': c['w'][i], 'height': c['h'][i]}
+
+        return {
+            'id': c['id'][i],
+            'image_index': int(c['image_index'][i]),
+            'class_id': None if c['class_id'][i] < 0 else int(c['class_id'][i]),
+            'author': c['author'][i],
+            'type': anno_type,
+            'annotation': data,
+        }
+
+    def annotation(self, i):
+        """Makes the annotation object (AnnotationBB, AnnotationPolygon or AnnotationMask) of annotation 'i'."""
+        # annotation.py needs OpenCV, so it is only imported once objects are asked for
+        from .annotation import AnnotationBB, AnnotationMask, AnnotationPolygon
+
+        anno_type = self._columns['type'][i]
+        classes = {AnnotationBB.TYPE: AnnotationBB, AnnotationPolygon.TYPE: AnnotationPolygon}
+        classes.update({t: AnnotationMask for t in MASK_TYPES})
+        if anno_type not in classes:
+            raise ValueError('No annotation class for type "{}"'.format(anno_type))
+        return classes[anno_type](self._collection, self.to_dict(i), source=self._source)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.annotation(i)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""chunked blob upload functionality."""
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from time import sleep
+from urllib.parse import parse_qs, quote, urlparse
+
+# GCS resumable chunks must be a multiple of this, except the last
+GCS_CHUNK_MULTIPLE = 256 * 1024
+
+
+def _data_size(data) -> int:
+    """The size in bytes of bytes or a file-like object, or None if it can't be told without reading it."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    # Seek rather than fstat where possible, as fileno() moves spooled files to disk
+    if hasattr(data, 'seekable') and data.seekable():
+        position = data.tell()
+        size = data.seek(0, os.SEEK_END) - position
+        data.seek(position)
+        return size
+    try:
+        return os.fstat(data.fileno()).st_size - data.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class _RangeReader():
+    """Reads byte ranges of bytes or a seekable file, safely from several threads."""
+
+    def __init__(self, data):
+        self._data = data
+        self._lock = threading.Lock()
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self._base = 0
+            self._view = memoryview(data)
+        else:
+            self._base = data.tell()
+            self._view = None
+
+    def read(self, offset, length) -> bytes:
+        if self._view is not None:
+            return bytes(self._view[offset:offset + length])
+        with self._lock:
+            self._data.seek(self._base + offset)
+            return self._data.read(length)
+
+
+def _is_azure(url) -> bool:
+    return 'windows.net' in urlparse(url).netloc
+
+
+def _gcs_allows_resumable(url) -> bool:
+    """Whether a GCS signed url was signed for starting a resumable session (with 'x-goog-resumable')."""
+    signed_headers = parse_qs(urlparse(url).query).get('X-Goog-SignedHeaders', [''])[0]
+    return 'x-goog-resumable' in signed_headers.lower().split(';')
+
+
+def _with_query(url, **params) -> str:
+    return '{}{}{}'.format(url, '&' if urlparse(url).query else '?', '&'.join(
+        '{}={}'.format(k, v) for k, v in params.items()))
+
+
+class BlockUpload():
+    """
+    Uploads one large blob to a signed url in chunks, so a failure only
+    costs the chunk it happened in rather than the whole file.
+
+    On Azure the blob is sent as 'chunk_size' blocks ('Put Block'), up to
+    'concurrency' at once, then committed with 'Put Block List'. On GCS a
+    resumable session is started and the chunks are sent in order (the
+    protocol doesn't allow them in parallel); after a failed chunk the
+    session is asked how much it holds and continues from there. Each chunk
+    is attempted up to 'retries' + 1 times, waiting 'retry_delay' seconds
+    before the first retry and twice as long before each one after. If a
+    throttle.UploadThrottle is given, each chunk counts against its
+    in-flight budget and rate.
+
+    GCS only allows a resumable session from a url signed for it (with the
+    'x-goog-resumable' header). For other urls, or if the session is
+    refused, run() returns False and the caller should fall back on a
+    single PUT.
+
+    Used automatically by client._upload_to_signed_blob_storage_url() for
+    data of at least client.BLOCK_UPLOAD_THRESHOLD bytes.
+    """
+
+    def __init__(self, session, url, data, size, mime_type, chunk_size=8 * 1024 * 1024, concurrency=8,
+                 retries=3, retry_delay=1.0, verify=True, throttle=None):
+        self._session = session
+        self._throttle = throttle
+        self.url = url
+        self.size = size
+        self.mime_type = mime_type
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._verify = verify
+        self._reader = _RangeReader(data)
+
+    def run(self) -> bool:
+        """Uploads the blob, returning False if the url doesn't allow chunked uploads."""
+        if _is_azure(self.url):
+            self._run_azure()
+            return True
+        if not _gcs_allows_resumable(self.url):
+            return False
+        return self._run_gcs()
+
+    def _backoff(self, attempt):
+        """Waits before retry number 'attempt' (from 1), twice as long as before the last."""
+        sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def _retry(self, fn, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+            self._backoff(attempt + 1)
+
+    # Azure
+
+    def _run_azure(self):
+        n = max(1, -(-self.size // self.chunk_size))
+        # Block ids must all be the same length within a blob
+        block_ids = [base64.b64encode('{:08d}'.format(i).encode()).decode() for i in range(n)]
+
+        with ThreadPoolExecutor(min(self.concurrency, n)) as ex:
+            for f in [ex.submit(self._retry, self._put_block, i, block_id) for i, block_id in enumerate(block_ids)]:
+                f.result()
+
+        body = '<?xml version="1.0" encoding="utf-8"?><BlockList>{}</BlockList>'.format(
+            ''.join('<Latest>{}</Latest>'.format(b) for b in block_ids))
+        self._retry(self._put, _with_query(self.url, comp='blocklist'), body.encode(),
+                    {'x-ms-blob-content-type': self.mime_type, 'Content-Type': 'application/xml'})
+
+    def _put_block(self, i, block_id):
+        chunk = self._reader.read(i * self.chunk_size, self.chunk_size)
+        self._put(_with_query(self.url, comp='block', blockid=quote(block_id, safe='')), chunk, {})
+
+    def _send(self, url, chunk, headers):
+        """PUTs a chunk, within the throttle's limits if there is one."""
+        if self._throttle is None:
+            return self._session.put(url, data=chunk, headers=headers, verify=self._verify)
+        reserved = self._throttle.acquire(len(chunk))
+        try:
+            return self._session.put(url, data=self._throttle.wrap(chunk, len(chunk)), headers=headers,
+                                     verify=self._verify)
+        finally:
+            self._throttle.release(reserved)
+
+    def _put(self, url, body, headers):
+        r = self._send(url, body, headers)
+        if not r.ok:
+            raise IOError('Block upload to blob storage failed ({}): {}'.format(r.status_code, r.text[:200]))
+        return r
+
+    # GCS
+
+    def _run_gcs(self) -> bool:
+        session_url = self._retry(self._start_gcs_session)
+        if session_url is None:
+            return False
+        chunk_size = max(GCS_CHUNK_MULTIPLE, self.chunk_size // GCS_CHUNK_MULTIPLE * GCS_CHUNK_MULTIPLE)
+
+        offset = 0
+        failures = 0
+        while offset < self.size:
+            try:
+                offset = self._put_gcs_chunk(session_url, offset, chunk_size)
+                failures = 0
+            except Exception:
+                failures += 1
+                if failures > self.retries:
+                    raise
+                self._backoff(failures)
+                offset = self._gcs_persisted(session_url)
+        return True
+
+    def _start_gcs_session(self) -> str:
+        """Starts a resumable session, returning its url, or None if the signed url doesn't allow one."""
+        r = self._session.post(self.url, headers={'x-goog-resumable': 'start', 'Content-Type': self.mime_type},
+                               verify=self._verify)
+        if r.status_code in (400, 403, 405):
+            return None
+        if not r.ok or 'Location' not in r.headers:
+            raise IOError('Could not start a resumable upload ({}): {}'.format(r.status_code, r.text[:200]))
+        return r.headers['Location']
+
+    def _put_gcs_chunk(self, session_url, offset, chunk_size) -> int:
+        """Sends the chunk at 'offset', returning the offset the session holds up to."""
+        chunk = self._reader.read(offset, chunk_size)
+        end = offset + len(chunk)
+        r = self._send(session_url, chunk, {'Content-Range': 'bytes {}-{}/{}'.format(offset, end - 1, self.size)})
+        if r.status_code == 308:
+            return self._persisted_from(r)
+        if not r.ok:
+            raise IOError('Resumable upload chunk failed ({}): {}'.format(r.status_code, r.text[:200]))
+        return end
+
+    def _gcs_persisted(self, session_url) -> int:
+        r = self._session.put(session_url, headers={'Content-Range': 'bytes */{}'.format(self.size)},
+                              verify=self._verify)
+        if r.status_code == 308:
+            return self._persisted_from(r)
+        if r.ok:
+            return self.size
+        raise IOError('Could not query the resumable upload ({}): {}'.format(r.status_code, r.text[:200]))
+
+    @staticmethod
+    def _persisted_from(response) -> int:
+        # 'Range: bytes=0-N' is absent until the first byte is persisted
+        received = response.headers.get('Range')
+        return int(received.split('-')[-1]) + 1 if received else 0
@@ -13,10 +13,13 @@ from .util import (
     _create_zegami_session,
     _ensure_token,
     _get_token,
+    _get_signed_blob_url_pool,
+    _get_signed_url_pool,
     _get_token_name,
     _obtain_signed_blob_storage_urls,
     _upload_to_signed_blob_storage_url
 )
+from .throttle import UploadThrottle
 from .workspace import Workspace
 
 DEFAULT_HOME = 'https://zegami.com'
@@ -41,6 +44,14 @@ class ZegamiClient():
     API_0 = 'api/v0'
     API_1 = 'api/v1'
 
+    # Blobs of at least this many bytes are uploaded in chunks of
+    # BLOCK_SIZE, BLOCK_CONCURRENCY at a time, each retried BLOCK_RETRIES
+    # times. Adjust on an instance to tune for a connection.
+    BLOCK_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+    BLOCK_SIZE = 8 * 1024 * 1024
+    BLOCK_CONCURRENCY = 8
+    BLOCK_RETRIES = 3
+
     _auth_get = _auth_get
     _auth_post = _auth_post
     _auth_put = _auth_put
@@ -52,9 +63,15 @@ class ZegamiClient():
     _get_token = _get_token
     _check_status = staticmethod(_check_status)
     _obtain_signed_blob_storage_urls = _obtain_signed_blob_storage_urls
+    _get_signed_url_pool = _get_signed_url_pool
+    _get_signed_blob_url_pool = _get_signed_blob_url_pool
     _upload_to_signed_blob_storage_url = _upload_to_signed_blob_storage_url
     _zegami_session = None
     _blobstore_session = None
+    _signed_url_pools = None
+
+    # Shapes every upload made by this client, see throttle.UploadThrottle
+    upload_throttle = None
 
     def __init__(self, username=None, password=None, token=None, allow_save_token=True, home=DEFAULT_HOME):
         # Make sure we have a token
@@ -64,6 +81,7 @@ class ZegamiClient():
         # Initialise a requests session
         self._create_zegami_session()
         self._create_blobstore_session()
+        self.upload_throttle = UploadThrottle()
 
         # Get user info, workspaces
         self._refresh_client()
@@ -3,16 +3,135 @@
 
 """Collection functionality."""
 
+from collections import deque, OrderedDict
 from concurrent.futures import ThreadPoolExecutor
-from io import BytesIO
+import csv
+from io import BytesIO, StringIO
+from itertools import chain
 import json
 import os
-from time import time
+from pathlib import Path
+import tempfile
+from time import sleep, time
+import numpy as np
 import pandas as pd
 from PIL import Image, UnidentifiedImageError
 
+from .annotation_store import AnnotationStore
+from .annotation_table import AnnotationTable
+from .helper import iter_json_array
+from .manifest import Manifest
 from .source import Source, UploadableSource
 from .nodes import add_node, add_parent
+from .sharding import ShardPlan
+
+# Rows of a DataFrame serialised at a time by replace_data()
+DATA_CHUNK_ROWS = 100000
+# Bytes of serialised data held in memory before spilling to a temp file
+DATA_SPOOL_SIZE = 64 * 1024 * 1024
+# Bytes read looking for the header line of a collection's data file
+DATA_HEADER_LIMIT = 1024 * 1024
+# Leading bytes of data files that aren't plain text (xlsx/zip, xls, gzip, zstd)
+BINARY_DATA_MAGIC = (b'PK\x03\x04', b'\xd0\xcf\x11\xe0', b'\x1f\x8b', b'\x28\xb5\x2f\xfd')
+# Images whose annotations get_annotations_for_images() keeps cached
+IMAGE_ANNOTATIONS_CACHE_SIZE = 4096
+
+
+def _read_data_file(path) -> pd.DataFrame:
+    """Reads a tsv, xls/xlsx or otherwise csv data file."""
+    if not os.path.exists(path):
+        raise FileNotFoundError('Data file "{}" doesn\'t exist'.format(path))
+
+    # Check the file extension
+    if path.split('.')[-1] == 'tsv':
+        return pd.read_csv(path, delimiter='\t')
+    elif path.split('.')[-1] in ['xls', 'xlsx']:
+        return pd.read_excel(path)
+    return pd.read_csv(path)
+
+
+def _row_hashes(df, columns, like=None) -> np.ndarray:
+    """
+    Hashes each row of 'df' over 'columns' (missing ones as empty) to a
+    uint64. Columns whose dtype differs from the same column in 'like' are
+    hashed as floats if both are numeric, else as strings, so eg ints that
+    came back from the server as floats still compare equal.
+    """
+    df = df.reindex(columns=columns)
+    if like is not None:
+        like = like.reindex(columns=columns)
+        mismatched = {}
+        for c in columns:
+            if df[c].dtype != like[c].dtype:
+                numeric = pd.api.types.is_numeric_dtype(df[c]) and pd.api.types.is_numeric_dtype(like[c])
+                mismatched[c] = float if numeric else str
+        if mismatched:
+            df = df.astype(mismatched)
+    return pd.util.hash_pandas_object(df, index=False).values
+
+
+def _common_keys(a, b) -> tuple:
+    """
+    Casts two key columns to a common dtype so equal keys match, eg 1 and
+    1.0 (as floats) or 1 and '1' (as strings, whole floats without '.0').
+    """
+    if a.dtype == b.dtype:
+        return a, b
+    if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+        return a.astype(float), b.astype(float)
+
+    def as_strings(keys):
+        if pd.api.types.is_float_dtype(keys) and (keys.dropna() % 1 == 0).all():
+            keys = keys.astype('Int64')
+        return keys.astype(str)
+
+    return as_strings(a), as_strings(b)
+
+
+def _tsv_columns(head) -> list:
+    """
+    Returns the columns of a data file from its first bytes, or None if it
+    doesn't look like a UTF-8 TSV file (eg an xls/xlsx, compressed or
+    comma-separated file) or its header wasn't complete.
+    """
+    if head.startswith(BINARY_DATA_MAGIC) or b'\n' not in head:
+        return None
+    try:
+        header = head.split(b'\n', 1)[0].decode('utf-8-sig').rstrip('\r')
+    except UnicodeDecodeError:
+        return None
+    if '\t' not in header and (',' in header or ';' in header):
+        return None
+    return next(csv.reader([header], delimiter='\t'), [])
+
+
+def _spool_data(data, head=None):
+    """
+    Serialises a DataFrame as TSV chunk by chunk into a spooled temporary
+    file. Returns the file, rewound.
+
+    If 'head' is given, its byte chunks (an existing TSV file, header
+    included) are written first and the DataFrame's rows follow them
+    without a header.
+    """
+    spool = tempfile.SpooledTemporaryFile(DATA_SPOOL_SIZE)
+
+    last = b'\n'
+    for chunk in head or []:
+        if chunk:
+            spool.write(chunk)
+            last = chunk[-1:]
+    if last != b'\n':
+        spool.write(b'\n')
+
+    for start in range(0, max(len(data), 1), DATA_CHUNK_ROWS):
+        text = StringIO()
+        data.iloc[start:start + DATA_CHUNK_ROWS].to_csv(
+            text, sep='\t', index=False, header=start == 0 and head is None)
+        spool.write(text.getvalue().encode('utf-8'))
+
+    spool.seek(0)
+    return spool
 
 
 class Collection():
@@ -45,8 +164,8 @@ class Collection():
 
     def clear_cache(self):
         self._cached_rows = None
-        self._cached_annotations_data = None
         self._cached_image_meta_source_lookups = {}
+        self._cached_image_annotations = OrderedDict()
 
     @property
     def client():
@@ -687,20 +806,7 @@ class Collection():
         e.g. the thumbnails only, by providing an alternative imageset id.
         """
 
-        # Turn the provided 'rows' into a list of ints.
-        # If 'rows' are not defined, get all rows of collection.
-        if rows is not None:
-            if type(rows) == pd.DataFrame:
-                indices = list(rows.index)
-            elif type(rows) == list:
-                indices = [int(r) for r in rows]
-            elif type(rows) == int:
-                indices = [rows]
-            else:
-                raise ValueError('Invalid rows argument, \'{}\' not supported'
-                                 .format(type(rows)))
-        else:
-            indices = [i for i in range(len(self))]
+        indices = self._parse_row_indices(rows)
 
         # Convert the row-space indices into imageset-space indices
         lookup = self._get_image_meta_lookup(source)
@@ -741,6 +847,61 @@ class Collection():
 
             return signed_route_urls
 
+    def download_rows(self, rows=None, sources='all', max_workers=50,
+                      prefetch_rows=None):
+        """
+        Downloads the sibling images of each row from several sources at
+        once, yielding one tuple of PIL.Images per row.
+
+        Each tuple is aligned with the requested sources (all sources of the
+        collection by default, or a list of source indices/names/instances).
+        Rows which have no image joined in a source have None in that
+        position.
+
+        Rows are yielded in the order given, while the images of the next
+        'prefetch_rows' rows (defaults to max_workers) are downloaded
+        concurrently in the background.
+
+        Example:
+            for regular, xray, heatmap in coll.download_rows(range(100)):
+                ...
+        """
+
+        sources = self._parse_sources(sources)
+        indices = self._parse_row_indices(rows)
+        matrix = self._get_imageset_index_matrix(indices, sources)
+        prefetch_rows = prefetch_rows or max_workers
+
+        c = self.client
+        url_bases = ['{}/{}/project/{}/imagesets/{}/images/'.format(
+            c.HOME, c.API_0, self.workspace_id, s.imageset_id)
+            for s in sources]
+
+        def submit_row(ex, imageset_indices):
+            return [None if i < 0 else
+                    ex.submit(self.download_image, '{}{}/data'.format(base, i))
+                    for base, i in zip(url_bases, imageset_indices)]
+
+        def collect_row(futures):
+            return tuple(None if f is None else f.result() for f in futures)
+
+        ex = ThreadPoolExecutor(max_workers=max_workers)
+        pending = deque()
+        try:
+            for imageset_indices in matrix:
+                pending.append(submit_row(ex, imageset_indices))
+                if len(pending) > prefetch_rows:
+                    yield collect_row(pending.popleft())
+            while pending:
+                yield collect_row(pending.popleft())
+        finally:
+            # Don't download rows nobody will consume if iteration stopped
+            for futures in pending:
+                for f in futures:
+                    if f is not None:
+                        f.cancel()
+            ex.shutdown(wait=True)
+
     def get_feature_extraction_imageset_id(self, source=0) -> str:
         """Returns the feature extraction imageset id in the given source index."""
         source = self._parse_source(source)
@@ -776,6 +937,9 @@ class Collection():
 
         By default, this operation will fail immediately if the collection is
         not fully processed to avoid issues.
+
+        Data is serialised and uploaded in chunks, so memory use doesn't
+        grow with the size of the data.
         """
 
         # If this collection is not fully processed, do not allow data upload
@@ -786,33 +950,146 @@ class Collection():
                 'fail_if_not_ready=False (not recommended)\n\n{}'
                 .format(self.status))
 
-        # Prepare data as bytes
         if type(data) == pd.DataFrame:
-            tsv = data.to_csv(sep='\t', index=False)
-            upload_data = bytes(tsv, 'utf-8')
             name = 'provided_as_dataframe.tsv'
         else:
             name = os.path.split(data)[-1]
-            if name.split('.')[-1] in ['csv', 'json', 'tsv',
-                                       'txt', 'xls', 'xlsx']:
-                with open(data, 'rb') as f:
-                    upload_data = f.read()
-            else:
+            if name.split('.')[-1] not in ['csv', 'json', 'tsv',
+                                           'txt', 'xls', 'xlsx']:
                 raise ValueError(
                     'File extension must one of these: csv, json, tsv, txt, '
                     'xls, xlsx')
 
-        # Create blob storage and upload to it
-        urls, id_set = self.client._obtain_signed_blob_storage_urls(
-            self.workspace_id,
-            blob_path='datasets/{}'.format(self._upload_dataset_id)
-        )
-        blob_id = id_set['ids'][0]
-        url = urls[blob_id]
+        # Files are streamed as they are, dataframes from a spooled temporary file
+        if type(data) == pd.DataFrame:
+            upload_data = _spool_data(data)
+        else:
+            upload_data = open(data, 'rb')
+        with upload_data:
+            self._upload_data_file(upload_data, name)
+
+    def append_rows(self, data, fail_if_not_ready=True):
+        """
+        Appends rows to the data in the collection, without downloading and
+        parsing the existing rows.
+
+        'data' is a pandas dataframe or a local csv/tsv/xlsx/xls file of
+        the new rows. Their columns must be among the collection's columns
+        (missing ones are left empty). The existing data file is streamed
+        back through a spooled temporary file with the new rows added to
+        its end, so memory use stays flat however large the collection's
+        data is. If the existing data isn't stored as TSV (eg it was
+        uploaded as xlsx or csv), it is parsed and replaced along with the
+        new rows instead.
+        """
+
+        if fail_if_not_ready and not self.status_bool:
+            raise ValueError(
+                'Collection has not fully processed. Wait for the collection '
+                'to finish processing, or force this method with '
+                'fail_if_not_ready=False (not recommended)\n\n{}'
+                .format(self.status))
+
+        if type(data) is str:
+            data = _read_data_file(data)
+        if type(data) != pd.DataFrame:
+            raise TypeError('data should be a pandas.DataFrame or a path to a data file, not {}'.format(type(data)))
+
+        url = '{}/{}/project/{}/datasets/{}/file'.format(
+            self.client.HOME, self.client.API_0,
+            self.workspace_id, self._dataset_id)
+        r = self.client._auth_get(url, return_response=True, stream=True)
+        with r:
+            head = iter(r.iter_content(1024 * 1024))
+            first = b''
+            for chunk in head:
+                first += chunk
+                if b'\n' in first or len(first) > DATA_HEADER_LIMIT:
+                    break
+
+            # Only the header of the existing data is parsed, to line the new rows up with it
+            columns = _tsv_columns(first)
+            if columns is None:
+                r.close()
+                # Not a TSV file that rows can be appended to as they are, so parse and replace it
+                self.replace_data(pd.concat([self.rows, data], ignore_index=True),
+                                  fail_if_not_ready=False)
+                return
+
+            unknown = [c for c in data.columns if c not in columns]
+            if unknown:
+                raise ValueError('Columns {} of the new rows are not columns of the collection\'s data: {}'
+                                 .format(unknown, columns))
+
+            spool = _spool_data(data.reindex(columns=columns), head=chain([first], head))
+
+        with spool:
+            self._upload_data_file(spool, 'provided_as_dataframe.tsv')
+
+    def sync_rows(self, data, key, fail_if_not_ready=True) -> dict:
+        """
+        Makes the collection's data match 'data', uploading it only if
+        something changed.
+
+        Rows are matched on the 'key' column, which must be unique, and
+        compared by hashing each row, so a sync that changes nothing costs
+        one pass over the rows instead of an upload and reprocessing.
+        Returns { inserted, updated, deleted, uploaded }. The collection's
+        current rows are compared as cached by 'rows'. See replace_data()
+        for the other arguments.
+        """
+        if type(data) is str:
+            data = _read_data_file(data)
+        if type(data) != pd.DataFrame:
+            raise TypeError('data should be a pandas.DataFrame or a path to a data file, not {}'.format(type(data)))
+
+        current = self.rows
+        if type(current) != pd.DataFrame:
+            raise ValueError('The collection\'s current data could not be read as a dataframe to compare against')
+        for name, df in [('data', data), ('the collection\'s data', current)]:
+            if key not in df.columns:
+                raise ValueError('Key column "{}" is not in {}'.format(key, name))
+            if df[key].duplicated().any():
+                raise ValueError('Key column "{}" has duplicate values in {}'.format(key, name))
+
+        columns = list(data.columns)
+        columns += [c for c in current.columns if c not in columns]
+        # Keys may differ in dtype, eg ints read back as floats after a NaN went through TSV
+        old_keys, new_keys = _common_keys(current[key], data[key])
+        old = pd.Series(_row_hashes(current, columns, like=data), index=old_keys.values)
+        new = pd.Series(_row_hashes(data, columns, like=current), index=new_keys.values)
+
+        shared = new.index.intersection(old.index)
+        result = {
+            'inserted': len(new) - len(shared),
+            'updated': int((new[shared] != old[shared]).sum()),
+            'deleted': len(old) - len(shared),
+        }
+        # Row order matters, as it is what images and tags are attached to
+        same_layout = list(data.columns) == list(current.columns) and new.index.equals(old.index)
+        result['uploaded'] = any(result.values()) or not same_layout
+
+        print('- Sync: {inserted} inserted, {updated} updated, {deleted} deleted{}'.format(
+            '' if result['uploaded'] else ', nothing to upload', **result))
+        if result['uploaded']:
+            self.replace_data(data, fail_if_not_ready=fail_if_not_ready)
+            # The server processes uploaded data, so read it back rather than caching 'data'
+            self._cached_rows = None
+
+        return result
+
+    def _upload_data_file(self, f, name):
+        """Uploads a data file and makes it the collection's data, as 'name'."""
+
+        # Create blob storage and upload to it. The pool keeps a spare url
+        # signed in the background for the next replacement.
+        url_pool = self.client._get_signed_blob_url_pool(
+            self.workspace_id, 'datasets/{}'.format(self._upload_dataset_id),
+            batch_size=2)
+        blob_id, url = url_pool.take()[0]
 
-        # Upload data to it
         self.client._upload_to_signed_blob_storage_url(
-            upload_data, url, 'application/octet-stream')
+            f, url, 'application/octet-stream')
 
         # Update the upload dataset details
         upload_dataset_url = '{}/{}/project/{}/datasets/{}'.format(
@@ -920,21 +1197,59 @@ class Collection():
 
         return [f.result() for f in futures]
 
-    def delete_images_with_tag(self, tag='delete'):
+    def delete_images_with_tag(self, tag='delete', max_workers=16):
         """Delete all the images in the collection with the tag 'delete'.s."""
 
-        row_indices = set()
         if tag in self.tags.keys():
-            row_indices.update(self.tags[tag])
-            lookup = self._get_image_meta_lookup()
-            imageset_indices = [lookup[int(i)] for i in row_indices]
-            c = self.client
-            urls = ['{}/{}/project/{}/imagesets/{}/images/{}'.format(
-                c.HOME, c.API_0, self.workspace_id, self._get_imageset_id(),
-                i) for i in imageset_indices]
-            for url in urls:
-                c._auth_delete(url)
-            print(f'\nDeleted {len(urls)} images')
+            self.delete_images(sorted(set(int(i) for i in self.tags[tag])), max_workers=max_workers)
+
+    def delete_images(self, row_indices, source=0, max_workers=16, retries=2) -> dict:
+        """
+        Deletes the images of the given rows from a source, up to
+        'max_workers' at once, retrying each failed delete up to 'retries'
+        times. Returns { deleted, failed } where 'failed' maps the row
+        indices that could not be deleted to their errors.
+        """
+
+        source = self._parse_source(source)
+        row_indices = [int(i) for i in row_indices]
+        imageset_indices = self._rows_to_images(
+            row_indices, self._lookup_to_array(self._get_image_meta_lookup(source)))
+
+        c = self.client
+        urls = {row: '{}/{}/project/{}/imagesets/{}/images/{}'.format(
+            c.HOME, c.API_0, self.workspace_id, source.imageset_id, i)
+            for row, i in zip(row_indices, imageset_indices)}
+        result = self._delete_concurrently(urls, max_workers, retries)
+        print('\nDeleted {} images{}'.format(
+            result['deleted'], ', {} failed'.format(len(result['failed'])) if result['failed'] else ''))
+        return result
+
+    def _delete_concurrently(self, urls, max_workers, retries, **kwargs) -> dict:
+        """
+        DELETEs a { key: url } dict from a pool of 'max_workers' threads,
+        retrying each up to 'retries' times, backing off as uploads do (see
+        UploadableSource.UPLOAD_RETRY_DELAY). Returns { deleted, failed }
+        where 'failed' is { key: error } of the deletes that never succeeded.
+        """
+
+        c = self.client
+
+        def delete(url):
+            for attempt in range(retries + 1):
+                try:
+                    c._auth_delete(url, **kwargs)
+                    return None
+                except Exception as e:
+                    if attempt == retries:
+                        return e
+                sleep(UploadableSource.UPLOAD_RETRY_DELAY * 2 ** attempt)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            errors = dict(zip(urls.keys(), ex.map(delete, urls.values())))
+
+        failed = {k: e for k, e in errors.items() if e is not None}
+        return {'deleted': len(urls) - len(failed), 'failed': failed}
 
     def _get_tag_indices(self):
         """Returns collection tags indices."""
@@ -965,16 +1280,7 @@ class Collection():
         In V1 collections, the source argument is ignored.
         """
 
-        if self.version < 2:
-            url = '{}/{}/project/{}/annotations/collection/{}'.format(
-                self.client.HOME, self.client.API_1, self.workspace_id,
-                self.id)
-        else:
-            source = self._parse_source(source)
-            url = '{}/{}/project/{}/annotations/collection/{}/source/{}'\
-                .format(self.client.HOME, self.client.API_1, self.workspace_id,
-                        self.id, source.id)
-
+        url = self._annotations_url(source)
         if anno_type is not None:
             url += '?type=' + anno_type
 
@@ -985,6 +1291,92 @@ class Collection():
 
         return annos['annotations']
 
+    def iter_annotations(self, anno_type=None, source=0, author=None, batch_size=1000):
+        """
+        Streams the annotations of a collection, yielding lists of up to
+        'batch_size' annotation dicts (as in get_annotations()).
+
+        The response is parsed incrementally as it arrives rather than
+        decoded in one go, so large (eg mask) annotation sets never need to
+        be held in memory whole. The 'anno_type' and 'author' filters are
+        sent with the request.
+
+        Example:
+            for batch in coll.iter_annotations(anno_type='mask'):
+                ...
+        """
+
+        params = {}
+        if anno_type is not None:
+            params['type'] = anno_type
+        if author is not None:
+            params['author'] = author
+
+        r = self.client._auth_get(self._annotations_url(source), return_response=True, stream=True, params=params)
+        with r:
+            batch = []
+            for anno in iter_json_array(r.iter_content(1024 * 1024), 'annotations'):
+                # Filter here too, in case the server ignores a filter
+                if author is not None and anno.get('author') != author:
+                    continue
+                batch.append(anno)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    def sync_annotation_store(self, source=0, path=None) -> AnnotationStore:
+        """
+        Returns a local AnnotationStore of the annotations of a source,
+        brought up to date with Zegami first. Every annotation is downloaded
+        (streamed, see iter_annotations()), but only those added or changed
+        since the last sync are written to the store.
+
+        The store is kept in ~/.zegami/annotation_stores by default, or at
+        'path'. Query it locally, eg:
+
+            store = coll.sync_annotation_store()
+            store.query(image_index=12, author='my-model')
+        """
+
+        source = None if self.version < 2 else self._parse_source(source)
+        path = path or os.path.join(
+            Path.home(), '.zegami', 'annotation_stores',
+            '{}-{}.sqlite'.format(self.id, 'v1' if source is None else source.id))
+
+        store = AnnotationStore(path)
+        result = store.sync(self.iter_annotations(source=0 if source is None else source))
+        print('Synced annotations to "{}": {} inserted, {} updated, {} deleted'.format(
+            path, result['inserted'], result['updated'], result['deleted']))
+        return store
+
+    def _annotations_url(self, source=0) -> str:
+        """The url of the annotations of a source (or of the first source, in V1 collections)."""
+
+        if self.version < 2:
+            return '{}/{}/project/{}/annotations/collection/{}'.format(
+                self.client.HOME, self.client.API_1, self.workspace_id,
+                self.id)
+
+        source = self._parse_source(source)
+        return '{}/{}/project/{}/annotations/collection/{}/source/{}'\
+            .format(self.client.HOME, self.client.API_1, self.workspace_id,
+                    self.id, source.id)
+
+    def get_annotations_table(self, anno_type=None, source=0) -> AnnotationTable:
+        """
+        Gets the annotations of a collection as a columnar AnnotationTable,
+        which holds large annotation sets far more compactly than the dicts
+        returned by get_annotations(). The annotations are streamed into
+        the table batch by batch (see iter_annotations()).
+        """
+
+        source = None if self.version < 2 else self._parse_source(source)
+        batches = self.iter_annotations(anno_type=anno_type, source=0 if source is None else source)
+        return AnnotationTable.concat(
+            AnnotationTable.from_annotations(batch, collection=self, source=source) for batch in batches)
+
     def get_annotations_for_image(
             self, row_index, source=0, anno_type=None) -> list:
         """
@@ -1011,6 +1403,54 @@ class Collection():
 
         return self.client._auth_get(url)
 
+    def get_annotations_for_images(self, row_indices, source=0, anno_type=None, max_workers=16) -> list:
+        """
+        Returns the annotations of many items in the collection, one result
+        (as from get_annotations_for_image()) per row index given. Defaults
+        to searching for annotations of all types.
+
+        Images are fetched up to 'max_workers' at a time, and the most
+        recently fetched images are cached, so paging back and forth
+        through a collection doesn't fetch the same images again. The
+        cache is cleared when annotations are uploaded or deleted through
+        this collection.
+        """
+
+        source = self._parse_source(source)
+        row_indices = [int(i) for i in row_indices]
+        imageset_indices = self._rows_to_images(
+            row_indices, self._lookup_to_array(self._get_image_meta_lookup(source)))
+
+        c = self.client
+        keys = [(source.imageset_id, i, anno_type) for i in imageset_indices]
+        cache = self._cached_image_annotations
+        missing = list(dict.fromkeys(k for k in keys if k not in cache))
+
+        def fetch(key):
+            imageset_id, imageset_index, _ = key
+            url = '{}/{}/project/{}/annotations/imageset/{}/images/{}'.format(
+                c.HOME, c.API_1, self.workspace_id, imageset_id, imageset_index)
+            if anno_type is not None:
+                url += '?type=' + anno_type
+            return c._auth_get(url)
+
+        fetched = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as ex:
+                fetched = dict(zip(missing, ex.map(fetch, missing)))
+
+        results = [fetched[k] if k in fetched else cache[k] for k in keys]
+
+        if self.allow_caching:
+            for k in keys:
+                if k in fetched:
+                    cache[k] = fetched[k]
+                cache.move_to_end(k)
+            while len(cache) > IMAGE_ANNOTATIONS_CACHE_SIZE:
+                cache.popitem(last=False)
+
+        return results
+
     def upload_annotation(self, uploadable, row_index=None, image_index=None,
                           source=None, author=None, debug=False):
         """
@@ -1040,6 +1480,63 @@ class Collection():
             assert row_index is None,\
                 'Must provide only one or row_index, image_index'
 
+        payload = self._annotation_payload(uploadable, imageset_id, image_index, author)
+
+        # Potentially print for debugging purposes
+        if debug:
+            print('\nupload_annotation payload:\n')
+            for k, v in payload.items():
+                if k == 'annotation':
+                    print('- annotation:')
+                    for k2, v2 in payload['annotation'].items():
+                        print('\t- {} : {}'.format(k2, v2))
+                else:
+                    print('- {} : {}'.format(k, v))
+            print('\nJSON:\n{}'.format(json.dumps(payload)))
+
+        # POST
+        c = self.client
+        url = '{}/{}/project/{}/annotations'.format(
+            c.HOME, c.API_1, self.workspace_id)
+        r = c._auth_post(url, json.dumps(payload), return_response=True)
+        self._cached_image_annotations.clear()
+
+        return r
+
+    @staticmethod
+    def _lookup_rows(row_indices, lookup) -> list:
+        """
+        Resolves row indices into imageset indices through a lookup array
+        (see _lookup_to_array()) in one step, with -1 for any row that is
+        invalid or has no image.
+        """
+
+        rows = pd.to_numeric(pd.Series(list(row_indices), dtype=object), errors='coerce')
+        valid = rows.notna() & (rows >= 0) & (rows < len(lookup)) & (rows % 1 == 0)
+        image_indices = np.full(len(rows), -1, dtype=np.int64)
+        image_indices[valid.to_numpy()] = lookup[rows[valid].to_numpy(dtype=np.int64)]
+        return image_indices.tolist()
+
+    @staticmethod
+    def _rows_to_images(row_indices, lookup) -> list:
+        """
+        Resolves row indices into imageset indices through a lookup array
+        (see _lookup_to_array()) in one step, raising if any row has no image.
+        """
+
+        rows = np.asarray(row_indices, dtype=np.int64)
+        bad = (rows < 0) | (rows >= len(lookup))
+        if bad.any():
+            raise IndexError('Invalid row index {} for this source.'.format(rows[bad][0]))
+        image_indices = lookup[rows]
+        if (image_indices < 0).any():
+            raise ValueError('Row {} has no image in this source'.format(rows[image_indices < 0][0]))
+        return image_indices.tolist()
+
+    @staticmethod
+    def _annotation_payload(uploadable, imageset_id, image_index, author) -> dict:
+        """Checks uploadable annotation data and builds the payload to POST for it."""
+
         assert type(uploadable) == dict,\
             'Expected uploadable data to be a dict, not a {}'\
             .format(type(uploadable))
@@ -1061,34 +1558,88 @@ class Collection():
             'image_index': int(image_index),
             'annotation': uploadable['annotation'],
             'type': uploadable['type'],
-            'format': uploadable['format'],
-            'class_id': str(int(uploadable['class_id'])),
+            'format': uploadable.get('format'),
+            'class_id': None if uploadable.get('class_id') is None else str(int(uploadable['class_id'])),
         }
 
         # Check that there are no missing fields in the payload
         for k, v in payload.items():
-            assert v is not None, 'Empty annotation uploadable data value '
-            'for \'{}\''.format(k)
+            assert v is not None, 'Empty annotation uploadable data value '\
+                'for \'{}\''.format(k)
 
-        # Potentially print for debugging purposes
-        if debug:
-            print('\nupload_annotation payload:\n')
-            for k, v in payload.items():
-                if k == 'annotation':
-                    print('- annotation:')
-                    for k2, v2 in payload['annotation'].items():
-                        print('\t- {} : {}'.format(k2, v2))
-                else:
-                    print('- {} : {}'.format(k, v))
-            print('\nJSON:\n{}'.format(json.dumps(payload)))
+        return payload
+
+    def upload_annotations(self, annotations, source=0, author=None, max_workers=16, batch_size=500) -> list:
+        """
+        Uploads many annotations to Zegami concurrently.
+
+        'annotations' is an iterable of (row_index, uploadable) pairs, where
+        each uploadable is as given to upload_annotation(). It may be a
+        generator, eg streaming predictions out of a model: it is consumed
+        'batch_size' annotations at a time, and no more than 'max_workers'
+        batches are read ahead of the uploads, so memory use stays bounded.
+
+        Returns one dict per annotation, in the order given, of
+        { row_index, image_index, ok, response } where 'response' is the
+        created annotation, or the error if it failed. Items that fail,
+        including rows with no image and malformed uploadables, don't stop
+        the rest of the upload.
+        """
+
+        source = None if self.version == 1 else self._parse_source(source)
+        imageset_id = self._get_imageset_id(source)
+        lookup = self._lookup_to_array(self._get_image_meta_lookup(source))
+        author = author or self.client.email
 
-        # POST
         c = self.client
         url = '{}/{}/project/{}/annotations'.format(
             c.HOME, c.API_1, self.workspace_id)
-        r = c._auth_post(url, json.dumps(payload), return_response=True)
 
-        return r
+        def post(payload):
+            try:
+                return True, c._auth_post(url, body=None, json=payload)
+            except Exception as e:
+                return False, e
+
+        def collect(prepared, futures):
+            return [{'row_index': row, 'image_index': i, 'ok': f is not None and f.result()[0],
+                     'response': error if f is None else f.result()[1]}
+                    for (row, i, _, error), f in zip(prepared, futures)]
+
+        results = []
+        pending = deque()
+        annotations = iter(annotations)
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            while True:
+                batch = [a for _, a in zip(range(batch_size), annotations)]
+                if not batch:
+                    break
+                rows = [row_index for row_index, _ in batch]
+                prepared = [self._prepare_annotation(row, i, uploadable, imageset_id, author)
+                            for row, i, (_, uploadable) in zip(rows, self._lookup_rows(rows, lookup), batch)]
+                pending.append((prepared, [None if payload is None else ex.submit(post, payload)
+                                           for _, _, payload, _ in prepared]))
+                # Backpressure: don't read further ahead of the uploads than this
+                while len(pending) > max_workers:
+                    results += collect(*pending.popleft())
+            while pending:
+                results += collect(*pending.popleft())
+
+        self._cached_image_annotations.clear()
+        failed = sum(not r['ok'] for r in results)
+        print('Uploaded {} annotations{}'.format(
+            len(results) - failed, ', {} failed'.format(failed) if failed else ''))
+        return results
+
+    def _prepare_annotation(self, row, image_index, uploadable, imageset_id, author) -> tuple:
+        """Returns (row, image index, payload or None, error or None) for one item of upload_annotations()."""
+
+        if image_index < 0:
+            return row, None, None, IndexError('Row {} has no image in this source to annotate'.format(row))
+        try:
+            return row, image_index, self._annotation_payload(uploadable, imageset_id, image_index, author), None
+        except (AssertionError, KeyError, TypeError, ValueError) as e:
+            return row, image_index, None, e
 
     def delete_annotation(self, annotation_id):
         """
@@ -1103,6 +1654,7 @@ class Collection():
             'author': c.email
         }
         r = c._auth_delete(url, data=json.dumps(payload))
+        self._cached_image_annotations.clear()
 
         return r
 
@@ -1114,29 +1666,52 @@ class Collection():
         source.
         """
 
-        # Get the sources to delete annotations from
-        scoped_sources = self.sources if only_for_source is None\
-            else [self._parse_source(only_for_source)]
+        self.delete_annotations(only_for_source=only_for_source)
 
-        c = 0
-        for source in scoped_sources:
+    def delete_annotations(self, annotations=None, author=None, anno_type=None, only_for_source=None,
+                           max_workers=16, retries=2) -> dict:
+        """
+        Deletes many annotations at once, up to 'max_workers' at a time,
+        retrying each failed delete up to 'retries' times.
 
-            annos = self.get_annotations(source=source)
-            if len(annos) == 0:
-                continue
+        'annotations' is a list of annotation ids, or of annotations as
+        returned by get_annotations(). If it is not given, every annotation
+        of the collection (or of 'only_for_source') is fetched and deleted.
+        Annotations may be narrowed to those of one 'author' (eg a model)
+        and/or 'anno_type' before deleting, which needs annotations rather
+        than bare ids.
 
-            print('Deleting {} annotations from source {}'
-                  .format(len(annos), source.name))
+        Returns { deleted, failed } where 'failed' maps the ids that could
+        not be deleted to their errors.
+        """
 
-            for j, anno in enumerate(annos):
-                self.delete_annotation(anno['id'])
-                print('\r{}/{}'.format(j + 1, len(annos)), end='',
-                      flush=True)
-                c += 1
-            print('')
+        if annotations is None:
+            scoped_sources = self.sources if only_for_source is None\
+                else [self._parse_source(only_for_source)]
+            annotations = [a for source in scoped_sources
+                           for a in self.get_annotations(anno_type=anno_type, source=source)]
+        else:
+            annotations = list(annotations)
+
+        if author is not None or anno_type is not None:
+            if not all(isinstance(a, dict) for a in annotations):
+                raise ValueError('Filtering by author or anno_type needs annotations, not bare ids')
+            annotations = [a for a in annotations
+                           if (author is None or a.get('author') == author) and
+                           (anno_type is None or a.get('type') == anno_type)]
 
-        print('\nDeleted {} annotations from collection "{}"'.format(
-            c, self.name))
+        ids = [a['id'] if isinstance(a, dict) else a for a in annotations]
+        print('Deleting {} annotations'.format(len(ids)))
+
+        c = self.client
+        urls = {i: '{}/{}/project/{}/annotations/{}'.format(c.HOME, c.API_1, self.workspace_id, i) for i in ids}
+        result = self._delete_concurrently(urls, max_workers, retries, data=json.dumps({'author': c.email}))
+        self._cached_image_annotations.clear()
+
+        print('\nDeleted {} annotations from collection "{}"{}'.format(
+            result['deleted'], self.name,
+            ', {} failed'.format(len(result['failed'])) if result['failed'] else ''))
+        return result
 
     @property
     def userdata():
@@ -1215,17 +1790,7 @@ class Collection():
 
         # Parse data
         if type(data) is str:
-            if not os.path.exists(data):
-                raise FileNotFoundError('Data file "{}" doesn\'t exist'
-                                        .format(data))
-
-            # Check the file extension
-            if data.split('.')[-1] == 'tsv':
-                data = pd.read_csv(data, delimiter='\t')
-            elif data.split('.')[-1] in ['xls', 'xlsx']:
-                data = pd.read_excel(data)
-            else:
-                data = pd.read_csv(data)
+            data = _read_data_file(data)
 
         # Check that all source filenames exist in the provided data
         if data is not None:
@@ -1234,16 +1799,66 @@ class Collection():
                 s._check_in_data(data)
 
             # append rows to data
-            new_rows = self.rows.append(data)
-            self.replace_data(new_rows)
+            self.append_rows(data)
 
         # validate and register uploadable sources against existing sources
         for i, us in enumerate(uploadable_sources):
             us._register_source(i, self.sources[i])
 
         # upload
-        for us in uploadable_sources:
-            us._upload()
+        UploadableSource._upload_all(uploadable_sources)
+
+    def plan_sharded_upload(self, uploadable_source, plan_dir, n_shards, source=0) -> ShardPlan:
+        """
+        Prepares the upload of an UploadableSource's images into one of this
+        collection's sources to be split between several processes or hosts.
+
+        This reserves the whole index range once and writes a shard plan
+        (with the source's manifest) into 'plan_dir', which should be a
+        directory every worker can reach. Each worker then calls
+        upload_shard(plan_dir, shard) for a different shard number from 0
+        to n_shards - 1. Progress of all shards is available with
+        ShardPlan.load(plan_dir).status().
+        """
+
+        uploadable_source = UploadableSource._parse_list(uploadable_source)[0]
+        source = self._parse_source(source)
+        uploadable_source._register_source(self.sources.index(source), source)
+        if uploadable_source.deduplicate:
+            uploadable_source._deduplicate()
+
+        start = uploadable_source._reserve_indices()
+        plan = ShardPlan.create(uploadable_source, plan_dir, n_shards, start)
+
+        print('- Planned {} shards of source "{}" in "{}"'.format(len(plan.shards), source.name, plan_dir))
+        return plan
+
+    def upload_shard(self, plan_dir, shard, image_dir=None) -> dict:
+        """
+        Uploads one shard of a plan made with plan_sharded_upload(). Run
+        this for every shard, from any process or host with access to
+        'plan_dir' and the images. If the images are mounted elsewhere on
+        this host, provide that location as 'image_dir'.
+
+        Re-running a shard resumes it. Returns the shard's upload report.
+        """
+
+        plan = ShardPlan.load(plan_dir)
+        if plan._retrieve('collection_id') != self.id:
+            raise ValueError('Shard plan "{}" is for collection "{}", not "{}"'
+                             .format(plan_dir, plan._retrieve('collection_id'), self.id))
+
+        manifest = Manifest.load(plan.manifest_path)
+        us = UploadableSource(
+            plan._retrieve('source_name'), image_dir or manifest.root,
+            column_filename=plan._retrieve('column_filename'), manifest=manifest,
+            journal_path=plan.journal_path(shard), deduplicate=plan.deduplicate,
+            hash_index_path=plan.hash_index_path)
+
+        source_index = plan._retrieve('source_index')
+        us._register_source(source_index, self.sources[source_index])
+
+        return us._upload_shard(plan, shard)
 
     @classes.setter
     def classes(self, classes):  # noqa: C901
@@ -1333,6 +1948,84 @@ class Collection():
             # This is a bit of a hack, but works
             return {k: k for k in range(100000)}
 
+    def _parse_row_indices(self, rows) -> list:
+        """
+        Turns the provided 'rows' (a DataFrame of rows, a list/range of row
+        indices or a single int) into a list of ints. If 'rows' is None, all
+        rows of the collection are used.
+        """
+
+        if rows is None:
+            return [i for i in range(len(self))]
+        if type(rows) == pd.DataFrame:
+            return list(rows.index)
+        if type(rows) in [list, tuple, range, np.ndarray]:
+            return [int(r) for r in rows]
+        if type(rows) == int:
+            return [rows]
+        raise ValueError('Invalid rows argument, \'{}\' not supported'
+                         .format(type(rows)))
+
+    def _parse_sources(self, sources) -> list:
+        """
+        Accepts 'all', a single source (see _parse_source()) or a list of
+        them, and always returns a list of checked Source instances.
+        """
+
+        if type(sources) == str and sources == 'all':
+            return list(self.sources)
+        if type(sources) in [list, tuple]:
+            return [self._parse_source(s) for s in sources]
+        return [self._parse_source(sources)]
+
+    def _get_image_meta_lookups(self, sources) -> list:
+        """
+        Returns the image-meta lookups of several sources, obtaining any
+        that are not cached concurrently rather than one after another.
+        """
+
+        if len(sources) < 2:
+            return [self._get_image_meta_lookup(s) for s in sources]
+
+        with ThreadPoolExecutor(max_workers=len(sources)) as ex:
+            return list(ex.map(self._get_image_meta_lookup, sources))
+
+    @staticmethod
+    def _lookup_to_array(lookup) -> np.ndarray:
+        """
+        Converts an image-meta lookup into an int64 array of imageset indices
+        by row index, with -1 marking rows that have no joined image.
+        """
+
+        if isinstance(lookup, dict):
+            keys = np.fromiter(lookup.keys(), dtype=np.int64, count=len(lookup))
+            values = pd.Series(list(lookup.values()), dtype='float64')
+            arr = np.full(keys.max() + 1 if len(keys) else 0, -1, dtype=np.int64)
+            arr[keys] = values.fillna(-1).to_numpy(dtype=np.int64)
+            return arr
+
+        return pd.Series(lookup, dtype='float64').fillna(-1)\
+            .to_numpy(dtype=np.int64)
+
+    def _get_imageset_index_matrix(self, row_indices, sources) -> np.ndarray:
+        """
+        Resolves row indices into an (n_rows x n_sources) int64 matrix of
+        imageset indices, one column per source, with -1 marking cells that
+        have no joined image.
+        """
+
+        rows = np.asarray(row_indices, dtype=np.int64)
+        if len(rows) and rows.min() < 0:
+            raise ValueError('Use row indices of 0 or above, not {}'.format(rows.min()))
+
+        matrix = np.full((len(rows), len(sources)), -1, dtype=np.int64)
+        for j, lookup in enumerate(self._get_image_meta_lookups(sources)):
+            arr = self._lookup_to_array(lookup)
+            in_range = rows < len(arr)
+            matrix[in_range, j] = arr[rows[in_range]]
+
+        return matrix
+
     def _get_image_meta_lookup(self, source=0) -> list:
         """
         Returns the image-meta lookup for converting between image and row
@@ -1363,10 +2056,13 @@ class Collection():
             'was required.')
 
     def get_annotations_as_dataframe(
-            self, anno_type=None, source=0) -> pd.DataFrame:
+            self, anno_type=None, source=0, typed=False) -> pd.DataFrame:
         """
         Collects all annotations of a type (or all if anno_type=None) and
         returns the information as a dataframe.
+
+        Set 'typed' to return the Author, Type and Class columns as pandas
+        categoricals, which are much smaller for large annotation sets.
         """
 
         source = self._parse_source(source)
@@ -1374,28 +2070,67 @@ class Collection():
         annos = self.get_annotations(
             anno_type=anno_type, source=source)
 
-        classes = self.classes
+        return self._annotations_to_dataframe(annos, source, typed=typed)
+
+    def _annotations_to_dataframe(self, annos, source, typed=False) -> pd.DataFrame:
+        """Normalises a list of annotation dicts into a dataframe, column by column."""
 
-        def to_dict(a):
-            d = {}
-            if classes and 'class_id' in a.keys():
-                c = next(filter(lambda c: int(c['id']) == int(a['class_id']), classes))
-                d['Class'] = c['name']
-                d['Class ID'] = int(c['id'])
-            d['Type'] = a['type']
-            d['Author'] = a['author']
-            d['Row Index'] = self.imageset_index_to_row_index(a['image_index'])
-            d['Imageset Index'] = a['image_index']
-            d['ID'] = a['id']
-            if 'metadata' in a.keys():
-                for k, v in a['metadata'].items():
-                    d[k] = v
-            return d
-
-        df = pd.DataFrame([to_dict(a) for a in annos])
+        records = pd.DataFrame.from_records(annos)
+        if len(records) == 0:
+            return pd.DataFrame()
+
+        df = pd.DataFrame(index=records.index)
+        classes = self.classes
+        if classes and 'class_id' in records.columns:
+            names = {int(c['id']): c['name'] for c in classes}
+            class_ids = pd.to_numeric(records['class_id'], errors='coerce')
+            df['Class'] = class_ids.map(names)
+            df['Class ID'] = class_ids.where(class_ids.isin(list(names))).astype('Int64')
+        df['Type'] = records['type']
+        df['Author'] = records['author']
+
+        # Map imageset indices back to rows through the inverted lookup,
+        # annotations without one having -1 as with rows not in the lookup
+        imageset_indices = records['image_index'].fillna(-1).to_numpy(dtype=np.int64)
+        inverse = self._invert_lookup_array(self._lookup_to_array(self._get_image_meta_lookup(source)))
+        in_range = (imageset_indices >= 0) & (imageset_indices < len(inverse))
+        row_indices = np.full(len(records), -1, dtype=np.int64)
+        row_indices[in_range] = inverse[imageset_indices[in_range]]
+        df['Row Index'] = row_indices
+
+        df['Imageset Index'] = imageset_indices
+        df['ID'] = records['id']
+
+        if 'metadata' in records.columns:
+            raw = [m if isinstance(m, dict) else {} for m in records['metadata']]
+            metadata = pd.DataFrame.from_records(raw, index=records.index)
+            # A metadata value replaces the column of the same name, for the annotations that have it
+            for col in metadata.columns.intersection(df.columns):
+                present = np.array([col in m for m in raw])
+                df[col] = df[col].astype(object).mask(present, metadata[col])
+            df = df.join(metadata[[c for c in metadata.columns if c not in df.columns]])
+
+        if typed:
+            for col in ['Class', 'Type', 'Author']:
+                if col in df.columns:
+                    df[col] = df[col].astype('category')
 
         return df
 
+    @staticmethod
+    def _invert_lookup_array(arr) -> np.ndarray:
+        """
+        Inverts a row -> imageset index array (see _lookup_to_array()) into
+        an imageset -> row index array, with -1 marking images no row uses.
+        Where several rows share an image, the first row is used.
+        """
+
+        rows = np.flatnonzero(arr >= 0)
+        images, first = np.unique(arr[rows], return_index=True)
+        inverse = np.full(images[-1] + 1 if len(images) else 0, -1, dtype=np.int64)
+        inverse[images] = rows[first]
+        return inverse
+
     def _parse_source(self, source) -> Source:  # noqa: C901
         """
         Accepts an int or a Source instance or source name and always returns a checked
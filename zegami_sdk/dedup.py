@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""content deduplication functionality."""
+
+import json
+import os
+
+import numpy as np
+
+
+class HashIndex():
+    """
+    A local record of the content hashes of the images uploaded into one
+    imageset, so later uploads can skip images it already holds.
+
+    Stored as a JSON-lines file of { hash, name, index } entries, where
+    'index' is the image's imageset index.
+    """
+
+    def __repr__(self):
+        return '<HashIndex "{}" ({} images)>'.format(self.path, len(self))
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._entries.setdefault(entry['hash'], entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, digest):
+        return digest in self._entries
+
+    def get(self, digest) -> dict:
+        """The { hash, name, index } entry of the first image uploaded with this content, or None."""
+        return self._entries.get(digest)
+
+    def add(self, entries):
+        """Records (hash, name, imageset index) entries, keeping the first seen per hash."""
+        new = []
+        for digest, name, index in entries:
+            if digest not in self._entries:
+                entry = {'hash': digest, 'name': name, 'index': int(index)}
+                self._entries[digest] = entry
+                new.append(entry)
+        if not new:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(e) + '\n' for e in new))
+
+
+def find_duplicates(manifest, hash_index=None):
+    """
+    Finds the entries of a hashed manifest whose content is already in
+    'hash_index', or repeats an earlier entry of the same manifest.
+
+    Returns (keep, duplicates): the manifest indices to upload, and one
+    { name, duplicate_of, imageset_index } dict per skipped entry, where
+    'duplicate_of' is the name of the image holding the same content and
+    'imageset_index' its index if already uploaded (else None).
+    """
+    if manifest.hashes is None:
+        raise ValueError('Manifest has no hashes, run manifest.compute_hashes() first')
+
+    n = len(manifest)
+    if n == 0:
+        return np.arange(0), []
+
+    # The first entry with each content, for every entry
+    contents = np.ascontiguousarray(manifest.hashes).view('V{}'.format(manifest.hashes.shape[1])).ravel()
+    _, first, inverse = np.unique(contents, return_index=True, return_inverse=True)
+    first_of = first[inverse.ravel()]
+
+    keep = []
+    duplicates = []
+    for i in range(n):
+        known = hash_index.get(manifest.hash(i)) if hash_index is not None else None
+        if known is not None:
+            duplicates.append({'name': manifest.name(i), 'duplicate_of': known['name'],
+                               'imageset_index': known['index']})
+        elif first_of[i] != i:
+            duplicates.append({'name': manifest.name(i), 'duplicate_of': manifest.name(first_of[i]),
+                               'imageset_index': None})
+        else:
+            keep.append(i)
+
+    return np.asarray(keep, dtype=np.int64), duplicates
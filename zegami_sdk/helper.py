@@ -3,8 +3,20 @@
 
 """helper code."""
 
+import codecs
+import csv
+import json
+import os
+import re
 import sys
 
+import pandas as pd
+
+# Delimited data file extensions, and the delimiter assumed if sniffing fails
+DELIMITED_EXTENSIONS = {'csv': ',', 'tsv': '\t', 'txt': '\t'}
+# Delimited data files the server reads as they are, by extension
+SERVER_DELIMITERS = {'csv': ',', 'tsv': '\t'}
+
 
 def guess_data_mimetype(data):
 
@@ -28,3 +40,108 @@ def guess_data_mimetype(data):
         except TypeError:
             pass
     return fallback_mimetype
+
+
+def read_data_columns(path) -> list:
+    """
+    Returns the column names of a csv/tsv/txt/xls/xlsx data file, reading
+    only its header. The delimiter of a delimited file is sniffed from
+    its first line.
+    """
+    ext = os.path.splitext(path)[-1].lower().lstrip('.')
+    if ext in ['xls', 'xlsx']:
+        return list(pd.read_excel(path, nrows=0).columns)
+    if ext not in DELIMITED_EXTENSIONS:
+        raise ValueError('Can\'t read the columns of "{}", expected one of {} or xls, xlsx'
+                         .format(path, list(DELIMITED_EXTENSIONS)))
+
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        header = f.readline()
+    return next(csv.reader([header], delimiter=_sniff_delimiter(header, ext)), [])
+
+
+def sniff_data_delimiter(path) -> str:
+    """Returns the delimiter of a csv/tsv/txt data file, sniffed from its first line."""
+    ext = os.path.splitext(path)[-1].lower().lstrip('.')
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        return _sniff_delimiter(f.readline(), ext)
+
+
+def _sniff_delimiter(header, ext) -> str:
+    try:
+        return csv.Sniffer().sniff(header, delimiters=',\t;|').delimiter
+    except csv.Error:
+        return DELIMITED_EXTENSIONS[ext]
+
+
+def iter_json_array(chunks, key):
+    """
+    Incrementally parses the array under the first "key" of a JSON document
+    arriving as byte chunks (eg a streamed response's iter_content()),
+    yielding its items one at a time. Only the item being parsed, and no
+    more than as much again read ahead of it, is held in memory.
+    """
+    return iter(_JsonArrayStream(chunks, key))
+
+
+class _JsonArrayStream():
+    """Yields the items of one array of a JSON document read from byte chunks, see iter_json_array()."""
+
+    # Characters kept between chunks while looking for the array
+    SEEK_TAIL = 256
+
+    def __init__(self, chunks, key):
+        self._chunks = iter(chunks)
+        self._key = key
+        self._start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._parser = json.JSONDecoder()
+        self._buf = ''
+        self._exhausted = False
+
+    def _more(self) -> bool:
+        """Reads text onto the buffer, returning False at the end of the document."""
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self._buf += text
+                return True
+        self._exhausted = True
+        return False
+
+    def _seek(self):
+        while True:
+            m = self._start.search(self._buf)
+            if m:
+                self._buf = self._buf[m.end():]
+                return
+            self._buf = self._buf[-self.SEEK_TAIL:]
+            if not self._more():
+                raise ValueError('No "{}" array in the JSON document'.format(self._key))
+
+    def __iter__(self):
+        self._seek()
+        pos = 0
+        while True:
+            while pos < len(self._buf) and self._buf[pos] in ' \t\r\n,':
+                pos += 1
+            if self._buf[pos:pos + 1] == ']':
+                return
+            try:
+                item, end = self._parser.raw_decode(self._buf, pos)
+            except ValueError:
+                end = None
+            # An item ending with the data read so far might continue (eg a number)
+            if end is not None and (end < len(self._buf) or self._exhausted):
+                yield item
+                pos = end
+                continue
+            if self._exhausted:
+                raise ValueError('Truncated "{}" array in the JSON document'.format(self._key))
+            # Read at least as much again before reparsing, so an item spanning
+            # many chunks is parsed a few times rather than once per chunk
+            self._buf = self._buf[pos:]
+            pos = 0
+            target = 2 * len(self._buf)
+            while self._more() and len(self._buf) < target:
+                pass
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""upload journal functionality."""
+
+import json
+import os
+import threading
+from time import time
+
+import numpy as np
+
+
+class UploadJournal():
+    """
+    A local, append-only record of an upload's progress, used to resume an
+    interrupted upload without re-reserving indices or re-sending images.
+
+    The journal is a JSON-lines file holding:
+        - the reservation: the imageset, the index range obtained from
+          /extend and the fingerprint of the manifest being uploaded
+        - one 'commit' record per images_bulk group committed
+        - one 'failed' record per item that could not be uploaded
+
+    Item indices are positions in the uploaded manifest. Imageset indices
+    are the reservation's 'start' plus the item index.
+    """
+
+    def __repr__(self):
+        return '<UploadJournal "{}" ({} committed, {} failed)>'.format(
+            self.path, self.committed_count, len(self.failed))
+
+    def __init__(self, path):
+        self.path = path
+        self.reservation = None
+        self.failed = {}
+        self._commits = []
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from an interrupted write, ignore it
+                    continue
+                self._apply(record)
+
+    def _apply(self, record):
+        event = record['event']
+        if event == 'reserve':
+            self.reservation = record
+            self.failed = {}
+            self._commits = []
+        elif event == 'commit':
+            self._commits.append((record['start'], record['count']))
+            for i in range(record['start'], record['start'] + record['count']):
+                self.failed.pop(i - self.reservation['start'], None)
+        elif event == 'failed':
+            self.failed[record['index']] = record['error']
+
+    def _write(self, record, truncate=False):
+        record['time'] = time()
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'w' if truncate else 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(record)
+
+    def matches(self, imageset_id, delta, fingerprint) -> bool:
+        """Whether this journal records a reservation for exactly this upload."""
+        r = self.reservation
+        return r is not None and r['imageset_id'] == imageset_id and r['delta'] == delta\
+            and r['fingerprint'] == fingerprint
+
+    def reserve(self, imageset_id, start, delta, fingerprint):
+        """Starts the journal afresh with a new index reservation."""
+        self._write({
+            'event': 'reserve',
+            'imageset_id': imageset_id,
+            'start': int(start),
+            'delta': int(delta),
+            'fingerprint': fingerprint,
+        }, truncate=True)
+
+    def record_commit(self, start, count):
+        """Records that imageset indices [start, start + count) are committed."""
+        self._write({'event': 'commit', 'start': int(start), 'count': int(count)})
+
+    def record_failure(self, index, error):
+        """Records that the item at manifest 'index' failed to upload."""
+        self._write({'event': 'failed', 'index': int(index), 'error': str(error)})
+
+    @property
+    def start():
+        pass
+
+    @start.getter
+    def start(self) -> int:
+        if self.reservation is None:
+            raise ValueError('UploadJournal "{}" has no reservation'.format(self.path))
+        return self.reservation['start']
+
+    def committed_mask(self) -> np.ndarray:
+        """A bool array over the reserved items, True where an item is committed."""
+        mask = np.zeros(self.reservation['delta'], dtype=bool)
+        for start, count in self._commits:
+            mask[start - self.start:start - self.start + count] = True
+        return mask
+
+    @property
+    def committed_count():
+        pass
+
+    @committed_count.getter
+    def committed_count(self) -> int:
+        return 0 if self.reservation is None else int(self.committed_mask().sum())
+
+    def missing(self) -> np.ndarray:
+        """Item indices that have not been committed yet."""
+        return np.flatnonzero(~self.committed_mask())
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""upload manifest functionality."""
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+import hashlib
+import os
+
+import numpy as np
+
+HASH_ALGORITHM = 'sha256'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(path) -> bytes:
+    """Returns the digest of a file's content. Module level to be picklable."""
+    h = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+def _scan_dir(path, rel_dir, accept):
+    """Lists one directory, returning ([(rel_path, size)], [(path, rel_path)]) of accepted files and subdirectories."""
+    files = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            # Hidden entries were never matched by glob, keep ignoring them
+            if entry.name.startswith('.'):
+                continue
+            rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+            if entry.is_dir():
+                subdirs.append((entry.path, rel_path))
+            elif entry.is_file() and accept(entry.name):
+                files.append((rel_path, entry.stat().st_size))
+    return files, subdirs
+
+
+def _stat_file(root, rel_path):
+    """Returns (rel_path, size), or None if the file does not exist."""
+    try:
+        st = os.stat(os.path.join(root, rel_path))
+    except FileNotFoundError:
+        return None
+    return rel_path, st.st_size
+
+
+def _digests_to_array(digests) -> np.ndarray:
+    """Packs a list of digests into an (n, digest_size) uint8 array."""
+    size = hashlib.new(HASH_ALGORITHM).digest_size
+    return np.frombuffer(b''.join(digests), dtype=np.uint8).reshape(-1, size)
+
+
+class Manifest():
+    """
+    A compact listing of the files an UploadableSource uploads.
+
+    Each file's relative path, size, mime type and optional content hash are
+    held in flat numpy arrays rather than per-file Python objects, so
+    millions of entries stay cheap to hold, slice and save. The manifest is
+    built once with a single parallel directory walk and reused by the
+    upload stage, which needs no further filesystem calls to describe the
+    files.
+
+    Save a manifest with .save() and reload it with Manifest.load() to skip
+    rescanning a large directory tree. Paths are stored relative to the
+    root, so a loaded manifest can be rebased onto a different mount point
+    with .rebase().
+    """
+
+    def __repr__(self):
+        return '<Manifest of {} files ({} bytes) in "{}">'.format(
+            len(self), self.total_size, self.root)
+
+    def __init__(self, root, rel_paths, sizes, mimes, hashes=None):
+        """
+        Builds a manifest from per-file lists. Typically obtained with
+        Manifest.scan() or Manifest.load() instead.
+        """
+
+        if not len(rel_paths) == len(sizes) == len(mimes):
+            raise ValueError('Manifest needs one size and mime per path ({}, {}, {})'
+                             .format(len(rel_paths), len(sizes), len(mimes)))
+
+        self.root = root
+
+        encoded = [p.encode('utf-8') for p in rel_paths]
+        self._path_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=self._path_offsets[1:])
+        self._path_buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        self._sizes = np.asarray(sizes, dtype=np.int64)
+
+        self._mime_table, codes = np.unique(np.asarray(mimes, dtype=str), return_inverse=True)
+        self._mime_codes = codes.astype(np.int16)
+
+        self._hashes = None if hashes is None else _digests_to_array(hashes)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    @classmethod
+    def _from_arrays(cls, root, path_buffer, path_offsets, sizes, mime_table, mime_codes, hashes):
+        m = cls.__new__(cls)
+        m.root = root
+        m._path_buffer = path_buffer
+        m._path_offsets = path_offsets
+        m._sizes = sizes
+        m._mime_table = mime_table
+        m._mime_codes = mime_codes
+        m._hashes = hashes
+        return m
+
+    @classmethod
+    def scan(cls, root, mimes, recursive=True, blacklist=(), max_workers=16, on_found=None):
+        """
+        Walks 'root' once, listing every file whose (case-insensitive)
+        extension is in 'mimes' and whose name doesn't end with a 'blacklist'
+        entry. Directories are listed concurrently, which matters most on
+        network filesystems where each listing is latency bound.
+
+        'on_found', if given, is called with the [(rel_path, mime)] found in
+        each directory as soon as it is listed, so work on the files can
+        start before the scan finishes.
+        """
+
+        mimes = {k.lower(): v for k, v in mimes.items()}
+        blacklist = tuple(b.lower() for b in blacklist)
+
+        def accept(name):
+            lower = name.lower()
+            if lower.endswith(blacklist):
+                return False
+            ext = os.path.splitext(lower)[1]
+            return ext in mimes
+
+        found = []
+        with ThreadPoolExecutor(max_workers) as ex:
+            pending = {ex.submit(_scan_dir, root, '', accept)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    files, subdirs = f.result()
+                    found.extend(files)
+                    if on_found is not None and files:
+                        on_found([(p, mimes[os.path.splitext(p)[1].lower()]) for p, _ in files])
+                    if recursive:
+                        pending.update(ex.submit(_scan_dir, p, r, accept) for p, r in subdirs)
+
+        # Walk order is nondeterministic, sort so repeated scans agree
+        found.sort()
+        rel_paths = [p for p, _ in found]
+        sizes = [s for _, s in found]
+        file_mimes = [mimes[os.path.splitext(p)[1].lower()] for p in rel_paths]
+
+        return cls(root, rel_paths, sizes, file_mimes)
+
+    @classmethod
+    def from_filenames(cls, root, rel_paths, get_mime, max_workers=16):
+        """
+        Builds a manifest from an explicit list of paths relative to 'root',
+        statting them concurrently and dropping any that don't exist.
+        'get_mime' maps a path to its mime type.
+        """
+
+        with ThreadPoolExecutor(max_workers) as ex:
+            found = [r for r in ex.map(lambda p: _stat_file(root, p), rel_paths) if r is not None]
+
+        rel_paths = [p for p, _ in found]
+        sizes = [s for _, s in found]
+
+        return cls(root, rel_paths, sizes, [get_mime(p) for p in rel_paths])
+
+    @classmethod
+    def load(cls, path):
+        """Loads a manifest previously written with .save()."""
+        with np.load(path, allow_pickle=False) as d:
+            return cls._from_arrays(
+                str(d['root']), d['path_buffer'], d['path_offsets'], d['sizes'],
+                d['mime_table'], d['mime_codes'], d['hashes'] if 'hashes' in d else None)
+
+    def save(self, path):
+        """Saves the manifest as a single .npz file."""
+        arrays = {
+            'root': np.array(self.root),
+            'path_buffer': self._path_buffer,
+            'path_offsets': self._path_offsets,
+            'sizes': self._sizes,
+            'mime_table': self._mime_table,
+            'mime_codes': self._mime_codes,
+        }
+        if self._hashes is not None:
+            arrays['hashes'] = self._hashes
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    def rebase(self, root):
+        """Points the manifest's relative paths at a different root directory."""
+        self.root = root
+
+    def subset(self, indices) -> 'Manifest':
+        """Returns a new manifest holding only the entries at 'indices' (in that order)."""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self._path_offsets[indices]
+        lengths = self._path_offsets[indices + 1] - starts
+
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if len(indices):
+            gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+            buffer = self._path_buffer[gather]
+        else:
+            buffer = self._path_buffer[:0]
+
+        return Manifest._from_arrays(
+            self.root, buffer, offsets, self._sizes[indices], self._mime_table,
+            self._mime_codes[indices], None if self._hashes is None else self._hashes[indices])
+
+    def rel_path(self, i) -> str:
+        start, end = self._path_offsets[i], self._path_offsets[i + 1]
+        return self._path_buffer[start:end].tobytes().decode('utf-8')
+
+    def path(self, i) -> str:
+        return os.path.join(self.root, self.rel_path(i))
+
+    def name(self, i) -> str:
+        return os.path.basename(self.rel_path(i))
+
+    def size(self, i) -> int:
+        return int(self._sizes[i])
+
+    def mime(self, i) -> str:
+        return str(self._mime_table[self._mime_codes[i]])
+
+    def hash(self, i) -> str:
+        """The hex content digest of entry i, or None if hashes aren't computed."""
+        return None if self._hashes is None else self._hashes[i].tobytes().hex()
+
+    @property
+    def paths():
+        pass
+
+    @paths.getter
+    def paths(self) -> list:
+        return [self.path(i) for i in range(len(self))]
+
+    @property
+    def names():
+        pass
+
+    @names.getter
+    def names(self) -> list:
+        return [self.name(i) for i in range(len(self))]
+
+    @property
+    def sizes():
+        pass
+
+    @sizes.getter
+    def sizes(self) -> np.ndarray:
+        return self._sizes
+
+    @property
+    def fingerprint():
+        pass
+
+    @fingerprint.getter
+    def fingerprint(self) -> str:
+        """A digest of the listed relative paths and sizes, identifying this exact listing."""
+        h = hashlib.sha1()
+        h.update(self._path_offsets.tobytes())
+        h.update(self._path_buffer.tobytes())
+        h.update(self._sizes.tobytes())
+        return h.hexdigest()
+
+    @property
+    def total_size():
+        pass
+
+    @total_size.getter
+    def total_size(self) -> int:
+        return int(self._sizes.sum())
+
+    @property
+    def hashes():
+        pass
+
+    @hashes.getter
+    def hashes(self):
+        """
+        Content digests as an (n, digest_size) uint8 array, or None if
+        compute_hashes() hasn't been run.
+        """
+        return self._hashes
+
+    def compute_hashes(self, max_workers=None):
+        """
+        Hashes every file's content in a process pool, storing the digests
+        in the manifest (and in any file it is subsequently saved to).
+        """
+
+        paths = self.paths
+        chunksize = max(1, len(paths) // ((max_workers or os.cpu_count() or 1) * 16))
+        with ProcessPoolExecutor(max_workers) as ex:
+            digests = list(ex.map(_hash_file, paths, chunksize=chunksize))
+
+        self._hashes = _digests_to_array(digests)
+        return self._hashes
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""sharded upload functionality."""
+
+import json
+import os
+from time import time
+
+import numpy as np
+
+from .journal import UploadJournal
+
+
+class ShardPlan():
+    """
+    Splits one source's upload between several worker processes or hosts.
+
+    A coordinator reserves the whole index range once (see
+    Collection.plan_sharded_upload()) and writes the plan, the manifest and
+    later the per-shard journals to a shared directory. Each worker then
+    uploads its own contiguous slice of the manifest to fixed imageset
+    indices with Collection.upload_shard(), recording progress in its
+    shard's journal, so workers never coordinate with each other directly.
+    Re-running a shard resumes it.
+
+    Check overall progress with ShardPlan.load(plan_dir).status().
+    """
+
+    PLAN_FILE = 'plan.json'
+    MANIFEST_FILE = 'manifest.npz'
+
+    def __repr__(self):
+        return '<ShardPlan "{}" ({} shards, {} images from index {})>'.format(
+            self.plan_dir, len(self.shards), self.delta, self.start)
+
+    def __init__(self, plan_dir, plan_dict):
+        self.plan_dir = plan_dir
+        self._data = plan_dict
+
+    @classmethod
+    def create(cls, uploadable, plan_dir, n_shards, start) -> 'ShardPlan':
+        """
+        Writes a plan for a registered UploadableSource whose indices from
+        'start' have already been reserved. Shards are balanced by bytes
+        rather than image count.
+        """
+        if type(n_shards) is not int or n_shards < 1:
+            raise ValueError('n_shards should be a positive int, not {}'.format(n_shards))
+
+        os.makedirs(plan_dir, exist_ok=True)
+        m = uploadable.manifest
+        m.save(os.path.join(plan_dir, cls.MANIFEST_FILE))
+
+        cumulative = np.cumsum(m.sizes)
+        total = cumulative[-1] if len(cumulative) else 0
+        cuts = np.searchsorted(cumulative, np.arange(1, n_shards) * total / n_shards, side='right')
+        bounds = np.r_[0, cuts, len(m)]
+
+        collection = uploadable.source.collection
+        plan_dict = {
+            'workspace_id': collection.workspace_id,
+            'collection_id': collection.id,
+            'source_index': uploadable.index,
+            'source_name': uploadable.name,
+            'column_filename': uploadable.column_filename,
+            'imageset_id': uploadable.imageset_id,
+            'start': int(start),
+            'delta': len(m),
+            'fingerprint': m.fingerprint,
+            'deduplicate': bool(uploadable.deduplicate),
+            'hash_index_path': uploadable.hash_index_path,
+            'shards': [[int(b), int(e)] for b, e in zip(bounds[:-1], bounds[1:])],
+            'created': time(),
+        }
+        with open(os.path.join(plan_dir, cls.PLAN_FILE), 'w') as f:
+            json.dump(plan_dict, f, indent=2)
+
+        return cls(plan_dir, plan_dict)
+
+    @classmethod
+    def load(cls, plan_dir) -> 'ShardPlan':
+        path = os.path.join(plan_dir, cls.PLAN_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError('No shard plan found at "{}"'.format(path))
+        with open(path, 'r') as f:
+            return cls(plan_dir, json.load(f))
+
+    def _retrieve(self, key):
+        if key not in self._data:
+            raise KeyError('Key "{}" not found in ShardPlan _data'.format(key))
+        return self._data[key]
+
+    @property
+    def start():
+        pass
+
+    @start.getter
+    def start(self) -> int:
+        return self._retrieve('start')
+
+    @property
+    def delta():
+        pass
+
+    @delta.getter
+    def delta(self) -> int:
+        return self._retrieve('delta')
+
+    @property
+    def deduplicate():
+        pass
+
+    @deduplicate.getter
+    def deduplicate(self) -> bool:
+        """Whether the source was deduplicated, so shards add what they upload to its hash index."""
+        return self._data.get('deduplicate', False)
+
+    @property
+    def hash_index_path():
+        pass
+
+    @hash_index_path.getter
+    def hash_index_path(self) -> str:
+        """The hash index the source was deduplicated against, or None for the default."""
+        return self._data.get('hash_index_path')
+
+    @property
+    def shards():
+        pass
+
+    @shards.getter
+    def shards(self) -> list:
+        """[begin, end) manifest index ranges, one per shard."""
+        return self._retrieve('shards')
+
+    @property
+    def manifest_path():
+        pass
+
+    @manifest_path.getter
+    def manifest_path(self) -> str:
+        return os.path.join(self.plan_dir, self.MANIFEST_FILE)
+
+    def journal_path(self, shard) -> str:
+        return os.path.join(self.plan_dir, 'shard-{:04d}.jsonl'.format(shard))
+
+    def shard_range(self, shard) -> tuple:
+        if type(shard) is not int or not 0 <= shard < len(self.shards):
+            raise ValueError('shard should be an int from 0 to {}, not {}'.format(len(self.shards) - 1, shard))
+        begin, end = self.shards[shard]
+        return begin, end
+
+    def open_journal(self, shard, imageset_id) -> UploadJournal:
+        """Opens a shard's journal, starting it with the plan's reservation if new."""
+        if imageset_id != self._retrieve('imageset_id'):
+            raise ValueError('Shard plan is for imageset "{}", not "{}"'
+                             .format(self._retrieve('imageset_id'), imageset_id))
+        journal = UploadJournal(self.journal_path(shard))
+        if not journal.matches(imageset_id, self.delta, self._retrieve('fingerprint')):
+            journal.reserve(imageset_id, self.start, self.delta, self._retrieve('fingerprint'))
+        return journal
+
+    def status(self) -> list:
+        """Per shard progress read from the shard journals: { shard, images, committed, failed }."""
+        statuses = []
+        for shard, (begin, end) in enumerate(self.shards):
+            committed = failed = 0
+            if os.path.exists(self.journal_path(shard)):
+                journal = UploadJournal(self.journal_path(shard))
+                if journal.reservation is not None:
+                    committed = int(journal.committed_mask()[begin:end].sum())
+                    failed = len(journal.failed)
+            statuses.append({'shard': shard, 'images': end - begin, 'committed': committed, 'failed': failed})
+        return statuses
+
+    @property
+    def complete():
+        pass
+
+    @complete.getter
+    def complete(self) -> bool:
+        return all(s['committed'] == s['images'] for s in self.status())
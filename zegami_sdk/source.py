@@ -3,11 +3,31 @@
 
 """collection source functionality."""
 
-from concurrent.futures import as_completed, ThreadPoolExecutor
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+import io
+from itertools import islice
 import json
 import os
-from tqdm import tqdm
+from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+import threading
+from time import sleep
+import warnings
+import zipfile
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from .dedup import find_duplicates, HashIndex
+from .helper import guess_data_mimetype
+from .journal import UploadJournal
+from .manifest import Manifest
+from .transcode import Transcoder
+from .upload import FairScheduler, UploadPipeline
+from .validation import ImageValidator
 
 
 class Source():
@@ -116,6 +136,17 @@ class UploadableSource():
         ".dcm": "application/dicom",
     }
 
+    # Number of concurrent blob uploads
+    UPLOAD_CONCURRENCY = 16
+    # Number of concurrent blob uploads shared by sources uploaded together
+    TOTAL_UPLOAD_CONCURRENCY = 32
+    # Number of signed blob urls requested at once, ahead of demand
+    SIGNED_URL_BATCH_SIZE = 500
+    # Number of times images that failed to upload are retried
+    UPLOAD_RETRIES = 3
+    # Seconds waited before the first retry of failed images, doubling each retry after
+    UPLOAD_RETRY_DELAY = 2
+
     BLACKLIST = (
         ".yaml",
         ".yml",
@@ -131,7 +162,8 @@ class UploadableSource():
     )
 
     def __init__(self, name, image_dir, column_filename='__auto_join__', recursive_search=True, filename_filter=[],
-                 additional_mimes={}):
+                 additional_mimes={}, manifest=None, compute_hashes=False, journal_path=None, deduplicate=False,
+                 hash_index_path=None, transcode=None, validate=False):
         """
         Used in conjunction with create_collection().
 
@@ -146,17 +178,59 @@ class UploadableSource():
         Common mime types are inferred from the file extension,
         but a dict of additional mime type mappings can be provided eg to
         cater for files with no extension.
+
+        The files found are held in a Manifest (see .manifest), which
+        records each file's size and mime type so uploading doesn't need to
+        touch the filesystem again. Scanning a huge directory tree is slow,
+        so a manifest can be saved with .manifest.save(path) and passed back
+        in as 'manifest' (a Manifest or the saved file's path) to skip the
+        scan. Set 'compute_hashes' to also hash each file's content into the
+        manifest.
+
+        Upload progress is recorded in a local journal so that an
+        interrupted upload, run again for the same collection source,
+        only uploads the images that are missing into their original
+        indices. By default the journal lives in ~/.zegami/upload_journals
+        and is removed once everything is uploaded; provide 'journal_path'
+        to keep it somewhere specific.
+
+        Set 'deduplicate' to skip images whose content was already uploaded
+        into the target source, or which repeat another image of this
+        upload. Files are hashed in a process pool and compared against a
+        local index of what was uploaded to the source before (by default
+        in ~/.zegami/hash_indexes, or at 'hash_index_path'). Skipped images
+        are listed in .duplicates with the name of the image holding the
+        same content, so data rows can be pointed at that instead.
+
+        To re-encode or downscale images before they are uploaded, provide
+        'transcode' as a transcode.Transcoder (or a dict of its arguments),
+        eg transcode={'format': 'jpeg', 'quality': 85, 'max_side': 4096}.
+        Images are transcoded in a process pool as the upload streams, and
+        uploaded with the mime type of their new format under their
+        original names.
+
+        Set 'validate' to open and decode every image (or check the DICOM
+        preamble) in a process pool while the directory is scanned. Images
+        that can't be read are left out of the upload, before any indices
+        are reserved for them, and listed in .rejected.
         """
 
         self.name = name
         self.image_dir = image_dir
         self.column_filename = column_filename
+        self.journal_path = journal_path
+        self.deduplicate = deduplicate
+        self.hash_index_path = hash_index_path
+        self.duplicates = []
+        self.rejected = []
+
+        self.transcoder = Transcoder._parse(transcode)
 
         # Set externally once a blank collection has been made
         self._source = None
         self._index = None
 
-        self.image_mimes = {**UploadableSource.IMAGE_MIMES, **additional_mimes}
+        self.image_mimes = {k.lower(): v for k, v in {**UploadableSource.IMAGE_MIMES, **additional_mimes}.items()}
 
         # Check the directory exists
         if not os.path.exists(image_dir):
@@ -164,22 +238,86 @@ class UploadableSource():
         if not os.path.isdir(image_dir):
             raise TypeError('image_dir "{}" is not a directory'.format(self.image_dir))
 
+        validator = ImageValidator() if validate else None
+        try:
+            manifest = self._find_images(manifest, filename_filter, recursive_search, validator)
+
+            if compute_hashes and manifest.hashes is None:
+                manifest.compute_hashes()
+
+            self.manifest = manifest
+
+            print('UploadableSource "{}" found {} images in "{}"'.format(self.name, len(self), image_dir))
+
+            if validator is not None:
+                self._reject_invalid(validator)
+        finally:
+            if validator is not None:
+                validator.shutdown()
+
+    def _find_images(self, manifest, filename_filter, recursive_search, validator) -> Manifest:
+        """Returns the manifest of images to upload, queueing them with 'validator' (if any) as found."""
+        image_dir = self.image_dir
+        if manifest is not None:
+            if type(manifest) is str:
+                manifest = Manifest.load(manifest)
+            if not isinstance(manifest, Manifest):
+                raise TypeError('manifest should be a Manifest or the path to a saved one, not {}'
+                                .format(type(manifest)))
+            manifest.rebase(image_dir)
+
         # Potentially limit paths based on filename_filter.
-        if filename_filter:
+        elif filename_filter:
             if type(filename_filter) != list:
                 raise TypeError('filename_filter should be a list')
-            fps = [os.path.join(image_dir, fp) for fp in filename_filter if os.path.exists(os.path.join(image_dir, fp))]
+            manifest = Manifest.from_filenames(image_dir, filename_filter, self._get_mime_type)
 
         else:
-            # Find all files matching the allowed mime-types
-            fps = sum(
-                [glob('{}/**/*{}'.format(image_dir, ext), recursive=recursive_search)
-                 for ext in self.IMAGE_MIMES.keys()], [])
+            # Find all files matching the allowed mime-types. Extensionless
+            # files are only picked up when named in filename_filter.
+            # Validation starts on each directory's files as they are listed.
+            scan_mimes = {k: v for k, v in self.image_mimes.items() if k}
+            on_found = None if validator is None else lambda files: validator.submit(image_dir, files)
+            return Manifest.scan(image_dir, scan_mimes, recursive=recursive_search, blacklist=self.BLACKLIST,
+                                 on_found=on_found)
+
+        if validator is not None:
+            validator.submit(image_dir, ((manifest.rel_path(i), manifest.mime(i)) for i in range(len(manifest))))
+        return manifest
+
+    def _reject_invalid(self, validator):
+        """Drops the images that failed validation from the manifest, listing them in .rejected."""
+        errors = validator.results()
+        if not errors:
+            return
+
+        m = self.manifest
+        keep = [i for i in range(len(m)) if m.rel_path(i) not in errors]
+        self.rejected = [{'name': m.name(i), 'path': m.path(i), 'error': errors[m.rel_path(i)]}
+                         for i in range(len(m)) if m.rel_path(i) in errors]
+        self.manifest = m.subset(keep)
 
-        self.filepaths = fps
-        self.filenames = [os.path.basename(fp) for fp in self.filepaths]
+        print('- Rejected {} images that could not be read, see .rejected:'.format(len(self.rejected)))
+        for r in self.rejected[:10]:
+            print('    {} : {}'.format(r['name'], r['error']))
+        if len(self.rejected) > 10:
+            print('    ...')
+
+    @property
+    def filepaths():
+        pass
 
-        print('UploadableSource "{}" found {} images in "{}"'.format(self.name, len(self), image_dir))
+    @filepaths.getter
+    def filepaths(self) -> list:
+        return self.manifest.paths
+
+    @property
+    def filenames():
+        pass
+
+    @filenames.getter
+    def filenames(self) -> list:
+        return self.manifest.names
 
     @property
     def source():
@@ -224,7 +362,7 @@ class UploadableSource():
         return self.source.imageset_id
 
     def __len__(self):
-        return len(self.filepaths)
+        return len(self.manifest)
 
     def _register_source(self, index, source):
         """Called to register a new (empty) Source() from a new collection to this, ready for uploading data into."""
@@ -242,134 +380,246 @@ class UploadableSource():
                 .format(self.name, self.source.name)
             )
 
-    def _assign_images_to_smaller_lists(self, file_paths, start=0):
-        """Create smaller lists based on the number of images in the directory."""
-        # Recurse and pick up only valid files (either with image extensions, or not on blacklist)
-        total_work = len(file_paths)
-        workloads = []
-        workload = []
-        workload_start = start
-
-        if total_work > 2500:
-            size = 100
-        elif total_work < 100:
-            size = 1
-        else:
-            size = 10
-
-        i = 0
-        while i < total_work:
-            path = file_paths[i]
-            workload.append(path)
-            i += 1
-            if len(workload) == size or i == total_work:
-                workloads.append({'paths': workload, 'start': workload_start})
-                workload = []
-                workload_start = start + i
-
-        return workloads, total_work, size
-
-    def get_threaded_workloads(self, executor, workloads):
-        threaded_workloads = []
-        for workload in workloads:
-            threaded_workloads.append(executor.submit(
-                self._upload_image_group,
-                workload['paths'],
-                workload['start']
-            ))
-        return threaded_workloads
-
-    def _upload(self):
+    def _upload(self) -> dict:
         """Uploads all images by filepath to the collection.
 
         provided a Source() has been generated and designated to this instance.
-        """
-        collection = self.source.collection
-        c = collection.client
 
+        If the journal shows an earlier attempt at this exact upload, only
+        the images it didn't commit are uploaded, into the indices reserved
+        then. Images that fail are retried up to UPLOAD_RETRIES times.
+        Returns a report of { uploaded, duplicates, rejected, failed, journal }.
+        """
         print('- Uploadable source {} "{}" beginning upload'.format(self.index, self.name))
 
-        # Tell the server how many uploads are expected for this source
-        url = '{}/{}/project/{}/imagesets/{}/extend'.format(c.HOME, c.API_0, collection.workspace_id, self.imageset_id)
+        if self.deduplicate:
+            self._deduplicate()
+
         delta = len(self)
         # If there are no new uploads, ignore.
         if delta == 0:
             print('No new data to be uploaded.')
-            return
-        resp = c._auth_post(url, body=None, json={'delta': delta})
-        new_size = resp['new_size']
-        start = new_size - delta
-
-        (workloads, total_work, group_size) = self._assign_images_to_smaller_lists(self.filepaths, start=start)
-
-        # Multiprocess upload the images
-        # divide the filepaths into smaller groups
-        # with ThreadPoolExecutor() as ex:
-        CONCURRENCY = 16
-        with ThreadPoolExecutor(CONCURRENCY) as executor:
-            threaded_workloads = self.get_threaded_workloads(executor, workloads)
-            kwargs = {
-                'total': len(threaded_workloads),
-                'unit': 'image',
-                'unit_scale': group_size,
-                'leave': True
-            }
-            for f in tqdm(as_completed(threaded_workloads), **kwargs):
-                if f.exception():
-                    raise f.exception()
+            return {'uploaded': 0, 'duplicates': self.duplicates, 'rejected': self.rejected,
+                    'failed': [], 'journal': None}
 
-    def _upload_image_group(self, paths, start_index):
-        """Upload a group of images.
+        fingerprint = self._fingerprint()
+        journal = UploadJournal(self._get_journal_path(fingerprint))
+
+        # Start signing blob urls while the server extends the imageset
+        self._get_url_pool().prefetch()
+
+        if journal.matches(self.imageset_id, delta, fingerprint):
+            start = journal.start
+            todo = journal.missing()
+            print('- Resuming from journal "{}", {} of {} images left to upload'
+                  .format(journal.path, len(todo), delta))
+        else:
+            start = self._reserve_indices()
+            journal.reserve(self.imageset_id, start, delta, fingerprint)
+            todo = None
+
+        report = self._run_upload(start, todo, journal)
+
+        # Only learn the hashes once complete, so a resumed upload
+        # deduplicates to the same images as the interrupted one
+        if not report['failed']:
+            self._learn_hashes(start, range(len(self)))
+
+        return report
+
+    def _learn_hashes(self, start, indices):
+        """Adds the uploaded items at 'indices' to the hash index, if deduplicating."""
+        if self.deduplicate:
+            m = self.manifest
+            self._get_hash_index().add((m.hash(i), m.name(i), start + i) for i in indices)
+
+    def _get_hash_index(self) -> HashIndex:
+        path = self.hash_index_path or os.path.join(
+            Path.home(), '.zegami', 'hash_indexes', '{}.jsonl'.format(self.imageset_id))
+        return HashIndex(path)
+
+    def _deduplicate(self):
+        """Drops images already in the target imageset, or repeated in this upload, from the manifest."""
+        if self.manifest.hashes is None:
+            print('- Hashing {} images to find duplicates'.format(len(self)))
+            self.manifest.compute_hashes()
+
+        keep, duplicates = find_duplicates(self.manifest, self._get_hash_index())
+        if duplicates:
+            print('- Skipping {} duplicate images, see .duplicates for the images they duplicate'
+                  .format(len(duplicates)))
+            self.manifest = self.manifest.subset(keep)
+            self.duplicates.extend(duplicates)
+
+    def _upload_shard(self, plan, shard) -> dict:
+        """Uploads one shard of a sharding.ShardPlan, resuming from the shard's journal."""
+        if self._fingerprint() != plan._retrieve('fingerprint'):
+            raise ValueError('UploadableSource "{}" does not list the images the shard plan was made for'
+                             .format(self.name))
+
+        begin, end = plan.shard_range(shard)
+        journal = plan.open_journal(shard, self.imageset_id)
+        missing = journal.missing()
+        todo = missing[(missing >= begin) & (missing < end)]
+
+        print('- Uploading shard {} of source "{}", {} of {} images left to upload'
+              .format(shard, self.name, len(todo), end - begin))
+
+        self._get_url_pool().prefetch()
+        report = self._run_upload(plan.start, todo, journal)
+
+        # As in _upload(), only learn the shard's hashes once it is complete
+        if not report['failed']:
+            self._learn_hashes(plan.start, range(begin, end))
+
+        return report
+
+    def _reserve_indices(self) -> int:
+        """Tells the server how many uploads are expected for this source, returning the first reserved index."""
+        collection = self.source.collection
+        c = collection.client
+        url = '{}/{}/project/{}/imagesets/{}/extend'.format(
+            c.HOME, c.API_0, collection.workspace_id, self.imageset_id)
+        resp = c._auth_post(url, body=None, json={'delta': len(self)})
+        return resp['new_size'] - len(self)
+
+    def _run_upload(self, start, todo, journal) -> dict:
+        """Uploads the 'todo' items (None for all) from 'start', retrying failures, and reports."""
+        if self.transcoder is None:
+            return self._report_upload(journal, self._run_pipeline(
+                self._make_pipeline(journal=journal), start, todo))
+
+        # Keep every transcoding process busy, and no more images in memory than that needs
+        workers = self.transcoder.max_workers
+        pipeline = self._make_pipeline(read_concurrency=workers, max_in_flight=workers + self.UPLOAD_CONCURRENCY,
+                                       journal=journal)
+        with self.transcoder:
+            failures = self._run_pipeline(pipeline, start, todo)
+        return self._report_upload(journal, failures)
 
-        Item is a tuple comprising:
-            - blob_id
-            - blob_url
-            - file path
+    def get_threaded_workloads(self, executor, workloads):
         """
-        coll = self.source.collection
-        c = coll.client
+        Deprecated: uploads now go through an UploadPipeline, see
+        collection.add_images().
 
-        # Obtain blob storage information
-        blob_storage_urls, id_set = c._obtain_signed_blob_storage_urls(
-            coll.workspace_id, id_count=len(paths), blob_path="imagesets/{}".format(self.imageset_id))
+        Submits each { indices, start } workload's upload to 'executor',
+        returning the futures, each of { item index: error } of the items
+        that failed.
+        """
+        warnings.warn('get_threaded_workloads() is deprecated, uploads now use an UploadPipeline',
+                      DeprecationWarning, stacklevel=2)
+        return [executor.submit(self._make_pipeline().run, w['start'] - int(w['indices'][0]), w['indices'])
+                for w in workloads if len(w['indices'])]
+
+    def _make_pipeline(self, **kwargs) -> UploadPipeline:
+        """An UploadPipeline for this source, on the shared scheduler if uploading alongside other sources."""
+        return UploadPipeline(self, put_concurrency=self.UPLOAD_CONCURRENCY, scheduler=self._scheduler,
+                              desc=self.name if self._scheduler is not None else None,
+                              position=self._index if self._scheduler is not None else None, **kwargs)
+
+    def _run_pipeline(self, pipeline, start, todo) -> dict:
+        failures = pipeline.run(start, todo) if todo is None or len(todo) else {}
+        for attempt in range(self.UPLOAD_RETRIES):
+            if not failures:
+                break
+            delay = self.UPLOAD_RETRY_DELAY * 2 ** attempt
+            print('- Retrying {} images that failed to upload in {}s ({}/{})'
+                  .format(len(failures), delay, attempt + 1, self.UPLOAD_RETRIES))
+            sleep(delay)
+            failures = pipeline.run(start, sorted(failures))
+        return failures
+
+    def _fingerprint(self) -> str:
+        """Identifies exactly what this uploadable uploads, to match it against journals."""
+        return self.manifest.fingerprint
+
+    def _get_journal_path(self, fingerprint) -> str:
+        if self.journal_path:
+            return self.journal_path
+        return os.path.join(Path.home(), '.zegami', 'upload_journals',
+                            '{}-{}.jsonl'.format(self.imageset_id, fingerprint[:16]))
+
+    def _report_upload(self, journal, failures) -> dict:
+        """Prints and returns a summary of the upload, tidying up the default journal if complete."""
+        report = {
+            'uploaded': journal.committed_count,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'failed': [{'index': i, 'name': self._item_info(i)['name'], 'error': e}
+                       for i, e in sorted(failures.items())],
+            'journal': journal.path,
+        }
 
-        # Check that numbers of values are still matching
-        if not len(paths) == len(blob_storage_urls):
-            raise Exception(
-                'Mismatch in blob urls count ({}) to filepath count ({})'
-                .format(len(blob_storage_urls), len(self))
-            )
+        if failures:
+            print('- {} images of source "{}" failed to upload. Run the upload again to retry them '
+                  '(progress is kept in "{}"):'.format(len(failures), self.name, journal.path))
+            for f in report['failed'][:10]:
+                print('    {} : {}'.format(f['name'], f['error']))
+            if len(failures) > 10:
+                print('    ...')
+        elif not self.journal_path:
+            os.remove(journal.path)
 
-        bulk_info = []
-        for (i, path) in enumerate(paths):
-            mime_type = self._get_mime_type(path)
-            blob_id = id_set['ids'][i]
-            blob_url = blob_storage_urls[blob_id]
-            bulk_info.append({
-                'blob_id': blob_id,
-                'name': os.path.basename(path),
-                'size': os.path.getsize(path),
-                'mimetype': mime_type
-            })
-            self._upload_image(c, path, blob_url, mime_type)
-
-        # Upload bulk image info
-        url = (
-            f'{c.HOME}/{c.API_0}/project/{coll.workspace_id}/imagesets/{self.imageset_id}'
-            f'/images_bulk?start={start_index}'
-        )
-        c._auth_post(url, body=None, return_response=True, json={'images': bulk_info})
-
-    def _upload_image(self, client, path, blob_url, mime_type):
-        """Uploads a single image to the collection."""
-        try:
-            with open(path, 'rb') as f:
-                client._upload_to_signed_blob_storage_url(f, blob_url, mime_type)
-        except Exception as e:
-            print('Error uploading "{}" to blob storage:\n{}'.format(path, e))
+        return report
+
+    def _get_url_pool(self):
+        """The client's pool of signed blob urls for this source's imageset."""
+        collection = self.source.collection
+        return collection.client._get_signed_blob_url_pool(
+            collection.workspace_id, 'imagesets/{}'.format(self.imageset_id),
+            batch_size=min(max(len(self), 1), self.SIGNED_URL_BATCH_SIZE))
+
+    def _item_sizes(self):
+        return self.manifest.sizes
+
+    def _item_info(self, index) -> dict:
+        m = self.manifest
+        mime = m.mime(index)
+        if self.transcoder is not None:
+            mime = self.transcoder.mime_type(mime)
+        return {'name': m.name(index), 'size': m.size(index), 'mimetype': mime}
+
+    def _read_item(self, index):
+        """
+        Opens a file for upload, returning (file, info). The upload stage
+        closes the file. Transcoded images are returned as bytes instead.
+        """
+        info = self._item_info(index)
+        path = self.manifest.path(index)
+        if self.transcoder is not None:
+            data = self.transcoder.transcode(path, self.manifest.mime(index))
+            if data is not None:
+                return data, {**info, 'size': len(data)}
+        return open(path, 'rb'), info
+
+    # The FairScheduler shared with other sources during _upload_all()
+    _scheduler = None
+
+    @classmethod
+    def _upload_all(cls, uploadable_sources) -> list:
+        """
+        Uploads registered sources concurrently, their blob uploads sharing
+        one FairScheduler of TOTAL_UPLOAD_CONCURRENCY workers so small
+        sources don't queue behind large ones. Returns each source's report.
+        """
+        if len(uploadable_sources) < 2:
+            return [us._upload() for us in uploadable_sources]
 
-    def _check_in_data(self, data):
-        cols = list(data.columns)
+        scheduler = FairScheduler(cls.TOTAL_UPLOAD_CONCURRENCY)
+        for us in uploadable_sources:
+            us._scheduler = scheduler
+        try:
+            with ThreadPoolExecutor(len(uploadable_sources)) as ex:
+                futures = [ex.submit(us._upload) for us in uploadable_sources]
+            return [f.result() for f in futures]
+        finally:
+            for us in uploadable_sources:
+                us._scheduler = None
+            scheduler.shutdown()
+
+    def _check_in_data(self, columns):
+        """Checks this source's filename column is among the data's 'columns' (or a DataFrame's)."""
+        cols = list(columns.columns) if isinstance(columns, pd.DataFrame) else list(columns)
         if self.column_filename != '__auto_join__' and self.column_filename not in cols:
             raise Exception('Source "{}" had the filename_column "{}" '
                             'which is not a column of the provided data:\n{}'
@@ -396,14 +646,363 @@ class UploadableSource():
 
     def _get_mime_type(self, path) -> str:
         """Gets the mime_type of the path. Raises an error if not a valid image mime_type."""
-        if '.' not in path:
-            return self.image_mimes['']
-        ext = os.path.splitext(path)[-1]
+        ext = os.path.splitext(os.path.basename(path))[-1].lower()
         if ext in self.image_mimes.keys():
             return self.image_mimes[ext]
         raise TypeError('"{}" is not a supported image mime_type ({})'.format(path, self.image_mimes))
 
 
+class InMemorySource(UploadableSource):
+
+    FORMATS = {
+        'png': 'image/png',
+        'jpeg': 'image/jpeg',
+        'bmp': 'image/bmp',
+        'tiff': 'image/tiff',
+        'webp': 'image/webp',
+    }
+
+    def __init__(self, name, images, column_filename='__auto_join__', format='png', quality=90, chunk_size=1000,
+                 encode_concurrency=None):
+        """
+        Used in conjunction with create_collection() or add_images().
+
+        An InMemorySource() uploads images held or generated in memory
+        rather than files on disk, eg model outputs or crops, without
+        writing them out first.
+
+        'images' is any iterable (including a generator) of (name, image)
+        pairs, where image is already encoded bytes (uploaded as they are,
+        with the mime type of the name's extension or else of the content),
+        a numpy array or a PIL.Image. Arrays and PIL images are encoded to
+        'format' ('png', 'jpeg', 'bmp', 'tiff' or 'webp') using
+        'quality' for lossy formats. The name is what data rows join on.
+
+        The iterable is consumed lazily, 'chunk_size' images at a time, so
+        only one chunk of source images is held at once. Each chunk reserves
+        its own indices and is encoded by 'encode_concurrency' workers
+        (default: the number of CPUs) as it streams into blob storage.
+        A generator can't be replayed, so these uploads aren't journaled
+        for resuming.
+        """
+        if format not in self.FORMATS:
+            raise ValueError('format should be one of {}, not "{}"'.format(list(self.FORMATS), format))
+        if type(chunk_size) is not int or chunk_size < 1:
+            raise ValueError('chunk_size should be a positive int, not {}'.format(chunk_size))
+
+        self.name = name
+        self.images = images
+        self.column_filename = column_filename
+        self.format = format
+        self.quality = quality
+        self.chunk_size = chunk_size
+        self.encode_concurrency = encode_concurrency or os.cpu_count() or 1
+        self.image_mimes = {k.lower(): v for k, v in UploadableSource.IMAGE_MIMES.items()}
+        self.duplicates = []
+        self.rejected = []
+
+        # UploadableSource's options, which don't apply to images from memory.
+        # Its __init__ scans a directory, so they are set here instead.
+        self.image_dir = None
+        self.manifest = None
+        self.journal_path = None
+        self.deduplicate = False
+        self.hash_index_path = None
+        self.transcoder = None
+
+        # The chunk of (name, image) pairs being uploaded
+        self._items = []
+
+        # Set externally once a blank collection has been made
+        self._source = None
+        self._index = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def _upload(self) -> dict:
+        """
+        Uploads the images chunk by chunk, provided a Source() has been
+        generated and designated to this instance.
+
+        Returns a report of { uploaded, failed }, where failed items are
+        identified by their position in 'images'.
+        """
+        print('- Uploadable source {} "{}" beginning upload from memory'.format(self.index, self.name))
+
+        uploaded = 0
+        failed = []
+        position = 0
+        images = iter(self.images)
+        try:
+            while True:
+                self._items = list(islice(images, self.chunk_size))
+                if not self._items:
+                    break
+
+                start = self._reserve_indices()
+                pipeline = self._make_pipeline(read_concurrency=self.encode_concurrency,
+                                               max_in_flight=self.encode_concurrency + self.UPLOAD_CONCURRENCY)
+                failures = self._run_pipeline(pipeline, start, None)
+
+                uploaded += len(self._items) - len(failures)
+                failed.extend({'index': position + i, 'name': self._item_info(i)['name'], 'error': e}
+                              for i, e in sorted(failures.items()))
+                position += len(self._items)
+        finally:
+            self._items = []
+
+        if failed:
+            print('- {} images of source "{}" failed to upload:'.format(len(failed), self.name))
+            for f in failed[:10]:
+                print('    {} : {}'.format(f['name'], f['error']))
+            if len(failed) > 10:
+                print('    ...')
+
+        return {'uploaded': uploaded, 'failed': failed}
+
+    def _item_sizes(self):
+        return None
+
+    def _item_info(self, index) -> dict:
+        item = self._items[index]
+        name = item[0] if type(item) is tuple and len(item) == 2 else repr(item)
+        return {'name': name}
+
+    def _read_item(self, index):
+        """Encodes an image for upload, returning (bytes, info)."""
+        item = self._items[index]
+        if type(item) is not tuple or len(item) != 2 or type(item[0]) is not str:
+            raise TypeError('images should be (name, image) pairs, not {}'.format(repr(item)[:100]))
+
+        name, image = item
+        data, mime_type = self._encode(name, image)
+        return data, {'name': name, 'size': len(data), 'mimetype': mime_type}
+
+    def _encode(self, name, image):
+        """Returns (bytes, mime_type) of an image given as bytes, a numpy array or a PIL.Image."""
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            data = bytes(image)
+            ext = os.path.splitext(name)[-1].lower()
+            return data, self.image_mimes[ext] if ext in self.image_mimes else guess_data_mimetype(data)
+
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        if not isinstance(image, Image.Image):
+            raise TypeError('Image "{}" should be bytes, a numpy array or a PIL.Image, not {}'
+                            .format(name, type(image)))
+
+        if self.format == 'jpeg' and image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.format.upper(), **({} if self.format == 'png' else {'quality': self.quality}))
+        return buffer.getvalue(), self.FORMATS[self.format]
+
+
+class _MemberFile():
+    """
+    A seekable, read-only view of 'size' bytes of a file from 'offset',
+    eg an archive member. Its size is known up front, so it is never read
+    to find its end.
+    """
+
+    def __init__(self, fileobj, size, offset=0):
+        self._f = fileobj
+        self._size = size
+        self._offset = offset
+        self._pos = 0
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + pos)
+        return self._pos
+
+    def read(self, size=-1) -> bytes:
+        remaining = max(0, self._size - self._pos)
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        if not size:
+            return b''
+        # Only seek the underlying file when it isn't already in place
+        if self._f.tell() != self._offset + self._pos:
+            self._f.seek(self._offset + self._pos)
+        data = self._f.read(size)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+
+class ArchiveSource(UploadableSource):
+
+    # Bytes of a compressed tar member held in memory before spilling to a temp file
+    MEMBER_SPOOL_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, name, archive_path, column_filename='__auto_join__', filename_filter=[], additional_mimes={},
+                 journal_path=None, read_concurrency=4):
+        """
+        Used in conjunction with create_collection() or add_images().
+
+        An ArchiveSource() uploads the images inside a .zip or .tar (plain,
+        .tar.gz, .tar.bz2 or .tar.xz) archive without extracting it to disk.
+
+        Members are chosen with the same mime type and blacklist rules as
+        an UploadableSource, or by 'filename_filter' (checked against the
+        member's basename). Each image is named after its member's
+        basename.
+
+        Zip and uncompressed tar members are streamed to the upload by
+        'read_concurrency' threads at once. Compressed tar archives can
+        only be read front to back, so their members are read in order by
+        a single reader, each through a spooled temporary file. The
+        archive is read once to list its images, and again to upload them.
+
+        Like an UploadableSource, progress is journaled so an interrupted
+        upload can be resumed (see 'journal_path').
+        """
+        if not os.path.isfile(archive_path):
+            raise FileNotFoundError('archive_path "{}" is not a file'.format(archive_path))
+        if filename_filter and type(filename_filter) != list:
+            raise TypeError('filename_filter should be a list')
+
+        if zipfile.is_zipfile(archive_path):
+            self._is_zip = True
+        elif tarfile.is_tarfile(archive_path):
+            self._is_zip = False
+        else:
+            raise TypeError('"{}" is not a zip or tar archive'.format(archive_path))
+
+        self.name = name
+        self.archive_path = archive_path
+        self.column_filename = column_filename
+        self.journal_path = journal_path
+        self.read_concurrency = read_concurrency
+        self.image_mimes = {k.lower(): v for k, v in {**UploadableSource.IMAGE_MIMES, **additional_mimes}.items()}
+        self._filename_filter = set(filename_filter)
+        self.image_dir = None
+        self.deduplicate = False
+        self.hash_index_path = None
+        self.transcoder = None
+        self.duplicates = []
+        self.rejected = []
+
+        # Per thread zip handles, or the single position in the tar stream
+        self._zip_handles = threading.local()
+        self._opened = []
+        self._tar = None
+        self._tar_lock = threading.Lock()
+
+        # Set externally once a blank collection has been made
+        self._source = None
+        self._index = None
+
+        # Where each member's data starts, in an uncompressed tar
+        self._tar_offsets = None
+        if self._is_zip:
+            members = [(m.filename, m.file_size) for m in self._zip_members()]
+        else:
+            members, offsets = [], []
+            for m, tar in self._tar_members():
+                members.append((m.name, m.size))
+                offsets.append(m.offset_data)
+            with tarfile.open(archive_path, 'r|*') as tar:
+                if tar.fileobj.comptype == 'tar':
+                    self._tar_offsets = offsets
+        self.manifest = Manifest(archive_path, [n for n, _ in members], [s for _, s in members],
+                                 [self._get_mime_type(n) for n, _ in members])
+
+        print('ArchiveSource "{}" found {} images in "{}"'.format(self.name, len(self), archive_path))
+
+    def _accept(self, member_name) -> bool:
+        basename = os.path.basename(member_name)
+        if self._filename_filter:
+            return basename in self._filename_filter
+        lower = basename.lower()
+        ext = os.path.splitext(lower)[1]
+        return not lower.startswith('.') and not lower.endswith(self.BLACKLIST) and bool(ext)\
+            and ext in self.image_mimes
+
+    def _zip_members(self) -> list:
+        with zipfile.ZipFile(self.archive_path) as z:
+            return [m for m in z.infolist() if not m.is_dir() and self._accept(m.filename)]
+
+    def _tar_members(self):
+        """Streams the archive, yielding each accepted (member, tar) in order."""
+        with tarfile.open(self.archive_path, 'r|*') as tar:
+            for member in tar:
+                if member.isfile() and self._accept(member.name):
+                    yield member, tar
+
+    def _item_info(self, index) -> dict:
+        m = self.manifest
+        return {'name': m.name(index), 'size': m.size(index), 'mimetype': m.mime(index)}
+
+    def _read_item(self, index):
+        """Opens an archive member for upload, returning (file, info). The upload closes the file."""
+        if self._is_zip:
+            data = self._read_zip_member(index)
+        elif self._tar_offsets is not None:
+            data = _MemberFile(open(self.archive_path, 'rb'), self.manifest.size(index), self._tar_offsets[index])
+        else:
+            data = self._read_tar_member(index)
+        return data, self._item_info(index)
+
+    def _read_zip_member(self, index) -> '_MemberFile':
+        z = getattr(self._zip_handles, 'zip', None)
+        if z is None:
+            z = self._zip_handles.zip = zipfile.ZipFile(self.archive_path)
+            self._opened.append(z)
+        return _MemberFile(z.open(self.manifest.rel_path(index)), self.manifest.size(index))
+
+    def _read_tar_member(self, index):
+        """
+        Copies member 'index' of a compressed tar into a spooled temporary
+        file, moving forward through the tar stream (restarting it to go
+        back). A compressed stream can't be read out of order, so this
+        keeps no more than MEMBER_SPOOL_SIZE bytes of a member in memory.
+        """
+        with self._tar_lock:
+            if self._tar is None or index < self._tar[1]:
+                self._tar = [self._tar_members(), 0]
+            members, position = self._tar
+            try:
+                for member, tar in members:
+                    self._tar[1] = position = position + 1
+                    if position - 1 == index:
+                        spool = tempfile.SpooledTemporaryFile(self.MEMBER_SPOOL_SIZE)
+                        shutil.copyfileobj(tar.extractfile(member), spool)
+                        spool.seek(0)
+                        return spool
+            except Exception:
+                # The stream can't continue past a bad read, start afresh next time
+                self._tar = None
+                raise
+            raise IndexError('Member {} not found in "{}"'.format(index, self.archive_path))
+
+    def _run_upload(self, start, todo, journal) -> dict:
+        pipeline = self._make_pipeline(read_concurrency=self.read_concurrency, journal=journal)
+        try:
+            return self._report_upload(journal, self._run_pipeline(pipeline, start, todo))
+        finally:
+            self._close_archive()
+
+    def _close_archive(self):
+        """Closes the zip handles and tar stream opened for reading members."""
+        for z in self._opened:
+            z.close()
+        self._opened = []
+        self._zip_handles = threading.local()
+        if self._tar is not None:
+            self._tar[0].close()
+            self._tar = None
+
+
 class UrlSource(UploadableSource):
 
     def __init__(self, name, url_template, image_fetch_headers, column_filename=None):
@@ -6,17 +6,42 @@
 
 import io
 import importlib
+import json
 import os
 from pathlib import Path
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch
+import zipfile
 
+import numpy as np
+import pandas as pd
+from PIL import Image
+import requests
 import requests_mock
 from zegami_sdk import util
+from zegami_sdk.annotation_store import AnnotationStore
+from zegami_sdk.annotation_table import AnnotationTable
+from zegami_sdk.blocks import BlockUpload
 from zegami_sdk.client import ZegamiClient
+from zegami_sdk import collection
+from zegami_sdk.collection import Collection
+from zegami_sdk.dedup import find_duplicates, HashIndex
+from zegami_sdk.journal import UploadJournal
+from zegami_sdk import validation
+from zegami_sdk.validation import ImageValidator
+from zegami_sdk.manifest import Manifest
+from zegami_sdk.source import ArchiveSource, InMemorySource, UploadableSource
+from zegami_sdk.throttle import UploadThrottle
+from zegami_sdk.transcode import Transcoder
+from zegami_sdk.upload import _GroupSizer, FairScheduler, SignedUrlPool, UploadPipeline
 
-from .helper import guess_data_mimetype
+from .helper import (_JsonArrayStream, guess_data_mimetype, iter_json_array, read_data_columns, SERVER_DELIMITERS,
+                     sniff_data_delimiter)
 
 
 class TestHelper(unittest.TestCase):
@@ -42,6 +67,728 @@ class TestHelper(unittest.TestCase):
             'text/plain'
         )
 
+    def test_iter_json_array(self):
+        annos = [{'id': i, 'annotation': {'points': [[i, 'é']] * i}} for i in range(20)] + [7]
+        doc = json.dumps({'sources': [{'id': 's', 'annotations': annos}]}, ensure_ascii=False).encode('utf-8')
+        for size in [1, 5, 64, len(doc)]:
+            chunks = (doc[i:i + size] for i in range(0, len(doc), size))
+            self.assertEqual(list(iter_json_array(chunks, 'annotations')), annos)
+        self.assertEqual(list(iter_json_array([b'{"annotations" : [ ]}'], 'annotations')), [])
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"annotations": [{"id": 1}, {"id"'], 'annotations'))
+
+    def test_iter_json_array_large_item(self):
+        mask = {'id': 'big', 'annotation': {'mask': 'x' * 100000}}
+        doc = json.dumps({'annotations': [mask, {'id': 'small'}]}).encode('utf-8')
+        stream = _JsonArrayStream((doc[i:i + 100] for i in range(0, len(doc), 100)), 'annotations')
+        stream._parser.raw_decode = unittest.mock.Mock(wraps=stream._parser.raw_decode)
+        self.assertEqual(list(stream), [mask, {'id': 'small'}])
+        # A thousand chunks, but the item is only reparsed as the read doubles
+        self.assertLess(stream._parser.raw_decode.call_count, 20)
+
+
+class TestReadDataColumns(unittest.TestCase):
+    def test_header_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {
+                'data.csv': '\ufeffimage,"size, px",label\n' + 'a.png,1,x\n' * 10,
+                'data.tsv': 'image\tlabel\na.png\tx\n',
+                'semi.csv': 'image;label\na.png;x\n',
+                'single.txt': 'image\na.png\n',
+            }
+            for name, content in files.items():
+                with open(os.path.join(tmp, name), 'w', encoding='utf-8') as f:
+                    f.write(content)
+
+            self.assertEqual(read_data_columns(os.path.join(tmp, 'data.csv')), ['image', 'size, px', 'label'])
+            self.assertEqual(read_data_columns(os.path.join(tmp, 'data.tsv')), ['image', 'label'])
+            self.assertEqual(read_data_columns(os.path.join(tmp, 'semi.csv')), ['image', 'label'])
+            self.assertEqual(read_data_columns(os.path.join(tmp, 'single.txt')), ['image'])
+            self.assertRaises(ValueError, read_data_columns, os.path.join(tmp, 'data.json'))
+
+            # Only files split the way the server expects are uploaded as they are
+            self.assertEqual(sniff_data_delimiter(os.path.join(tmp, 'data.csv')), SERVER_DELIMITERS['csv'])
+            self.assertEqual(sniff_data_delimiter(os.path.join(tmp, 'data.tsv')), SERVER_DELIMITERS['tsv'])
+            self.assertNotEqual(sniff_data_delimiter(os.path.join(tmp, 'semi.csv')), SERVER_DELIMITERS['csv'])
+            self.assertNotIn('txt', SERVER_DELIMITERS)
+
+
+class TestCollectionLookups(unittest.TestCase):
+    def setUp(self):
+        sources = [
+            {'name': 'Regular', 'imageset_id': 'ims_0', 'imageset_dataset_join_id': 'join_0'},
+            {'name': 'X-Ray', 'imageset_id': 'ims_1', 'imageset_dataset_join_id': 'join_1'},
+        ]
+        self.collection = Collection(None, None, {'version': 2, 'image_sources': sources})
+        lookups = {'join_0': [2, None, 0], 'join_1': {k: k for k in range(4)}}
+        self.collection._join_id_to_lookup = lambda join_id: lookups[join_id]
+
+    def test_imageset_index_matrix(self):
+        sources = self.collection._parse_sources('all')
+        matrix = self.collection._get_imageset_index_matrix([0, 1, 2, 3], sources)
+        self.assertEqual(matrix.tolist(), [[2, 0], [-1, 1], [0, 2], [-1, 3]])
+
+    def test_download_rows_aligns_sources(self):
+        self.collection._client = unittest.mock.MagicMock(HOME='https://mockzegami.com', API_0='api/v0')
+        self.collection._workspace = unittest.mock.MagicMock(id='ws')
+        self.collection.download_image = lambda url: url.split('/')[-4:-1]
+        rows = list(self.collection.download_rows([1, 2], prefetch_rows=1))
+        self.assertEqual(rows, [
+            (None, ['ims_1', 'images', '1']),
+            (['ims_0', 'images', '0'], ['ims_1', 'images', '2']),
+        ])
+
+    def test_sync_rows(self):
+        self.collection._cached_rows = pd.DataFrame({'id': [1, 2, 3], 'value': [1.0, 2.0, 3.0]})
+        self.collection.replace_data = unittest.mock.MagicMock()
+
+        # Same values with a different dtype are not a change
+        result = self.collection.sync_rows(pd.DataFrame({'id': [1, 2, 3], 'value': [1, 2, 3]}), key='id')
+        self.assertEqual(result, {'inserted': 0, 'updated': 0, 'deleted': 0, 'uploaded': False})
+        self.collection.replace_data.assert_not_called()
+
+        data = pd.DataFrame({'id': [1, 3, 4], 'value': [1.0, 5.0, 4.0]})
+        result = self.collection.sync_rows(data, key='id')
+        self.assertEqual(result, {'inserted': 1, 'updated': 1, 'deleted': 1, 'uploaded': True})
+        self.collection.replace_data.assert_called_once()
+        self.assertIsNone(self.collection._cached_rows)
+
+        # Keys read back as floats or strings still match
+        for keys in [[1.0, 2.0, np.nan], ['1', '2', None]]:
+            self.collection._cached_rows = pd.DataFrame({'id': keys, 'value': [1, 2, 3]})
+            result = self.collection.sync_rows(pd.DataFrame({'id': [1, 2, 4], 'value': [1, 2, 3]}), key='id')
+            self.assertEqual((result['inserted'], result['updated'], result['deleted']), (1, 0, 1))
+
+    def _mock_data_file(self, content):
+        response = unittest.mock.MagicMock()
+        response.iter_content.return_value = [content[i:i + 7] for i in range(0, len(content), 7)]
+        self.collection._client = unittest.mock.MagicMock(
+            HOME='https://mockzegami.com', API_0='api/v0', _auth_get=unittest.mock.MagicMock(return_value=response))
+        self.collection._workspace = unittest.mock.MagicMock(id='ws')
+        self.collection._data['dataset_id'] = 'ds'
+        uploaded = []
+        self.collection._upload_data_file = lambda f, name: uploaded.append(f.read())
+        self.collection.replace_data = unittest.mock.MagicMock()
+        return uploaded
+
+    def test_append_rows_streams_existing_tsv(self):
+        uploaded = self._mock_data_file(b'id\tvalue\tnote\n1\t1.5\ta\n2\t2.5\tb')
+        self.collection.append_rows(pd.DataFrame({'value': [3.5], 'id': [3]}), fail_if_not_ready=False)
+        self.assertEqual(uploaded, [b'id\tvalue\tnote\n1\t1.5\ta\n2\t2.5\tb\n3\t3.5\t\n'])
+        self.collection.replace_data.assert_not_called()
+
+        with self.assertRaises(ValueError):
+            self.collection.append_rows(pd.DataFrame({'other': [1]}), fail_if_not_ready=False)
+
+    def test_append_rows_replaces_non_tsv_data(self):
+        for content in [b'id,value\n1,1.5\n', b'PK\x03\x04\x00\x01binary']:
+            uploaded = self._mock_data_file(content)
+            self.collection._cached_rows = pd.DataFrame({'id': [1], 'value': [1.5]})
+            self.collection.append_rows(pd.DataFrame({'id': [3], 'value': [3.5]}), fail_if_not_ready=False)
+            self.assertEqual(uploaded, [])
+            replaced = self.collection.replace_data.call_args[0][0]
+            self.assertEqual(replaced.to_dict('list'), {'id': [1, 3], 'value': [1.5, 3.5]})
+
+    def test_upload_annotations(self):
+        posted = []
+
+        def post(url, body=None, json=None):
+            if json['image_index'] == 0:
+                raise Exception('rejected')
+            posted.append(json)
+            return {'id': 'anno_{}'.format(json['image_index'])}
+
+        self.collection._client = unittest.mock.MagicMock(
+            HOME='https://mockzegami.com', API_1='api/v1', email='me', _auth_post=post)
+        self.collection._workspace = unittest.mock.MagicMock(id='ws')
+        uploadable = {'type': 'zc-boundingbox', 'format': 'BB1', 'class_id': 1, 'annotation': {'x0': 0}}
+        items = [(0, uploadable), (1, uploadable), (2, uploadable), (0, {'type': 'x'}), (9, uploadable),
+                 (0, uploadable)]
+        results = self.collection.upload_annotations(iter(items), author='model', max_workers=2, batch_size=2)
+
+        # Rows without images and bad uploadables fail alone, without stopping the rest
+        self.assertEqual([(r['row_index'], r['image_index'], r['ok']) for r in results],
+                         [(0, 2, True), (1, None, False), (2, 0, False), (0, 2, False), (9, None, False),
+                          (0, 2, True)])
+        self.assertEqual(results[0]['response'], {'id': 'anno_2'})
+        self.assertIsInstance(results[1]['response'], IndexError)
+        self.assertIsInstance(results[3]['response'], AssertionError)
+        self.assertEqual(len(posted), 2)
+        self.assertEqual(posted[0]['imageset_id'], 'ims_0')
+        self.assertEqual(posted[0]['author'], 'model')
+
+    def test_bulk_deletes(self):
+        attempts = []
+
+        def delete(url, **kwargs):
+            attempts.append(url)
+            if url.endswith('/b'):
+                raise Exception('gone')
+
+        self.collection._client = unittest.mock.MagicMock(
+            HOME='https://mockzegami.com', API_0='api/v0', API_1='api/v1', email='me', _auth_delete=delete)
+        self.collection._workspace = unittest.mock.MagicMock(id='ws')
+        self.collection._data['name'] = 'coll'
+
+        annos = [{'id': 'a', 'author': 'model'}, {'id': 'b', 'author': 'model'}, {'id': 'c', 'author': 'me'}]
+        with patch.object(collection, 'sleep') as sleep:
+            result = self.collection.delete_annotations(annos, author='model', retries=1)
+        sleep.assert_called_once_with(UploadableSource.UPLOAD_RETRY_DELAY)
+        self.assertEqual(result['deleted'], 1)
+        self.assertEqual(list(result['failed']), ['b'])
+        self.assertEqual(sorted(a.split('/')[-1] for a in attempts), ['a', 'b', 'b'])
+        with self.assertRaises(ValueError):
+            self.collection.delete_annotations(['a'], author='model')
+
+        del attempts[:]
+        result = self.collection.delete_images([0, 2])
+        self.assertEqual(result, {'deleted': 2, 'failed': {}})
+        self.assertEqual(sorted(attempts), [
+            'https://mockzegami.com/api/v0/project/ws/imagesets/ims_0/images/0',
+            'https://mockzegami.com/api/v0/project/ws/imagesets/ims_0/images/2',
+        ])
+
+    @patch.object(Collection, 'classes', new_callable=unittest.mock.PropertyMock,
+                  return_value=[{'id': 1, 'name': 'cat'}, {'id': 2, 'name': 'dog'}])
+    def test_annotations_to_dataframe(self, classes):
+        annos = [
+            {'id': 'a', 'type': 'zc-boundingbox', 'author': 'model', 'image_index': 0, 'class_id': '2',
+             'metadata': {'score': 0.5}},
+            {'id': 'b', 'type': 'zc-boundingbox', 'author': 'me', 'image_index': 2, 'class_id': '1'},
+            {'id': 'c', 'type': 'zc-polygon', 'author': 'me', 'image_index': 1, 'class_id': '3',
+             'metadata': {'Author': 'reviewer'}},
+            {'id': 'd', 'type': 'zc-polygon', 'author': 'me'},
+        ]
+        df = self.collection._annotations_to_dataframe(annos, self.collection.sources[0], typed=True)
+        self.assertEqual(df['Class'].tolist()[:2], ['dog', 'cat'])
+        self.assertTrue(pd.isna(df['Class'][2]))
+        self.assertEqual(df['Row Index'].tolist(), [2, 0, -1, -1])
+        self.assertEqual(df['Imageset Index'].tolist(), [0, 2, 1, -1])
+        self.assertEqual(df['ID'].tolist(), ['a', 'b', 'c', 'd'])
+        self.assertEqual(df['Author'].dtype, 'category')
+        # Metadata named like a column replaces it, without adding a column
+        self.assertEqual(df['Author'].tolist(), ['model', 'me', 'reviewer', 'me'])
+        self.assertEqual(list(df.columns).count('Author'), 1)
+        self.assertEqual(df['score'].tolist()[0], 0.5)
+
+    def test_iter_annotations(self):
+        annos = [{'id': i, 'author': 'model' if i % 2 else 'me'} for i in range(5)]
+        response = unittest.mock.MagicMock()
+        response.iter_content.return_value = [json.dumps({'annotations': annos}).encode()]
+        self.collection._client = unittest.mock.MagicMock(
+            HOME='https://mockzegami.com', API_1='api/v1', _auth_get=unittest.mock.MagicMock(return_value=response))
+        self.collection._workspace = unittest.mock.MagicMock(id='ws')
+        self.collection._data['id'] = 'coll'
+        self.collection._data['image_sources'][0]['source_id'] = 'src'
+
+        batches = list(self.collection.iter_annotations(anno_type='mask', author='model', batch_size=1))
+        self.assertEqual(batches, [[annos[1]], [annos[3]]])
+        args, kwargs = self.collection.client._auth_get.call_args
+        self.assertEqual(kwargs['params'], {'type': 'mask', 'author': 'model'})
+
+    @patch.object(collection, 'IMAGE_ANNOTATIONS_CACHE_SIZE', 2)
+    def test_get_annotations_for_images_caches(self):
+        fetched = []
+
+        def get(url):
+            fetched.append(url.split('/')[-1])
+            return {'annotations': [url.split('/')[-1]]}
+
+        self.collection._client = unittest.mock.MagicMock(HOME='https://mockzegami.com', API_1='api/v1', _auth_get=get)
+        self.collection._workspace = unittest.mock.MagicMock(id='ws')
+
+        results = self.collection.get_annotations_for_images([0, 2, 0])
+        self.assertEqual(results, [{'annotations': ['2']}, {'annotations': ['0']}, {'annotations': ['2']}])
+        self.assertEqual(sorted(fetched), ['0', '2'])
+
+        # The least recently used image is evicted, the other is still cached
+        self.collection.get_annotations_for_images([2], source=1)
+        self.collection.get_annotations_for_images([0])
+        self.assertEqual(len(fetched), 3)
+        self.collection.get_annotations_for_images([2])
+        self.assertEqual(len(fetched), 4)
+
+
+class TestAnnotationTable(unittest.TestCase):
+    def setUp(self):
+        self.annos = [
+            {'id': 'a', 'type': 'zc-boundingbox', 'author': 'model', 'image_index': 3, 'class_id': '1',
+             'annotation': {'x': 1, 'y': 2, 'w': 3, 'h': 4, 'score': 0.9}},
+            {'id': 'b', 'type': 'zc-polygon', 'author': 'me', 'image_index': 1, 'class_id': 2,
+             'annotation': {'points': [[0, 0], [4, 0], [4, 2]], 'score': None}},
+            {'id': 'c', 'type': 'mask', 'author': 'model', 'image_index': 3,
+             'annotation': {'mask': 'data:image/png;base64,AAAA', 'width': 8, 'height': 6,
+                            'roi': {'xmin': 1, 'ymin': 1, 'width': 2, 'height': 2}}},
+            {'id': 'd', 'type': 'zc-polygon', 'author': 'model', 'image_index': 0, 'class_id': 1,
+             'annotation': {'points': [[1, 1], [2, 2], [3, 1], [2, 0]]}},
+        ]
+        self.table = AnnotationTable.from_annotations(self.annos)
+
+    def test_columns(self):
+        self.assertEqual(len(self.table), 4)
+        self.assertEqual(self.table['class_id'].tolist(), [1, 2, -1, 1])
+        self.assertEqual(self.table.bboxes[1].tolist(), [0, 0, 4, 2])
+        self.assertEqual(self.table.points(3).tolist(), [[1, 1], [2, 2], [3, 1], [2, 0]])
+        self.assertEqual(self.table.mask_data(2), 'data:image/png;base64,AAAA')
+        self.assertEqual(self.table.to_dict(1)['annotation']['points'], [[0, 0], [4, 0], [4, 2]])
+
+    def test_filter_and_group(self):
+        model = self.table.filter(author='model', anno_type=['zc-polygon', 'mask'])
+        self.assertEqual(model['id'].tolist(), ['c', 'd'])
+        self.assertEqual(model.points(1).tolist(), [[1, 1], [2, 2], [3, 1], [2, 0]])
+        self.assertEqual(model.mask_data(0), 'data:image/png;base64,AAAA')
+
+        groups = {i: t['id'].tolist() for i, t in self.table.group_by_image()}
+        self.assertEqual(groups, {0: ['d'], 1: ['b'], 3: ['a', 'c']})
+
+        joined = AnnotationTable.concat([self.table.take([3]), self.table.take([1])])
+        self.assertEqual(joined['id'].tolist(), ['d', 'b'])
+        self.assertEqual(joined.points(1).tolist(), [[0, 0], [4, 0], [4, 2]])
+
+
+class TestAnnotationStore(unittest.TestCase):
+    def test_sync_and_query(self):
+        annos = [{'id': 'a{}'.format(i), 'image_index': i % 3, 'class_id': i % 2, 'author': 'model',
+                  'type': 'zc-boundingbox', 'annotation': {'x': i}} for i in range(6)]
+        with tempfile.TemporaryDirectory() as tmp:
+            with AnnotationStore(os.path.join(tmp, 'store.sqlite')) as store:
+                self.assertEqual(store.sync([annos[:4], annos[4:]]), {'inserted': 6, 'updated': 0, 'deleted': 0})
+                self.assertEqual(store.sync([annos]), {'inserted': 0, 'updated': 0, 'deleted': 0})
+
+                changed = dict(annos[0], author='me')
+                result = store.sync([[changed] + annos[1:5]])
+                self.assertEqual(result, {'inserted': 0, 'updated': 1, 'deleted': 1})
+                self.assertEqual(len(store), 5)
+
+                self.assertEqual([a['id'] for a in store.query(image_index=1)], ['a1', 'a4'])
+                self.assertEqual([a['id'] for a in store.query(author='me')], ['a0'])
+                self.assertEqual([a['id'] for a in store.query(class_id=[1], image_index=[0, 1])], ['a3', 'a1'])
+                self.assertEqual(len(store.table(author='model')), 4)
+
+
+class TestSpoolData(unittest.TestCase):
+    @patch.object(collection, 'DATA_CHUNK_ROWS', 3)
+    def test_chunked_serialisation(self):
+        df = pd.DataFrame({'image': ['{}.png'.format(i) for i in range(10)], 'value': range(10)})
+        expected = df.to_csv(sep='\t', index=False).encode('utf-8')
+
+        with collection._spool_data(df) as f:
+            self.assertEqual(f.read(), expected)
+        with collection._spool_data(df.iloc[:0]) as f:
+            self.assertEqual(f.read(), b'image\tvalue\n')
+
+    def test_rows_appended_to_head(self):
+        df = pd.DataFrame({'image': ['c.png'], 'value': [3]})
+        head = [b'image\tvalue\na.png\t1\nb.pn', b'g\t2']
+        with collection._spool_data(df, head=iter(head)) as f:
+            self.assertEqual(f.read(), b'image\tvalue\na.png\t1\nb.png\t2\nc.png\t3\n')
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for rel_path in ['b.PNG', 'sub/a.jpg', 'sub/notes.txt', '.hidden/c.png']:
+            os.makedirs(os.path.dirname(os.path.join(self.root, rel_path)), exist_ok=True)
+            with open(os.path.join(self.root, rel_path), 'wb') as f:
+                f.write(rel_path.encode())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan_matches_extensions_case_insensitively(self):
+        m = Manifest.scan(self.root, UploadableSource.IMAGE_MIMES, blacklist=UploadableSource.BLACKLIST)
+        self.assertEqual(m.names, ['b.PNG', 'a.jpg'])
+        self.assertEqual([m.mime(i) for i in range(len(m))], ['image/png', 'image/jpeg'])
+        self.assertEqual(m.sizes.tolist(), [5, 9])
+
+    def test_save_load_subset(self):
+        m = Manifest.scan(self.root, UploadableSource.IMAGE_MIMES)
+        m.compute_hashes(max_workers=1)
+        path = os.path.join(self.root, 'manifest.npz')
+        m.save(path)
+        loaded = Manifest.load(path)
+        self.assertEqual(loaded.paths, m.paths)
+        subset = loaded.subset([1])
+        self.assertEqual(subset.names, ['a.jpg'])
+        self.assertEqual(subset.hash(0), m.hash(1))
+
+
+class TestDeduplication(unittest.TestCase):
+    def test_find_duplicates_in_batch_and_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, content in [('a.png', b'one'), ('b.png', b'two'), ('c.png', b'one'), ('d.png', b'three')]:
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(content)
+            m = Manifest.scan(tmp, UploadableSource.IMAGE_MIMES)
+            m.compute_hashes(max_workers=1)
+
+            index = HashIndex(os.path.join(tmp, 'index.jsonl'))
+            index.add([(m.hash(3), 'old_d.png', 42)])
+
+            keep, duplicates = find_duplicates(m, HashIndex(index.path))
+            self.assertEqual(keep.tolist(), [0, 1])
+            self.assertEqual(duplicates, [
+                {'name': 'c.png', 'duplicate_of': 'a.png', 'imageset_index': None},
+                {'name': 'd.png', 'duplicate_of': 'old_d.png', 'imageset_index': 42},
+            ])
+
+    def test_upload_of_only_duplicates_reports(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ['a.png', 'b.png']:
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(b'same')
+            us = UploadableSource('d', tmp, deduplicate=True, hash_index_path=os.path.join(tmp, 'index.jsonl'))
+            us._index = 0
+            us.manifest.compute_hashes(max_workers=1)
+            us._get_hash_index().add([(us.manifest.hash(0), 'old.png', 7)])
+
+            with patch.object(UploadableSource, 'source'):
+                report = us._upload()
+            self.assertEqual((report['uploaded'], report['failed']), (0, []))
+            self.assertEqual([d['name'] for d in report['duplicates']], ['a.png', 'b.png'])
+
+    def test_uploaded_shards_are_hash_indexed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            images = os.path.join(tmp, 'images')
+            os.makedirs(images)
+            for name in ['a.png', 'b.png', 'c.png']:
+                with open(os.path.join(images, name), 'wb') as f:
+                    f.write(name.encode())
+            index_path = os.path.join(tmp, 'index.jsonl')
+            us = UploadableSource('d', images, deduplicate=True, hash_index_path=index_path)
+
+            coll = Collection(None, None, {'id': 'c', 'version': 2, 'image_sources': [
+                {'name': 'd', 'imageset_id': 'ims_0', 'imageset_dataset_join_id': 'join_0'}]})
+            coll._workspace = unittest.mock.MagicMock(id='ws')
+            coll._client = unittest.mock.MagicMock()
+            plan_dir = os.path.join(tmp, 'plan')
+            with patch.object(UploadableSource, '_reserve_indices', return_value=10):
+                coll.plan_sharded_upload(us, plan_dir, 2)
+
+            with patch.object(UploadableSource, '_run_upload', return_value={'failed': []}):
+                for shard in range(2):
+                    coll.upload_shard(plan_dir, shard)
+
+            keep, duplicates = find_duplicates(us.manifest, HashIndex(index_path))
+            self.assertEqual(keep.tolist(), [])
+            self.assertEqual([d['imageset_index'] for d in duplicates], [10, 11, 12])
+
+
+class TestTranscoder(unittest.TestCase):
+    def test_transcode_on_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            Image.new('RGB', (300, 200)).save(os.path.join(tmp, 'big.bmp'))
+            Image.new('RGB', (50, 50)).save(os.path.join(tmp, 'small.png'))
+            Image.new('RGB', (300, 200)).save(os.path.join(tmp, 'anim.gif'))
+
+            us = UploadableSource('t', tmp, transcode={'format': 'png', 'max_side': 100})
+            infos = {us._item_info(i)['name']: us._read_item(i) for i in range(len(us))}
+
+            data, info = infos['big.bmp']
+            self.assertEqual(info['mimetype'], 'image/png')
+            self.assertEqual(info['size'], len(data))
+            with Image.open(io.BytesIO(data)) as im:
+                self.assertEqual((im.format, im.size), ('PNG', (100, 67)))
+
+            # Already fitting in the target format, or not a transcoded type
+            for name, mime in [('small.png', 'image/png'), ('anim.gif', 'image/gif')]:
+                f, info = infos[name]
+                self.assertEqual(info['mimetype'], mime)
+                with f, open(os.path.join(tmp, name), 'rb') as original:
+                    self.assertEqual(f.read(), original.read())
+
+    def test_needs_a_change(self):
+        self.assertRaises(ValueError, Transcoder)
+        self.assertRaises(ValueError, Transcoder, format='pdf')
+        self.assertEqual(Transcoder(max_side=10).mime_type('image/tiff'), 'image/tiff')
+
+
+class TestValidation(unittest.TestCase):
+    def test_rejects_unreadable_images(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            Image.new('RGB', (64, 64)).save(os.path.join(tmp, 'good.png'))
+            with open(os.path.join(tmp, 'good.png'), 'rb') as f:
+                png = f.read()
+            os.makedirs(os.path.join(tmp, 'sub'))
+            with open(os.path.join(tmp, 'sub', 'truncated.png'), 'wb') as f:
+                f.write(png[:len(png) // 2])
+            with open(os.path.join(tmp, 'good.dcm'), 'wb') as f:
+                f.write(bytes(128) + b'DICM' + bytes(16))
+            with open(os.path.join(tmp, 'bad.dcm'), 'wb') as f:
+                f.write(bytes(200))
+
+            us = UploadableSource('v', tmp, validate=True)
+            self.assertEqual(sorted(us.filenames), ['good.dcm', 'good.png'])
+            self.assertEqual(sorted(r['name'] for r in us.rejected), ['bad.dcm', 'truncated.png'])
+
+            us = UploadableSource('v', tmp, filename_filter=['good.png', 'sub/truncated.png'], validate=True)
+            self.assertEqual(us.filenames, ['good.png'])
+            self.assertEqual([r['name'] for r in us.rejected], ['truncated.png'])
+
+    def test_very_large_images_are_valid(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'huge.png')
+            Image.new('L', (100, 100)).save(path)
+            # Beyond Pillow's decompression bomb limit (twice MAX_IMAGE_PIXELS raises)
+            with patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+                self.assertIsNone(validation._check_file(path, 'image/png'))
+            with patch.object(Image, 'MAX_IMAGE_PIXELS', 8000), patch.object(validation, 'MAX_DECODE_PIXELS', 10):
+                self.assertIsNone(validation._check_file(path, 'image/png'))
+
+        with ImageValidator(max_workers=1) as validator:
+            validator.submit(tmp, [('missing.png', 'image/png')])
+        self.assertEqual(validator._futures, [])
+
+
+class TestUploadRetries(unittest.TestCase):
+    def test_retries_back_off(self):
+        class FlakyPipeline():
+            def __init__(self):
+                self.runs = []
+
+            def run(self, start, todo):
+                self.runs.append(todo)
+                return {0: 'error'} if len(self.runs) < 3 else {}
+
+        us = InMemorySource('r', [])
+        pipeline = FlakyPipeline()
+        with patch('zegami_sdk.source.sleep') as sleep:
+            self.assertEqual(us._run_pipeline(pipeline, 0, None), {})
+        self.assertEqual(pipeline.runs, [None, [0], [0]])
+        self.assertEqual([c.args[0] for c in sleep.call_args_list],
+                         [us.UPLOAD_RETRY_DELAY, us.UPLOAD_RETRY_DELAY * 2])
+
+
+class TestInMemorySource(unittest.TestCase):
+    def test_read_items(self):
+        us = InMemorySource('m', [], format='jpeg')
+        us._items = [
+            ('array', np.zeros((4, 6, 4), dtype=np.uint8)),
+            ('pil', Image.new('L', (3, 3))),
+            ('raw.png', b'not really a png'),
+            ('bad', 1),
+        ]
+
+        data, info = us._read_item(0)
+        self.assertEqual(info, {'name': 'array', 'size': len(data), 'mimetype': 'image/jpeg'})
+        with Image.open(io.BytesIO(data)) as im:
+            self.assertEqual((im.format, im.size), ('JPEG', (6, 4)))
+
+        self.assertEqual(us._read_item(1)[1]['mimetype'], 'image/jpeg')
+        self.assertEqual(us._read_item(2), (b'not really a png', {'name': 'raw.png', 'size': 16,
+                                                                  'mimetype': 'image/png'}))
+        self.assertRaises(TypeError, us._read_item, 3)
+
+    def test_has_uploadable_source_attributes(self):
+        us = InMemorySource('m', [])
+        for attr in ['image_dir', 'manifest', 'journal_path', 'hash_index_path', 'transcoder']:
+            self.assertIsNone(getattr(us, attr))
+        self.assertFalse(us.deduplicate)
+        self.assertIsNone(us._make_pipeline().scheduler)
+
+
+class TestArchiveSource(unittest.TestCase):
+    def test_list_and_read_members(self):
+        members = {'a/one.png': b'1', 'a/.hidden.png': b'h', 'two.JPG': b'22', 'notes.txt': b't', 'three.tif': b'333'}
+        with tempfile.TemporaryDirectory() as tmp:
+            zip_path = os.path.join(tmp, 'images.zip')
+            with zipfile.ZipFile(zip_path, 'w') as z:
+                for name, data in members.items():
+                    z.writestr(name, data)
+            tar_paths = [os.path.join(tmp, 'images.tar.gz'), os.path.join(tmp, 'images.tar')]
+            for tar_path, mode in zip(tar_paths, ['w:gz', 'w']):
+                with tarfile.open(tar_path, mode) as t:
+                    for name, data in members.items():
+                        info = tarfile.TarInfo(name)
+                        info.size = len(data)
+                        t.addfile(info, io.BytesIO(data))
+
+            for path in [zip_path] + tar_paths:
+                us = ArchiveSource('a', path)
+                self.assertEqual(us.filenames, ['one.png', 'two.JPG', 'three.tif'])
+                # Out of order reads restart a compressed tar stream
+                for i in [2, 0, 1]:
+                    f, info = us._read_item(i)
+                    # Members are opened for streaming, not read into memory
+                    self.assertNotIsInstance(f, bytes)
+                    f.seek(0, os.SEEK_END)
+                    self.assertEqual(f.tell(), info['size'])
+                    f.seek(0)
+                    self.assertEqual(f.read(), members[us.manifest.rel_path(i)])
+                    f.close()
+                self.assertEqual(us._item_info(1)['mimetype'], 'image/jpeg')
+                us._close_archive()
+
+            with open(os.path.join(tmp, 'plain.png'), 'wb') as f:
+                f.write(b'not an archive')
+            self.assertRaises(TypeError, ArchiveSource, 'a', os.path.join(tmp, 'plain.png'))
+
+
+class TestUploadGroups(unittest.TestCase):
+    def test_large_files_get_their_own_group(self):
+        sizer = _GroupSizer(total=5000, initial_bytes=100)
+        sizes = [10, 10, 500, 10, 10]
+        self.assertEqual(sizer.take(sizes, 0, 5), 2)
+        self.assertEqual(sizer.take(sizes, 2, 5), 3)
+        self.assertEqual(sizer.take(sizes, 3, 5), 5)
+
+    def test_callback_errors_end_the_upload(self):
+        uploadable = unittest.mock.MagicMock()
+        uploadable.__len__.return_value = 3
+        uploadable._item_sizes.return_value = None
+        uploadable._get_url_pool.return_value.take.side_effect = lambda n: [('b', 'url')] * n
+        uploadable._read_item.side_effect = IOError('unreadable')
+        journal = unittest.mock.MagicMock()
+        journal.record_failure.side_effect = IOError('disk full')
+
+        pipeline = UploadPipeline(uploadable, put_concurrency=2, journal=journal)
+        outcome = []
+        runner = threading.Thread(target=lambda: outcome.append(self._run(pipeline)), daemon=True)
+        runner.start()
+        runner.join(10)
+        self.assertFalse(runner.is_alive(), 'run() hung on a failed callback')
+        self.assertEqual(str(outcome[0]), 'disk full')
+
+    def test_refused_puts_free_their_slots(self):
+        uploadable = unittest.mock.MagicMock()
+        uploadable.__len__.return_value = 5
+        uploadable._item_sizes.return_value = None
+        uploadable._get_url_pool.return_value.take.side_effect = lambda n: [('b', 'url')] * n
+        files = []
+        uploadable._read_item.side_effect = lambda i: files.append(io.BytesIO(b'x')) or (files[-1], {'size': 1})
+        scheduler = unittest.mock.MagicMock()
+        scheduler.submit.side_effect = RuntimeError('FairScheduler has been shut down')
+
+        pipeline = UploadPipeline(uploadable, max_in_flight=2, scheduler=scheduler)
+        outcome = []
+        runner = threading.Thread(target=lambda: outcome.append(pipeline.run(0)), daemon=True)
+        runner.start()
+        runner.join(10)
+        self.assertFalse(runner.is_alive(), 'run() hung waiting for upload slots')
+        self.assertEqual(sorted(outcome[0]), [0, 1, 2, 3, 4])
+        self.assertTrue(all(f.closed for f in files))
+        self.assertIsNone(pipeline._put_ex)
+
+    @staticmethod
+    def _run(pipeline):
+        try:
+            pipeline.run(0)
+        except Exception as e:
+            return e
+
+
+class TestFairScheduler(unittest.TestCase):
+    def test_queues_take_turns(self):
+        scheduler = FairScheduler(concurrency=1)
+        started, gate = threading.Event(), threading.Event()
+        ran = []
+        scheduler.submit('big', lambda: started.set() or gate.wait())
+        started.wait()
+        futures = [scheduler.submit('big', ran.append, 'big{}'.format(i)) for i in range(4)]
+        futures += [scheduler.submit('small', ran.append, 'small{}'.format(i)) for i in range(2)]
+        failing = scheduler.submit('small', int, 'x')
+        gate.set()
+
+        for f in futures:
+            f.result()
+        self.assertRaises(ValueError, failing.result)
+        self.assertEqual(ran, ['big0', 'small0', 'big1', 'small1', 'big2', 'big3'])
+        scheduler.shutdown()
+
+
+class TestSignedUrlPool(unittest.TestCase):
+    def test_take_skips_expired_urls_and_looks_ahead(self):
+        fetched = []
+
+        def fetch(count):
+            fetched.append(count)
+            expired = ('old', 'https://acc.blob.core.windows.net/c/old?se=2000-01-01T00:00:00Z')
+            fresh = [('b{}'.format(i), 'https://acc.blob.core.windows.net/c/b?se=2999-01-01') for i in range(count)]
+            return [expired] + fresh
+
+        pool = SignedUrlPool(fetch, batch_size=4)
+        taken = pool.take(3)
+        self.assertEqual([blob_id for blob_id, _ in taken], ['b0', 'b1', 'b2'])
+        # One url was left, below the low water mark, so another batch was requested
+        pool.take(2)
+        self.assertEqual(fetched[:2], [4, 4])
+
+    def test_expired_ids_are_renewed_and_batch_sizes_are_per_caller(self):
+        fetched, renewed = [], []
+        expiry = {'old': '2000-01-01T00:00:00Z'}
+
+        def fetch(count):
+            fetched.append(count)
+            ids = ['b{}'.format(len(fetched) * 100 + i) for i in range(count)]
+            if len(fetched) == 1:
+                ids[0] = 'old'
+            return [(i, 'https://acc.blob.core.windows.net/c/{}?se={}'.format(i, expiry.get(i, '2999-01-01')))
+                    for i in ids]
+
+        def renew(blob_ids):
+            renewed.extend(blob_ids)
+            return [(i, 'https://acc.blob.core.windows.net/c/{}?se=2999-01-01'.format(i)) for i in blob_ids]
+
+        pool = SignedUrlPool(fetch, batch_size=4, renew=renew)
+        small, large = pool.sized(2), pool.sized(8)
+        self.assertEqual(len(small.take(1)), 1)
+        self.assertEqual(len(large.take(8)), 8)
+        # Neither caller changed the pool's own batch size
+        self.assertEqual(pool.batch_size, 4)
+        self.assertEqual(fetched[0], 2)
+        self.assertIn(8, fetched)
+        # The expired id was signed again and handed out, not dropped
+        self.assertIn('old', renewed)
+
+
+class TestUploadThrottle(unittest.TestCase):
+    def test_rate_and_budget(self):
+        throttle = UploadThrottle(rate=1000 * 1000, max_in_flight_bytes=100)
+        events = []
+        throttle.add_listener(events.append)
+
+        reserved = throttle.acquire(60)
+        self.assertEqual(throttle.in_flight_bytes, 60)
+        # More than the whole budget takes all of it, once it is free
+        releaser = threading.Timer(0.05, throttle.release, [reserved])
+        releaser.start()
+        start = time.time()
+        self.assertEqual(throttle.acquire(250), 100)
+        self.assertGreater(time.time() - start, 0.04)
+        throttle.release(100)
+
+        # The burst allowance is used up, then sending is paced
+        reader = throttle.wrap(b'x' * 400 * 1000, 400 * 1000)
+        start = time.time()
+        self.assertEqual(sum(len(chunk) for chunk in reader), 400 * 1000)
+        self.assertGreater(time.time() - start, 0.1)
+        self.assertEqual(throttle.bytes_sent, 400 * 1000)
+
+        throttle.rate = None
+        self.assertEqual(events[-1]['event'], 'limits')
+        self.assertIsNone(events[-1]['rate'])
+
+
+class TestUploadJournal(unittest.TestCase):
+    def test_reload_reports_missing_items(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'upload.jsonl')
+            journal = UploadJournal(path)
+            journal.reserve('ims', start=100, delta=6, fingerprint='abc')
+            journal.record_commit(100, 2)
+            journal.record_failure(2, 'timeout')
+            journal.record_commit(103, 3)
+
+            resumed = UploadJournal(path)
+            self.assertTrue(resumed.matches('ims', 6, 'abc'))
+            self.assertFalse(resumed.matches('ims', 7, 'abc'))
+            self.assertEqual(resumed.missing().tolist(), [2])
+            self.assertEqual(resumed.failed, {2: 'timeout'})
+
+            resumed.record_commit(102, 1)
+            self.assertEqual(UploadJournal(path).failed, {})
+
 
 class TestSdkUtil(unittest.TestCase):
 
@@ -74,6 +821,53 @@ class TestSdkUtil(unittest.TestCase):
             )
             self.assertNotEqual(os.path.getsize(self.local_token_path), 0)
 
+    def test_block_upload(self):
+        self.url.BLOCK_UPLOAD_THRESHOLD = 10
+        self.url.BLOCK_SIZE = 4
+        data = b'0123456789ab'
+
+        def body(request):
+            # Throttled uploads stream their bodies
+            return request.body.read() if hasattr(request.body, 'read') else request.body
+
+        with requests_mock.Mocker() as m:
+            azure = 'https://acc.blob.core.windows.net/c/blob?se=2099-01-01&sig=x'
+            m.put(requests_mock.ANY)
+            self.url._upload_to_signed_blob_storage_url(io.BytesIO(data), azure, 'image/tiff')
+            blocks = {r.qs['blockid'][0]: body(r) for r in m.request_history if r.qs.get('comp') == ['block']}
+            self.assertEqual(b''.join(blocks[k] for k in sorted(blocks)), data)
+            commit = m.request_history[-1]
+            self.assertEqual(commit.qs['comp'], ['blocklist'])
+            self.assertEqual(commit.headers['x-ms-blob-content-type'], 'image/tiff')
+
+        # GCS urls not signed for a resumable session go straight to one PUT
+        with requests_mock.Mocker() as m:
+            gcs = 'https://storage.googleapis.com/bucket/blob?X-Goog-SignedHeaders=host&X-Goog-Signature=x'
+            m.put(gcs)
+            self.url._upload_to_signed_blob_storage_url(data, gcs, 'image/tiff')
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(body(m.request_history[-1]), data)
+
+        # Resumable chunks are retried, backing off, and continue from what the session holds
+        with requests_mock.Mocker() as m, patch('zegami_sdk.blocks.sleep') as sleep:
+            gcs = 'https://storage.googleapis.com/bucket/blob?X-Goog-SignedHeaders=host%3Bx-goog-resumable'
+            session = 'https://storage.googleapis.com/session'
+            m.post(gcs, headers={'Location': session})
+            held = [{'status_code': 308, 'headers': {'Range': 'bytes=0-{}'.format(n)}} for n in (3, 7)]
+            m.put(session, [held[0], {'status_code': 503}, held[0], {'status_code': 503}, held[0], held[1],
+                            {'status_code': 200}])
+            upload = BlockUpload(requests.Session(), gcs, data, len(data), 'image/tiff', chunk_size=4,
+                                 retry_delay=0.5)
+            with patch('zegami_sdk.blocks.GCS_CHUNK_MULTIPLE', 4):
+                self.assertTrue(upload.run())
+            self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.5, 1.0])
+
+        # Small blobs always go in one PUT
+        with requests_mock.Mocker() as m:
+            m.put(azure)
+            self.url._upload_to_signed_blob_storage_url(data[:4], azure, 'image/png')
+            self.assertEqual(m.call_count, 1)
+
 
 @unittest.mock.patch.dict(os.environ, {'ALLOW_INSECURE_SSL': 'yes'})
 class TestSdkUtilVerifySSLFalse(TestSdkUtil):
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""upload bandwidth shaping functionality."""
+
+import io
+import threading
+from time import sleep, time
+
+
+class UploadThrottle():
+    """
+    Shapes every upload made through one client: image uploads, data
+    replacement and storage items share it (see client.upload_throttle).
+
+    'rate' caps the bytes sent per second across all uploads, and
+    'max_in_flight_bytes' caps the bytes of the blobs (or blob chunks)
+    being sent at once. Either may be None for no limit, and both can be
+    changed at any time, including mid-upload, eg:
+
+        zc.upload_throttle.rate = 10 * 1024 * 1024
+
+    Listeners added with add_listener() are called with progress events,
+    dicts of { event, bytes_sent, in_flight_bytes, rate, throughput }
+    where 'event' is 'progress' (at most every 'report_interval'
+    seconds while sending) or 'limits' (when a limit changes) and
+    'throughput' is the recent bytes per second sent.
+    """
+
+    # Seconds of sending the rate limit lets accumulate while idle
+    BURST_SECONDS = 0.25
+
+    def __repr__(self):
+        return '<UploadThrottle rate={} max_in_flight_bytes={}>'.format(self.rate, self.max_in_flight_bytes)
+
+    def __init__(self, rate=None, max_in_flight_bytes=None, report_interval=1.0):
+        self._rate = rate
+        self._max_in_flight_bytes = max_in_flight_bytes
+        self.report_interval = report_interval
+        self._cond = threading.Condition()
+        self._tokens = 0.0
+        self._last_refill = time()
+        self._in_flight = 0
+        self._listeners = []
+
+        self.bytes_sent = 0
+        self._last_report = time()
+        self._report_bytes = 0
+        self.throughput = 0.0
+
+    @property
+    def rate():
+        pass
+
+    @rate.getter
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate should be a positive number of bytes per second or None, not {}'.format(rate))
+        with self._cond:
+            self._rate = rate
+            self._tokens = min(self._tokens, 0.0)
+            self._cond.notify_all()
+        self._emit('limits')
+
+    @property
+    def max_in_flight_bytes():
+        pass
+
+    @max_in_flight_bytes.getter
+    def max_in_flight_bytes(self):
+        return self._max_in_flight_bytes
+
+    @max_in_flight_bytes.setter
+    def max_in_flight_bytes(self, max_in_flight_bytes):
+        if max_in_flight_bytes is not None and max_in_flight_bytes <= 0:
+            raise ValueError('max_in_flight_bytes should be a positive int or None, not {}'
+                             .format(max_in_flight_bytes))
+        with self._cond:
+            self._max_in_flight_bytes = max_in_flight_bytes
+            self._cond.notify_all()
+        self._emit('limits')
+
+    @property
+    def in_flight_bytes():
+        pass
+
+    @in_flight_bytes.getter
+    def in_flight_bytes(self) -> int:
+        return self._in_flight
+
+    def add_listener(self, callback):
+        """Calls 'callback(event)' with every progress event."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def acquire(self, nbytes) -> int:
+        """
+        Waits until 'nbytes' fit in the in-flight budget, returning the
+        amount reserved, which must be given back with release(). A blob
+        larger than the whole budget waits for it to be free, then takes
+        all of it.
+        """
+        with self._cond:
+            while True:
+                limit = self._max_in_flight_bytes
+                reserved = nbytes if limit is None else min(nbytes, limit)
+                if limit is None or self._in_flight + reserved <= limit:
+                    self._in_flight += reserved
+                    return reserved
+                self._cond.wait()
+
+    def release(self, reserved):
+        with self._cond:
+            self._in_flight -= reserved
+            self._cond.notify_all()
+
+    def consume(self, nbytes):
+        """Waits until the rate limit allows sending 'nbytes', then counts them as sent."""
+        with self._cond:
+            rate = self._rate
+            if rate is not None:
+                now = time()
+                self._tokens = min(self._tokens + (now - self._last_refill) * rate, rate * self.BURST_SECONDS)
+                self._last_refill = now
+                self._tokens -= nbytes
+                delay = -self._tokens / rate if self._tokens < 0 else 0
+            else:
+                delay = 0
+        if delay:
+            sleep(delay)
+        self._count(nbytes)
+
+    def _count(self, nbytes):
+        with self._cond:
+            self.bytes_sent += nbytes
+            now = time()
+            elapsed = now - self._last_report
+            if elapsed < self.report_interval:
+                return
+            self.throughput = (self.bytes_sent - self._report_bytes) / elapsed
+            self._last_report = now
+            self._report_bytes = self.bytes_sent
+        self._emit('progress')
+
+    def _emit(self, event):
+        if not self._listeners:
+            return
+        e = {
+            'event': event,
+            'bytes_sent': self.bytes_sent,
+            'in_flight_bytes': self._in_flight,
+            'rate': self._rate,
+            'throughput': self.throughput,
+        }
+        for callback in list(self._listeners):
+            callback(e)
+
+    def wrap(self, data, size) -> '_ThrottledReader':
+        """Wraps bytes or a file-like object of 'size' bytes in a reader that sends at the allowed rate."""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = io.BytesIO(data)
+        return _ThrottledReader(self, data, size)
+
+
+class _ThrottledReader():
+    """A file-like object that requests streams from, reading at its throttle's rate."""
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, throttle, data, size):
+        self._throttle = throttle
+        self._data = data
+        self._remaining = size
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1) -> bytes:
+        if size is None or size < 0:
+            size = self._remaining
+        chunk = self._data.read(min(size, self._remaining))
+        self._remaining -= len(chunk)
+        self._throttle.consume(len(chunk))
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.BLOCK_SIZE)
+            if not chunk:
+                return
+            yield chunk
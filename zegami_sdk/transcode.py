@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""image transcoding functionality."""
+
+from concurrent.futures import ProcessPoolExecutor
+import io
+import os
+
+from PIL import Image
+
+FORMAT_MIMES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'tiff': 'image/tiff',
+}
+
+
+def _transcode_file(path, fmt, quality, max_side) -> bytes:
+    """
+    Re-encodes one image file, returning the new file's bytes, or None if
+    it already fits and needs no new format. Module level to be picklable.
+    """
+    with Image.open(path) as im:
+        resize = max_side is not None and max(im.size) > max_side
+        if not resize and fmt in (None, im.format.lower()):
+            return None
+
+        if resize:
+            im.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        out_fmt = fmt or im.format.lower()
+        if out_fmt == 'jpeg' and im.mode not in ('L', 'RGB'):
+            im = im.convert('RGB')
+
+        buffer = io.BytesIO()
+        save_kwargs = {'optimize': True} if out_fmt == 'png' else {'quality': quality}
+        im.save(buffer, format=out_fmt.upper(), **save_kwargs)
+        return buffer.getvalue()
+
+
+class Transcoder():
+    """
+    Re-encodes and/or downscales images on the client before they are
+    uploaded, for sources of large files that are never viewed at full
+    resolution (eg uncompressed TIFF or BMP).
+
+    'format' is the format images are re-encoded to ('png', 'jpeg', 'webp'
+    or 'tiff'), or None to keep each image's own format. 'quality' applies
+    to lossy formats. Images with a side longer than 'max_side' pixels are
+    scaled down to fit, keeping their aspect ratio.
+
+    Only images of the given 'mimes' are transcoded, by default every type
+    Pillow reads other than DICOM and (possibly animated) GIF. Other images
+    are uploaded as they are.
+
+    Images are transcoded in a pool of 'max_workers' processes, one image at
+    a time as the upload reaches it, so nothing is written to disk.
+    """
+
+    DEFAULT_MIMES = ('image/bmp', 'image/jpeg', 'image/png', 'image/tiff')
+
+    def __repr__(self):
+        return '<Transcoder format={}, quality={}, max_side={}>'.format(self.format, self.quality, self.max_side)
+
+    def __init__(self, format=None, quality=90, max_side=None, mimes=DEFAULT_MIMES, max_workers=None):
+        if format is not None and format.lower() not in FORMAT_MIMES:
+            raise ValueError('format should be one of {} or None, not "{}"'.format(list(FORMAT_MIMES), format))
+        if max_side is not None and (type(max_side) is not int or max_side < 1):
+            raise ValueError('max_side should be a positive int or None, not {}'.format(max_side))
+        if format is None and max_side is None:
+            raise ValueError('Transcoder needs a format, a max_side or both')
+
+        self.format = None if format is None else format.lower()
+        self.quality = quality
+        self.max_side = max_side
+        self.mimes = tuple(mimes)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._ex = None
+
+    @classmethod
+    def _parse(cls, transcode):
+        """Returns a Transcoder (or None) from a Transcoder, a dict of its arguments or None."""
+        if type(transcode) is dict:
+            transcode = cls(**transcode)
+        if transcode is not None and not isinstance(transcode, cls):
+            raise TypeError('transcode should be a Transcoder or a dict of its arguments, not {}'
+                            .format(type(transcode)))
+        return transcode
+
+    def applies_to(self, mime_type) -> bool:
+        return mime_type in self.mimes
+
+    def mime_type(self, mime_type) -> str:
+        """The mime type an image of 'mime_type' is uploaded as."""
+        if self.format is None or not self.applies_to(mime_type):
+            return mime_type
+        return FORMAT_MIMES[self.format]
+
+    def __enter__(self):
+        self._ex = ProcessPoolExecutor(self.max_workers)
+        return self
+
+    def __exit__(self, *args):
+        self._ex.shutdown()
+        self._ex = None
+
+    def transcode(self, path, mime_type) -> bytes:
+        """
+        Returns the transcoded bytes of the image at 'path', or None if it
+        should be uploaded unchanged. Runs in the process pool when used as
+        a context manager, otherwise in this process.
+        """
+        if not self.applies_to(mime_type):
+            return None
+        args = (path, self.format, self.quality, self.max_side)
+        if self._ex is None:
+            return _transcode_file(*args)
+        return self._ex.submit(_transcode_file, *args).result()
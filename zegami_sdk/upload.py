@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""image upload pipeline functionality."""
+
+import calendar
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from contextlib import nullcontext
+import threading
+from time import strptime, time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from tqdm import tqdm
+
+
+def _signed_url_expiry(url, default_ttl):
+    """
+    Returns the unix time a signed url expires at, read from its Azure SAS
+    ('se') or GCS ('X-Goog-Date' + 'X-Goog-Expires', or 'Expires') query
+    parameters. Unknown formats are assumed to expire after 'default_ttl'.
+    """
+    query = parse_qs(urlparse(url).query)
+    try:
+        if 'se' in query:
+            se = query['se'][0]
+            fmt = '%Y-%m-%dT%H:%M:%SZ' if 'T' in se else '%Y-%m-%d'
+            return calendar.timegm(strptime(se, fmt))
+        if 'X-Goog-Date' in query and 'X-Goog-Expires' in query:
+            signed_at = calendar.timegm(strptime(query['X-Goog-Date'][0], '%Y%m%dT%H%M%SZ'))
+            return signed_at + int(query['X-Goog-Expires'][0])
+        if 'Expires' in query:
+            return float(query['Expires'][0])
+    except ValueError:
+        pass
+    return time() + default_ttl
+
+
+class SignedUrlPool():
+    """
+    Hands out signed blob storage urls, requesting them in large batches
+    ahead of demand on a background thread so uploads don't wait on signing.
+
+    'fetch(count)' should return a list of (blob_id, url) pairs. Whenever
+    fewer than half a batch of urls remain (or 'low_water', if given),
+    another batch is requested. Batches are 'batch_size' urls unless the
+    caller asks for another size, see sized().
+
+    Urls within 'expiry_margin' seconds of expiring aren't handed out. Their
+    blob ids are already reserved, so if 'renew(blob_ids)' is given (returning
+    fresh (blob_id, url) pairs for the same ids) they are signed again with
+    the next batch rather than dropped.
+
+    Obtain shared pools with client._get_signed_blob_url_pool().
+    """
+
+    def __init__(self, fetch, batch_size=500, low_water=None, default_ttl=600, expiry_margin=300, renew=None):
+        self._fetch = fetch
+        self._renew = renew
+        self.batch_size = batch_size
+        self._low_water = low_water
+        self.default_ttl = default_ttl
+        self.expiry_margin = expiry_margin
+        self._urls = deque()  # (blob_id, url, expires_at)
+        self._expired = []  # blob ids awaiting renewal
+        self._cond = threading.Condition()
+        self._refilling = False
+        self._error = None
+
+    def __len__(self):
+        return len(self._urls)
+
+    @property
+    def low_water():
+        pass
+
+    @low_water.getter
+    def low_water(self) -> int:
+        return self._low_water_for(self.batch_size)
+
+    def _low_water_for(self, batch_size) -> int:
+        return batch_size // 2 if self._low_water is None else self._low_water
+
+    def sized(self, batch_size) -> '_SizedUrlPool':
+        """A view of this pool whose takes and prefetches request batches of 'batch_size'."""
+        return _SizedUrlPool(self, batch_size)
+
+    def prefetch(self, count=None, batch_size=None):
+        """Starts fetching a batch in the background without waiting for it."""
+        batch_size = batch_size or self.batch_size
+        with self._cond:
+            self._start_refill(count or batch_size, batch_size)
+
+    def take(self, count=1, batch_size=None) -> list:
+        """
+        Returns 'count' unexpired (blob_id, url) pairs, waiting on a fetch if
+        too few are ready. Any fetches requested are of 'batch_size' urls.
+        """
+        batch_size = batch_size or self.batch_size
+        taken = []
+        with self._cond:
+            while True:
+                self._set_aside_expired()
+                while self._urls and len(taken) < count:
+                    blob_id, url, _ = self._urls.popleft()
+                    taken.append((blob_id, url))
+                if len(taken) == count:
+                    break
+                if self._error is not None:
+                    e, self._error = self._error, None
+                    raise e
+                self._start_refill(count - len(taken), batch_size)
+                self._cond.wait()
+
+            # Look ahead so the next take finds urls ready
+            if len(self._urls) < self._low_water_for(batch_size):
+                self._start_refill(batch_size, batch_size)
+
+        return taken
+
+    def _set_aside_expired(self):
+        """Moves urls close to expiring out of the pool, keeping their ids to renew. Call holding the lock."""
+        cutoff = time() + self.expiry_margin
+        while self._urls and self._urls[0][2] < cutoff:
+            blob_id, _, _ = self._urls.popleft()
+            if self._renew is not None:
+                self._expired.append(blob_id)
+
+    def _start_refill(self, need, batch_size):
+        """Starts a background fetch unless one is running. Call holding the lock."""
+        if self._refilling:
+            return
+        self._refilling = True
+        threading.Thread(target=self._refill, args=(max(need, batch_size),), daemon=True).start()
+
+    def _add(self, pairs):
+        entries = [(blob_id, url, _signed_url_expiry(url, self.default_ttl)) for blob_id, url in pairs]
+        with self._cond:
+            self._urls.extend(entries)
+        return len(entries)
+
+    def _refill(self, count):
+        with self._cond:
+            expired, self._expired = self._expired, []
+        try:
+            if expired:
+                count -= self._add(self._renew(expired))
+                expired = []
+            if count > 0:
+                self._add(self._fetch(count))
+        except Exception as e:
+            with self._cond:
+                self._expired = expired + self._expired
+                self._error = e
+        finally:
+            with self._cond:
+                self._refilling = False
+                self._cond.notify_all()
+
+
+class _SizedUrlPool():
+    """A SignedUrlPool as used by one caller, requesting batches of the caller's 'batch_size'."""
+
+    def __init__(self, pool, batch_size):
+        self.pool = pool
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.pool)
+
+    def prefetch(self, count=None):
+        self.pool.prefetch(count, batch_size=self.batch_size)
+
+    def take(self, count=1) -> list:
+        return self.pool.take(count, batch_size=self.batch_size)
+
+
+class FairScheduler():
+    """
+    Runs the blob uploads of several concurrent UploadPipelines on one
+    shared set of 'concurrency' worker threads.
+
+    Each pipeline submits into its own queue and idle workers take from
+    the queues in turn, so a small source's uploads are interleaved with a
+    large one's instead of waiting behind them, while the total number of
+    concurrent uploads stays within 'concurrency'.
+    """
+
+    def __init__(self, concurrency=32):
+        self.concurrency = concurrency
+        self._queues = {}  # key: deque of (future, fn, args)
+        self._order = deque()  # keys with queued work, in turn order
+        self._cond = threading.Condition()
+        self._threads = []
+        self._shutdown = False
+
+    def submit(self, key, fn, *args) -> Future:
+        """Queues fn(*args) in the queue of 'key', typically the submitting pipeline."""
+        f = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('FairScheduler has been shut down')
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            if not queue:
+                self._order.append(key)
+            queue.append((f, fn, args))
+            if len(self._threads) < self.concurrency:
+                t = threading.Thread(target=self._work, daemon=True)
+                self._threads.append(t)
+                t.start()
+            self._cond.notify()
+        return f
+
+    def _next(self):
+        """Takes the next task, rotating between queues. Call holding the lock."""
+        key = self._order.popleft()
+        queue = self._queues[key]
+        task = queue.popleft()
+        if queue:
+            self._order.append(key)
+        else:
+            del self._queues[key]
+        return task
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._order and not self._shutdown:
+                    self._cond.wait()
+                if not self._order:
+                    return
+                f, fn, args = self._next()
+
+            if not f.set_running_or_notify_cancel():
+                continue
+            try:
+                f.set_result(fn(*args))
+            except BaseException as e:
+                f.set_exception(e)
+
+    def shutdown(self):
+        """Lets the workers finish the queued work, then stop."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+
+class _GroupSizer():
+    """
+    Decides how many consecutive items go into each images_bulk group.
+
+    Groups are capped both by item count and by bytes. Both caps follow the
+    observed upload throughput so a group holds roughly 'target_seconds' of
+    transfer: many small thumbnails share a group, while a very large file
+    ends up in a group on its own rather than holding back the metadata
+    commit of everything queued alongside it.
+    """
+
+    # Seconds of observations gathered before the rates are updated
+    WINDOW = 2.0
+    # Weight of the newest window in the rate moving averages
+    SMOOTHING = 0.3
+
+    def __init__(self, total, max_count=500, target_seconds=5.0, initial_bytes=64 * 1024 * 1024,
+                 min_bytes=1024 * 1024):
+        # Until anything is observed, fall back on sizing by the total work
+        if total > 2500:
+            self.count = 100
+        elif total < 100:
+            self.count = 1
+        else:
+            self.count = 10
+        self.count = min(self.count, max_count)
+        self.bytes = initial_bytes
+
+        self._max_count = max_count
+        self._min_bytes = min_bytes
+        self._target_seconds = target_seconds
+        self._items_rate = None
+        self._bytes_rate = None
+        self._window_start = time()
+        self._window_items = 0
+        self._window_bytes = 0
+        self._lock = threading.Lock()
+
+    def observe(self, size):
+        """Records one completed upload of 'size' bytes."""
+        with self._lock:
+            self._window_items += 1
+            self._window_bytes += size or 0
+            elapsed = time() - self._window_start
+            if elapsed < self.WINDOW:
+                return
+
+            items_rate = self._window_items / elapsed
+            bytes_rate = self._window_bytes / elapsed
+            if self._items_rate is None:
+                self._items_rate, self._bytes_rate = items_rate, bytes_rate
+            else:
+                a = self.SMOOTHING
+                self._items_rate = a * items_rate + (1 - a) * self._items_rate
+                self._bytes_rate = a * bytes_rate + (1 - a) * self._bytes_rate
+
+            self.count = int(min(max(round(self._items_rate * self._target_seconds), 1), self._max_count))
+            self.bytes = int(max(self._bytes_rate * self._target_seconds, self._min_bytes))
+
+            self._window_start = time()
+            self._window_items = 0
+            self._window_bytes = 0
+
+    def take(self, sizes, begin, end) -> int:
+        """Returns the (exclusive) end of the next group starting at 'begin'."""
+        count, max_bytes = self.count, self.bytes
+        stop = min(begin + count, end)
+        if sizes is None:
+            return stop
+
+        total = 0
+        i = begin
+        while i < stop:
+            size = int(sizes[i])
+            # Always take at least one item, but don't let a large file join a non-empty group
+            if i > begin and total + size > max_bytes:
+                break
+            total += size
+            i += 1
+        return i
+
+
+class _UploadGroup():
+    """A contiguous run of items, committed with images_bulk once all have been attempted."""
+
+    def __init__(self, start, indices):
+        self.start = start
+        self.indices = indices
+        self.bulk_info = [None] * len(indices)
+        self.done = Future()
+        self._remaining = len(indices)
+        self._lock = threading.Lock()
+
+    def item_done(self, offset, info) -> bool:
+        """
+        Records an item's bulk info (None if it failed), returning True once
+        every item of the group is done.
+        """
+        with self._lock:
+            self.bulk_info[offset] = info
+            self._remaining -= 1
+            return self._remaining == 0
+
+    def successful_runs(self) -> list:
+        """(begin, end) offsets of the contiguous runs of successfully uploaded items."""
+        runs = []
+        begin = None
+        for offset, info in enumerate(self.bulk_info + [None]):
+            if info is not None and begin is None:
+                begin = offset
+            elif info is None and begin is not None:
+                runs.append((begin, offset))
+                begin = None
+        return runs
+
+
+def _chain(source_future, target_future):
+    """Copies the outcome of one future onto another, unless it already failed."""
+    if target_future.done():
+        return
+    e = source_future.exception()
+    if e is not None:
+        target_future.set_exception(e)
+    else:
+        target_future.set_result(source_future.result())
+
+
+class UploadPipeline():
+    """
+    Uploads the items of an uploadable source in three overlapping stages.
+
+    1. Read: items are opened/prepared by 'read_concurrency' workers.
+    2. Put: each item's bytes are sent to its signed blob storage url by
+       'put_concurrency' workers, independently of the other items in its
+       group, so one slow file doesn't stall the rest.
+    3. Commit: once every item of a group has been attempted, the metadata
+       of its successfully uploaded items is sent with images_bulk POSTs
+       by 'commit_concurrency' workers.
+
+    If a FairScheduler is given, the put stage runs on its shared workers
+    instead, alongside other pipelines.
+
+    Group sizes adapt to file sizes and the observed throughput (see
+    _GroupSizer). At most 'max_in_flight' items are between being read and
+    uploaded at any time, bounding open files and buffered data.
+
+    Items that fail to read, upload or commit are left out of their
+    group's commit (which is split around them so every other item still
+    lands at its own index) and returned from run() so they can be retried.
+    If a journal (see journal.UploadJournal) is given, commits and failures
+    are recorded in it as they happen.
+
+    The uploadable provides, per item index:
+        - _item_info(index): {'name', 'size', 'mimetype'}
+        - _read_item(index): (data, info), data being bytes or a file-like
+          object (closed after uploading)
+    along with _item_sizes() (an array of sizes, or None if unknown up
+    front) and _get_url_pool() (the SignedUrlPool to take blob urls from).
+    """
+
+    def __init__(self, uploadable, put_concurrency=16, read_concurrency=4, commit_concurrency=4,
+                 max_group_count=500, target_group_seconds=5.0, max_in_flight=None, journal=None, scheduler=None,
+                 desc=None, position=None):
+        self._uploadable = uploadable
+        self.scheduler = scheduler
+        self.desc = desc
+        self.position = position
+        self.put_concurrency = put_concurrency
+        self.read_concurrency = read_concurrency
+        self.commit_concurrency = commit_concurrency
+        self.max_group_count = max_group_count
+        self.target_group_seconds = target_group_seconds
+        self.max_in_flight = max_in_flight or put_concurrency * 2
+        self.journal = journal
+
+    def run(self, start, indices=None) -> dict:
+        """
+        Uploads items of the uploadable (all of them, or the given item
+        'indices') so that item i lands at imageset index start + i.
+
+        Returns { item index: error message } of the items that failed.
+        """
+        u = self._uploadable
+        coll = u.source.collection
+        self._client = coll.client
+        self._workspace_id = coll.workspace_id
+        self._url_pool = u._get_url_pool()
+        self._failures = {}
+        self._failures_lock = threading.Lock()
+
+        indices = np.arange(len(u)) if indices is None else np.sort(np.asarray(indices, dtype=np.int64))
+        sizes = u._item_sizes()
+        if sizes is not None:
+            sizes = np.asarray(sizes)[indices]
+
+        self._sizer = _GroupSizer(len(indices), max_count=self.max_group_count,
+                                  target_seconds=self.target_group_seconds)
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+
+        # Groups must be contiguous in index space, so never span a gap
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        runs = zip(np.r_[0, breaks], np.r_[breaks, len(indices)])
+
+        # Blob uploads run on the scheduler's workers instead, if there is one
+        put_ex = ThreadPoolExecutor(self.put_concurrency) if self.scheduler is None else nullcontext()
+
+        groups = []
+        with ThreadPoolExecutor(self.read_concurrency) as self._read_ex,\
+                put_ex as self._put_ex,\
+                ThreadPoolExecutor(self.commit_concurrency) as self._commit_ex,\
+                tqdm(total=len(indices), unit='image', leave=True, desc=self.desc, position=self.position) as self._bar:
+
+            for run_begin, run_end in runs:
+                begin = run_begin
+                while begin < run_end:
+                    end = self._sizer.take(sizes, begin, run_end)
+                    group = _UploadGroup(start + int(indices[begin]), indices[begin:end])
+                    groups.append(group)
+                    self._submit_group(group)
+                    begin = end
+
+            for g in groups:
+                e = g.done.exception()
+                if e is not None:
+                    raise e
+
+        return self._failures
+
+    def _submit_group(self, group):
+        urls = self._url_pool.take(len(group.indices))
+        for offset, (index, (blob_id, blob_url)) in enumerate(zip(group.indices, urls)):
+            self._submit_item(group, offset, int(index), blob_id, blob_url)
+
+    def _submit_item(self, group, offset, index, blob_id, blob_url):
+        self._slots.acquire()
+        f = self._read_ex.submit(self._uploadable._read_item, index)
+        f.add_done_callback(lambda f: self._on_read(f, group, offset, index, blob_id, blob_url))
+
+    @staticmethod
+    def _fail_group(group, e):
+        """
+        Ends a group with an error raised in a done-callback, which
+        concurrent.futures would otherwise log and drop, leaving run()
+        waiting on the group forever.
+        """
+        if not group.done.done():
+            try:
+                group.done.set_exception(e)
+            except InvalidStateError:
+                pass
+
+    def _on_read(self, f, group, offset, index, blob_id, blob_url):
+        try:
+            e = f.exception()
+            if e is not None:
+                self._on_item_done(group, offset, index, blob_id, None, e)
+                return
+            data, info = f.result()
+            try:
+                if self.scheduler is not None:
+                    pf = self.scheduler.submit(self, self._put, data, info, blob_url)
+                else:
+                    pf = self._put_ex.submit(self._put, data, info, blob_url)
+            except Exception as e:
+                # The item never reached _put, so close it and free its slot here
+                if hasattr(data, 'close'):
+                    data.close()
+                self._on_item_done(group, offset, index, blob_id, info, e)
+                return
+            pf.add_done_callback(lambda pf: self._on_item_done(group, offset, index, blob_id, info, pf.exception()))
+        except Exception as e:
+            self._fail_group(group, e)
+
+    def _put(self, data, info, blob_url):
+        try:
+            self._client._upload_to_signed_blob_storage_url(data, blob_url, info['mimetype'])
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+    def _on_item_done(self, group, offset, index, blob_id, info, error):
+        try:
+            self._slots.release()
+            if error is not None:
+                self._record_failure(index, error)
+                info = None
+            else:
+                self._sizer.observe(info['size'])
+                info = {'blob_id': blob_id, **info}
+            self._bar.update(1)
+
+            if group.item_done(offset, info):
+                cf = self._commit_ex.submit(self._commit, group)
+                cf.add_done_callback(lambda cf: _chain(cf, group.done))
+        except Exception as e:
+            self._fail_group(group, e)
+
+    def _record_failure(self, index, error):
+        with self._failures_lock:
+            self._failures[index] = str(error)
+        if self.journal is not None:
+            self.journal.record_failure(index, error)
+
+    def _commit(self, group):
+        """Upload bulk image info for each successful run of a group."""
+        c = self._client
+        for begin, end in group.successful_runs():
+            start = group.start + begin
+            url = (
+                f'{c.HOME}/{c.API_0}/project/{self._workspace_id}/imagesets/{self._uploadable.imageset_id}'
+                f'/images_bulk?start={start}'
+            )
+            try:
+                c._auth_post(url, body=None, return_response=True, json={'images': group.bulk_info[begin:end]})
+            except Exception as e:
+                for index in group.indices[begin:end]:
+                    self._record_failure(int(index), e)
+                continue
+            if self.journal is not None:
+                self.journal.record_commit(start, end - begin)
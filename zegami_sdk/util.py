@@ -6,14 +6,20 @@
 
 import os
 from pathlib import Path
+import threading
 from urllib.parse import urlparse
 import uuid
 
 import requests
 import urllib3
 
+from .blocks import _data_size, BlockUpload
+from .upload import SignedUrlPool
+
 ALLOW_INSECURE_SSL = os.environ.get('ALLOW_INSECURE_SSL', False)
 
+_signed_url_pools_lock = threading.Lock()
+
 
 def __get_retry_adapter():
     retry_methods = urllib3.util.retry.Retry.DEFAULT_METHOD_WHITELIST.union(
@@ -178,16 +184,20 @@ def _auth_put(self, url, body, return_response=False, **kwargs):
     return r if return_response and r.ok else r.json()
 
 
-def _obtain_signed_blob_storage_urls(self, workspace_id, id_count=1, blob_path=None):
+def _obtain_signed_blob_storage_urls(self, workspace_id, id_count=1, blob_path=None, ids=None):
     """Obtain a signed blob storage url.
 
+    New blob ids are generated unless 'ids' are given to sign again.
+
     Returns:
         [dict]: blob storage urls
         [dict]: blob storage ids
     """
     blob_url = f'{self.HOME}/{self.API_1}/project/{workspace_id}/signed_blob_url'
 
-    if blob_path:
+    if ids is not None:
+        id_set = {"ids": list(ids)}
+    elif blob_path:
         id_set = {"ids": [f'{blob_path}/{str(uuid.uuid4())}' for i in range(id_count)]}
     else:
         id_set = {"ids": [str(uuid.uuid4()) for i in range(id_count)]}
@@ -198,16 +208,74 @@ def _obtain_signed_blob_storage_urls(self, workspace_id, id_count=1, blob_path=N
     return urls, id_set
 
 
+def _get_signed_url_pool(self, key, fetch, batch_size, renew=None):
+    """Returns the client's shared SignedUrlPool for 'key', creating it with 'fetch' on first use.
+
+    The pool is shared, so each caller gets a view of it that requests
+    batches of its own 'batch_size', see SignedUrlPool.sized().
+    """
+    with _signed_url_pools_lock:
+        if self._signed_url_pools is None:
+            self._signed_url_pools = {}
+        pool = self._signed_url_pools.get(key)
+        if pool is None:
+            pool = self._signed_url_pools[key] = SignedUrlPool(fetch, batch_size=batch_size, renew=renew)
+        return pool.sized(batch_size)
+
+
+def _get_signed_blob_url_pool(self, workspace_id, blob_path, batch_size=500):
+    """Returns the client's shared pool of signed blob storage urls for a blob path.
+
+    Urls are obtained with _obtain_signed_blob_storage_urls() in batches
+    ahead of demand, see upload.SignedUrlPool. Blob ids whose urls expire
+    before use are signed again rather than abandoned.
+    """
+    def fetch(count):
+        urls, id_set = self._obtain_signed_blob_storage_urls(workspace_id, id_count=count, blob_path=blob_path)
+        return [(blob_id, urls[blob_id]) for blob_id in id_set['ids']]
+
+    def renew(blob_ids):
+        urls, id_set = self._obtain_signed_blob_storage_urls(workspace_id, ids=blob_ids)
+        return [(blob_id, urls[blob_id]) for blob_id in id_set['ids']]
+
+    return self._get_signed_url_pool((workspace_id, blob_path), fetch, batch_size, renew=renew)
+
+
 def _upload_to_signed_blob_storage_url(self, data, url, mime_type, **kwargs):
-    """Upload data to an already obtained blob storage url."""
+    """Upload data to an already obtained blob storage url.
+
+    Data of at least BLOCK_UPLOAD_THRESHOLD bytes is sent in parallel,
+    individually retried chunks where the storage allows it, see
+    blocks.BlockUpload. Uploads keep within the client's upload_throttle.
+    """
     if url.startswith("/"):
         url = f'https://storage.googleapis.com{url}'
+
+    throttle = self.upload_throttle
+    size = _data_size(data)
+    if size is not None and size >= self.BLOCK_UPLOAD_THRESHOLD:
+        upload = BlockUpload(
+            self._blobstore_session, url, data, size, mime_type, chunk_size=self.BLOCK_SIZE,
+            concurrency=self.BLOCK_CONCURRENCY, retries=self.BLOCK_RETRIES, verify=not ALLOW_INSECURE_SSL,
+            throttle=throttle)
+        if upload.run():
+            return
+
     headers = {'Content-Type': mime_type}
     # this header is required for the azure blob storage
     # https://docs.microsoft.com/en-us/rest/api/storageservices/put-blob
     if 'windows.net' in url:
         headers['x-ms-blob-type'] = 'BlockBlob'
-    response = self._blobstore_session.put(
-        url, data=data, headers=headers, verify=not ALLOW_INSECURE_SSL, **kwargs
-    )
+
+    reserved = None
+    if throttle is not None and size is not None:
+        reserved = throttle.acquire(size)
+        data = throttle.wrap(data, size)
+    try:
+        response = self._blobstore_session.put(
+            url, data=data, headers=headers, verify=not ALLOW_INSECURE_SSL, **kwargs
+        )
+    finally:
+        if reserved is not None:
+            throttle.release(reserved)
     assert response.ok
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 Zegami Ltd
+
+"""image validation functionality."""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import warnings
+
+from PIL import Image
+
+DICOM_PREAMBLE_SIZE = 128
+DICOM_MAGIC = b'DICM'
+# Images with more pixels than this are checked structurally, not decoded
+MAX_DECODE_PIXELS = 64 * 1024 * 1024
+
+
+def _check_file(path, mime_type) -> str:
+    """
+    Checks one file can be read as its mime type, returning an error
+    message, or None if it is fine (or of a type that can't be checked).
+    """
+    try:
+        if mime_type == 'application/dicom':
+            with open(path, 'rb') as f:
+                f.seek(DICOM_PREAMBLE_SIZE)
+                if f.read(len(DICOM_MAGIC)) != DICOM_MAGIC:
+                    return 'Missing DICOM preamble'
+        elif mime_type.startswith('image/'):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+                # verify() checks structure without decoding
+                with Image.open(path) as im:
+                    im.verify()
+                    pixels = im.width * im.height
+                # Decode as well to catch truncated pixel data, unless that
+                # would take too long (eg gigapixel slides)
+                if pixels <= MAX_DECODE_PIXELS:
+                    with Image.open(path) as im:
+                        im.load()
+    except Image.DecompressionBombError:
+        # Too large for Pillow to open safely, not invalid
+        return None
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
+    return None
+
+
+def _check_files(root, entries) -> list:
+    """Checks (rel_path, mime_type) entries, returning [(rel_path, error)] of the bad ones. Picklable."""
+    errors = []
+    for rel_path, mime_type in entries:
+        error = _check_file(os.path.join(root, rel_path), mime_type)
+        if error is not None:
+            errors.append((rel_path, error))
+    return errors
+
+
+class ImageValidator():
+    """
+    Opens and decodes image files in a pool of 'max_workers' processes to
+    find corrupt or truncated ones before they are uploaded.
+
+    Files are submitted in chunks as they are found (see Manifest.scan()'s
+    'on_found'), so checking overlaps the directory scan. results()
+    waits for every check and shuts the pool down. Use it as a context
+    manager (or call shutdown()) so the pool is also shut down if the scan
+    fails before results() is called.
+    """
+
+    CHUNK_SIZE = 64
+
+    def __init__(self, max_workers=None):
+        self._ex = ProcessPoolExecutor(max_workers)
+        self._futures = []
+
+    def submit(self, root, entries):
+        """Queues (rel_path, mime_type) entries under 'root' for checking."""
+        entries = list(entries)
+        for i in range(0, len(entries), self.CHUNK_SIZE):
+            self._futures.append(self._ex.submit(_check_files, root, entries[i:i + self.CHUNK_SIZE]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        """Stops the checking processes, dropping any checks not yet started."""
+        self._ex.shutdown(cancel_futures=True)
+        self._futures = []
+
+    def results(self) -> dict:
+        """Returns { rel_path: error } of every file that failed its check."""
+        try:
+            return {rel_path: error for f in self._futures for rel_path, error in f.result()}
+        finally:
+            self.shutdown()
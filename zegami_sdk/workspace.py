@@ -13,8 +13,10 @@ from azure.storage.blob import (
 )
 import pandas as pd
 
+from .blocks import _data_size
 from .collection import Collection
-from .helper import guess_data_mimetype
+from .helper import (DELIMITED_EXTENSIONS, guess_data_mimetype, read_data_columns, SERVER_DELIMITERS,
+                     sniff_data_delimiter)
 from .source import UploadableSource
 
 
@@ -112,29 +114,51 @@ class Workspace():
             mime_type = guess_data_mimetype(data)
 
         # get signed url to use signature
-        client = self._client
-        url = '{}/{}/project/{}/storage/signedurl'.format(client.HOME, client.API_1, self.id)
-        if item_name:
-            url += '?name={}'.format(item_name)
-        resp = client._auth_get(url)
+        resp = self._get_storage_signed_url(item_name)
+        storage_id, url = resp['id'], resp['signedurl']
 
-        blob_id = 'storage/' + resp['id']
-        url = resp['signedurl']
+        blob_id = 'storage/' + storage_id
 
         url_object = urlparse(url)
         sas_token = url_object.query
         account_url = url_object.scheme + '://' + url_object.netloc
         container_name = url_object.path.split('/')[1]
 
-        container_client = ContainerClient(account_url, container_name, credential=sas_token)
-        container_client.upload_blob(
-            blob_id,
-            data,
-            blob_type='BlockBlob',
-            content_settings=ContentSettings(content_type=mime_type)
-        )
+        # Large items go up in parallel blocks, sized like image uploads
+        c = self._client
+        container_client = ContainerClient(
+            account_url, container_name, credential=sas_token,
+            max_single_put_size=c.BLOCK_UPLOAD_THRESHOLD, max_block_size=c.BLOCK_SIZE)
+
+        # Keep within the client's bandwidth and in-flight budget
+        throttle = c.upload_throttle
+        size = _data_size(data)
+        reserved = None
+        if throttle is not None and size is not None:
+            reserved = throttle.acquire(size)
+            data = throttle.wrap(data, size)
+        try:
+            container_client.upload_blob(
+                blob_id,
+                data,
+                length=size,
+                blob_type='BlockBlob',
+                content_settings=ContentSettings(content_type=mime_type),
+                max_concurrency=c.BLOCK_CONCURRENCY
+            )
+        finally:
+            if reserved is not None:
+                throttle.release(reserved)
 
-        return resp['id']
+        return storage_id
+
+    def _get_storage_signed_url(self, item_name=None) -> dict:
+        """Obtains { id, signedurl } for a new storage item."""
+        c = self._client
+        url = '{}/{}/project/{}/storage/signedurl'.format(c.HOME, c.API_1, self.id)
+        if item_name:
+            url += '?name={}'.format(item_name)
+        return c._auth_get(url)
 
     def delete_storage_item(self, storage_id) -> bool:
         """Deletes a storage item by ID. Returns the response's OK signal."""
@@ -233,6 +257,9 @@ class Workspace():
 
             Provide a pandas.DataFrame() a filepath to a .csv.
 
+            Multiple sources are uploaded concurrently, sharing
+            UploadableSource.TOTAL_UPLOAD_CONCURRENCY uploads between them.
+
         - description:
             A description for the collection.
 
@@ -259,25 +286,36 @@ class Workspace():
                 'is required to correctly join different images from each'
             )
 
-        # Parse data
+        # Data files are checked by their header and uploaded as they are,
+        # only being parsed if in a format the server can't take directly
+        columns = None
         if type(data) is str:
             if not os.path.exists(data):
                 raise FileNotFoundError(
                     'Data file "{}" doesn\'t exist'.format(data))
 
             # Check the file extension
-            if data.split('.')[-1] == 'tsv':
-                data = pd.read_csv(data, delimiter='\t')
-            elif data.split('.')[-1] in ['xls', 'xlsx']:
-                data = pd.read_excel(data)
+            ext = data.split('.')[-1].lower()
+            if ext in ['xls', 'xlsx']:
+                columns = read_data_columns(data)
+            elif ext in DELIMITED_EXTENSIONS:
+                # Only upload as is if the server will split it the same way
+                delimiter = sniff_data_delimiter(data)
+                if SERVER_DELIMITERS.get(ext) == delimiter:
+                    columns = read_data_columns(data)
+                else:
+                    data = pd.read_csv(data, sep=delimiter)
             else:
                 data = pd.read_csv(data)
 
+        if isinstance(data, pd.DataFrame):
+            columns = list(data.columns)
+
         # Check that all source filenames exist in the provided data
         if data is not None:
             print('- Checking data matches uploadable sources')
             for s in uploadable_sources:
-                s._check_in_data(data)
+                s._check_in_data(columns)
 
         # Creating an empty collection requires these parameters
         source_names_and_filename_cols = {n: c for n, c in zip(
@@ -292,7 +330,7 @@ class Workspace():
         blank_id = blank_resp['id']
         blank = self.get_collection_by_id(blank_id)
 
-        # If uploading data, do it now from the DataFrame, ignoring fail block
+        # If uploading data, do it now, ignoring fail block
         if data is not None:
             print('- Uploading data')
             blank.replace_data(data, fail_if_not_ready=False)
@@ -303,14 +341,16 @@ class Workspace():
             us._register_source(i, blank.sources[i])
 
         # Upload source data
-        for us in uploadable_sources:
-            us._upload()
+        UploadableSource._upload_all(uploadable_sources)
 
         # Format output string
         plural_str = '' if len(uploadable_sources) < 2 else 's'
-        data_str = 'no data' if data is None else\
-            'data of shape {} rows x {} columns'\
-            .format(len(data), len(data.columns))
+        if data is None:
+            data_str = 'no data'
+        elif isinstance(data, pd.DataFrame):
+            data_str = 'data of shape {} rows x {} columns'.format(len(data), len(data.columns))
+        else:
+            data_str = 'data from "{}" ({} columns)'.format(data, len(columns))
 
         print(
             '\n- Finished collection "{}" upload using {} image source{} with {}'